@@ -1,21 +1,38 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, session
+from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, session, Response, stream_with_context, abort
 import os
 import sys
 import json
 import uuid
+import hashlib
 import time
 import threading
+import queue
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import re
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
 import calendar
+import sqlite3
+import csv
+import io
+import math
+from functools import lru_cache
+from collections import deque, OrderedDict, Counter
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, fields
+from typing import NamedTuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 # Fix Windows console encoding for emoji/unicode
 if sys.platform == 'win32':
     sys.stdout.reconfigure(encoding='utf-8', errors='replace')
     sys.stderr.reconfigure(encoding='utf-8', errors='replace')
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, orm, or_, and_, func
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
 from flask_migrate import Migrate
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
@@ -31,8 +48,42 @@ if not os.getenv("SECRET_KEY"):
     print("WARNING: Using a randomly generated secret key. Set SECRET_KEY in .env for persistent sessions.")
 
 # Configure database
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///chatbot.db'
+# DATABASE_URL picks the engine (e.g. PostgreSQL in production, needs psycopg2-binary);
+# without it the app uses the local SQLite file. SQLite connections run in WAL mode so
+# readers do not block the single writer, and wait on a locked database instead of failing.
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///chatbot.db")
+if DATABASE_URL.startswith("postgres://"):  # Render/Heroku style URL, not accepted by SQLAlchemy
+    DATABASE_URL = "postgresql://" + DATABASE_URL[len("postgres://"):]
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))  # seconds, below typical server idle timeouts
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "15000"))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+
+app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+if not DATABASE_URL.startswith("sqlite"):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": True,
+    }
+
+@event.listens_for(Engine, "connect")
+def configure_sqlite_connection(dbapi_connection, connection_record):
+    """Apply SQLite mode settings to each new connection."""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")  # durable in WAL mode except on power loss
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    cursor.close()
+
 db = SQLAlchemy(app)
 migrate = Migrate(app, db)  # Initialize Flask-Migrate
 
@@ -55,8 +106,8 @@ BUSINESS INFORMATION:
 - Availability: {availability}
 - Booking Process: {booking_process}
 
-FREQUENTLY ASKED QUESTIONS:
-{faqs}
+FREQUENTLY ASKED QUESTIONS & MORE DETAILS:
+The FAQs and business details relevant to each customer message are provided in a "RELEVANT KNOWLEDGE" note. Answer from them when they apply.
 
 ═══════════════════════════════════════════
 WELCOME MESSAGE (FIRST MESSAGE ONLY):
@@ -96,8 +147,7 @@ When a customer wants to book an appointment:
    💬 **Notes** (optional)"
 
 2. **PRE-VALIDATION (CRITICAL)**:
-   Below are the slots already BOOKED. If the user picks one of these, tell them immediately it's taken and ask for a different slot:
-   {unavailable_slots}
+   The slots already BOOKED are listed in the "BOOKED SLOTS" note sent with each message. If the user picks one of these, tell them immediately it's taken and ask for a different slot.
 
 3. Valid Booking Hours: {appointment_hours}
    If outside these hours, politely suggest an alternative.
@@ -150,7 +200,7 @@ if not api_key:
     api_key = "mock_key"
 
 # OpenRouter API endpoint
-api_url = "https://openrouter.ai/api/v1/chat/completions"
+OPENROUTER_CHAT_URL = "https://openrouter.ai/api/v1/chat/completions"
 
 # Get the deployment URL from environment or use default for local development
 deployment_url = os.getenv("RENDER_EXTERNAL_URL", "https://chatbot.example.com")
@@ -163,6 +213,39 @@ headers = {
     "X-Title": "Business Assistant Bot"  # Title for your application on OpenRouter rankings
 }
 
+# --- Outbound HTTP (pooled, keep-alive) ---
+# Every outbound call goes through one of these sessions so TLS connections to
+# OpenRouter and Telegram are reused instead of re-handshaking on every request.
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "20"))         # connections kept per host
+HTTP_MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", "2"))
+HTTP_RETRY_BACKOFF = float(os.getenv("HTTP_RETRY_BACKOFF", "0.5"))  # seconds, doubled per retry
+TELEGRAM_TIMEOUT = float(os.getenv("TELEGRAM_TIMEOUT", "10"))
+TELEGRAM_CALLBACK_TIMEOUT = 5  # answer/edit calls should never hold the update handler long
+
+def _build_http_session(retry, pool_size=HTTP_POOL_SIZE):
+    """Create a requests session with a keep-alive connection pool and retry policy."""
+    http = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+    http.mount("https://", adapter)
+    http.mount("http://", adapter)
+    return http
+
+# OpenRouter: only retry failed connects; model-level fallback is handled by hedging
+openrouter_http = _build_http_session(Retry(
+    total=HTTP_MAX_RETRIES, connect=HTTP_MAX_RETRIES, read=0, status=0,
+    backoff_factor=HTTP_RETRY_BACKOFF
+))
+
+# Telegram: also retry rate limits and gateway errors, honouring Retry-After
+telegram_http = _build_http_session(Retry(
+    total=HTTP_MAX_RETRIES, connect=HTTP_MAX_RETRIES, read=0, status=HTTP_MAX_RETRIES,
+    status_forcelist=(429, 502, 503, 504), allowed_methods=frozenset(["GET", "POST"]),
+    backoff_factor=HTTP_RETRY_BACKOFF, respect_retry_after_header=True, raise_on_status=False
+))
+
+# Everything else (self-ping)
+default_http = _build_http_session(Retry(total=HTTP_MAX_RETRIES, backoff_factor=HTTP_RETRY_BACKOFF))
+
 # --- Keep-Alive System (Render Sleep Prevention) ---
 def keep_alive():
     """Background thread to ping the app and keep it from sleeping on Render."""
@@ -183,7 +266,7 @@ def keep_alive():
             # Wait for 10 minutes (600 seconds)
             time.sleep(600)
             print(f"DEBUG KEEP-ALIVE: Pinging {health_url}...")
-            response = requests.get(health_url, timeout=10)
+            response = default_http.get(health_url, timeout=10)
             print(f"DEBUG KEEP-ALIVE: Status={response.status_code}")
         except Exception as e:
             print(f"DEBUG KEEP-ALIVE: Error: {e}")
@@ -211,6 +294,10 @@ def _register_all_webhooks():
     except Exception as e:
         print(f"WEBHOOK-REG ERROR: {e}")
 
+def telegram_webhook_secret(bot_token):
+    """Secret Telegram echoes in X-Telegram-Bot-Api-Secret-Token, derived from the bot token."""
+    return hashlib.sha256(f"webhook:{bot_token}".encode()).hexdigest()
+
 def _register_single_webhook(bot_token, config_id, business_name, base_url=None):
     """Register a single bot's webhook with Telegram."""
     if not base_url:
@@ -220,7 +307,7 @@ def _register_single_webhook(bot_token, config_id, business_name, base_url=None)
     webhook_url = f"{base_url}/telegram/webhook/{config_id}"
     try:
         url = f"https://api.telegram.org/bot{bot_token}/setWebhook"
-        resp = requests.post(url, json={"url": webhook_url}, timeout=10)
+        resp = telegram_http.post(url, json={"url": webhook_url, "secret_token": telegram_webhook_secret(bot_token)}, timeout=TELEGRAM_TIMEOUT)
         ok = resp.status_code == 200 and resp.json().get('ok')
         if ok:
             print(f"WEBHOOK-REG: ✅ {business_name} -> {webhook_url}")
@@ -266,8 +353,8 @@ BUSINESS_TYPES = [
 class PollerState:
     started = False
     lock = threading.Lock()
-    processed_updates = set()
-    max_buffer = 1000
+    pollers = {}  # bot_token -> BotPoller
+    stopping = {}  # bot_token -> stopped BotPoller whose in-flight getUpdates has not returned yet
 
 poller_state = PollerState()
 
@@ -295,45 +382,250 @@ class FAQ(db.Model):
 class Conversation(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     session_id = db.Column(db.String(200), nullable=False, index=True)
-    config_id = db.Column(db.String(50), nullable=False)
-    history = db.Column(db.Text, nullable=False)  # JSON string of conversation history
+    config_id = db.Column(db.String(50), nullable=False, index=True)
+    history = db.Column(db.Text, nullable=False, default='')  # Legacy JSON blob, moved into Message rows on first access
+    message_count = db.Column(db.Integer, default=0)  # Next Message.sequence for this conversation
     handoff_status = db.Column(db.String(20), default=None)  # None, 'PENDING', 'ACTIVE'
     agent_response_pending = db.Column(db.Boolean, default=False)
-    last_updated = db.Column(db.DateTime, default=datetime.utcnow)
+    last_updated = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    summary = db.Column(db.Text)  # Rolling extractive summary of messages that fell out of the context window
+    summary_upto = db.Column(db.Integer, default=0)  # Messages with sequence below this are covered by summary
+    # System prompt this conversation runs on; NULL for older conversations that store it as their first message
+    prompt_version_id = db.Column(db.Integer, db.ForeignKey('prompt_version.id', name='fk_conversation_prompt_version'))
+    prompt_version = db.relationship('PromptVersion')
+    message_rows = db.relationship('Message',
+                                   backref='conversation',
+                                   lazy='dynamic',
+                                   order_by='[Message.sequence, Message.id]',
+                                   cascade="all, delete-orphan")
+    
+    __table_args__ = (
+        db.Index('ix_conversation_config_updated', 'config_id', 'last_updated'),
+    )
+    
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._reset_message_cache()
+    
+    @orm.reconstructor
+    def _reset_message_cache(self):
+        """
+        Per-object message cache, valid for the lifetime of the session (one request).
+        Appends are buffered in _pending_messages and written as Message rows in one
+        batch by the before_flush hook below.
+        """
+        self._message_cache = None    # Full history as dicts, once loaded
+        self._last_message = None     # Newest message, once known
+        self._pending_messages = []   # Appended but not yet flushed
+    
+    def _migrate_legacy_history(self):
+        """
+        Move a pre-Message-table JSON history blob into message rows (runs once per conversation).
+        Returns True if rows were created and need committing.
+        """
+        if not self.history:
+            return False
+        legacy_messages = json.loads(self.history)
+        self.history = ''
+        for message in legacy_messages:
+            self._append(message['role'], message['content'])
+        return True
+    
+    def _append(self, role, content):
+        """Buffer one message; it becomes a Message row at the next flush."""
+        message = {"role": role, "content": content}
+        self._pending_messages.append(message)
+        if self._message_cache is not None:
+            self._message_cache.append(message)
+        self._last_message = message
+        self.last_updated = datetime.utcnow()
+        db.session.add(self)
+        db.session.info.setdefault('conversations_with_pending_messages', set()).add(self)
+    
+    def _flush_pending_messages(self, session):
+        """
+        Turn buffered messages into Message rows with consecutive sequence numbers. A stored
+        conversation reserves its numbers with one UPDATE ... RETURNING on message_count, so a
+        customer turn and an agent reply appending at the same time never share a sequence.
+        """
+        count = len(self._pending_messages)
+        if self.id is None or db.inspect(self).attrs.message_count.history.has_changes():
+            # New conversation, or history just replaced: the count set in memory is the one to write
+            start = self.message_count or 0
+            self.message_count = start + count
+        else:
+            table = Conversation.__table__
+            end = session.execute(
+                table.update().where(table.c.id == self.id)
+                .values(message_count=func.coalesce(table.c.message_count, 0) + count)
+                .returning(table.c.message_count)
+            ).scalar_one()
+            start = end - count
+            orm.attributes.set_committed_value(self, 'message_count', end)
+        for offset, message in enumerate(self._pending_messages):
+            session.add(Message(conversation=self, sequence=start + offset, role=message['role'], content=message['content']))
+        self._pending_messages = []
+    
+    def _recent_rows(self, query, count):
+        """Return the newest `count` rows of query in chronological order."""
+        rows = query.order_by(None).order_by(Message.sequence.desc(), Message.id.desc()).limit(count).all()
+        rows.reverse()
+        return rows
+    
+    def _loaded_messages(self):
+        """Return the cached history, loading it from message rows on first use."""
+        if self._message_cache is None:
+            self._migrate_legacy_history()
+            self._message_cache = [row.to_dict() for row in self.message_rows]
+            self._last_message = self._message_cache[-1] if self._message_cache else None
+        return self._message_cache
+    
+    def _system_message(self):
+        """The referenced prompt version as a system message, or None for conversations without one."""
+        if self.prompt_version_id is None:
+            return None
+        return {"role": "system", "content": prompt_version_content(self.prompt_version_id)}
     
     @property
     def messages(self):
         """Get the conversation history as a list of message objects"""
-        if self.history:
-            return json.loads(self.history)
-        return []
+        system = self._system_message()
+        return ([system] if system else []) + self._loaded_messages()
     
     @messages.setter
     def messages(self, message_list):
-        """Save the conversation history as a JSON string"""
-        self.history = json.dumps(message_list)
+        """Replace the conversation history"""
+        self.history = ''
+        self._reset_message_cache()
+        if self.id is not None:
+            Message.query.filter_by(conversation_id=self.id).delete(synchronize_session='fetch')
+        self.message_count = 0
+        self.summary = None
+        self.summary_upto = 0
+        self._message_cache = []
+        for message in message_list:
+            self._append(message['role'], message['content'])
         self.last_updated = datetime.utcnow()
     
+    def last_message(self):
+        """Newest message (stored or buffered), or None."""
+        if self._last_message is None and self.id is not None:
+            last_rows = self._recent_rows(self.message_rows, 1)
+            self._last_message = last_rows[0].to_dict() if last_rows else None
+        return self._last_message
+    
     def add_message(self, role, content, deduplicate=False):
         """Add a message to the conversation history. If deduplicate is True, skip if identical to last message."""
-        messages = self.messages
-        if deduplicate and messages and messages[-1]['role'] == role and messages[-1]['content'] == content:
-            print(f"DEBUG: Skipping duplicate {role} message: {content[:20]}...")
-            return False
+        self._migrate_legacy_history()
+        if deduplicate:
+            last = self.last_message()
+            if last and last['role'] == role and last['content'] == content:
+                print(f"DEBUG: Skipping duplicate {role} message: {content[:20]}...")
+                return False
             
-        messages.append({"role": role, "content": content})
-        self.messages = messages
+        self._append(role, content)
         return True
         
     def get_last_messages(self, count=10, include_system=True):
         """Get the last N messages, optionally including the system prompt"""
-        messages = self.messages
-        if include_system and messages and messages[0]["role"] == "system":
-            system_message = messages[0]
-            other_messages = messages[1:][-count:]
-            return [system_message] + other_messages
+        system = self._system_message()
+        if system is not None:
+            tail = self._stored_last_messages(count, include_system=False)
+            return [system] + tail if include_system else tail
+        return self._stored_last_messages(count, include_system)
+    
+    def _stored_last_messages(self, count, include_system):
+        """Last N stored (and buffered) messages, keeping a stored system message at the head if asked."""
+        if self._message_cache is not None:
+            messages = self._message_cache
+            if include_system and messages and messages[0]["role"] == "system":
+                return [messages[0]] + messages[1:][-count:]
+            return messages[-count:]
+        
+        # Not cached: read only the system row and the tail, merging buffered messages in memory
+        # so the read does not force an early flush
+        self._migrate_legacy_history()
+        stored_count = self.message_count or 0
+        with db.session.no_autoflush:
+            rows = self.message_rows.filter(or_(
+                Message.sequence == 0,
+                Message.sequence >= stored_count - count
+            )).all() if self.id is not None else []
+        messages = [row.to_dict() for row in rows] + self._pending_messages
+        starts_at_head = (rows[0].sequence == 0) if rows else stored_count == 0
+        if include_system and messages and starts_at_head and messages[0]["role"] == "system":
+            return [messages[0]] + messages[1:][-count:]
         return messages[-count:]
 
+    def get_context_messages(self, token_budget):
+        """
+        System prompt, rolling summary and as many of the newest messages as fit in token_budget
+        (estimated locally). Messages that stop fitting are folded into the stored summary, so
+        later turns never read them again.
+        """
+        self._migrate_legacy_history()
+        summary_upto = self.summary_upto or 0
+        with db.session.no_autoflush:
+            rows = self.message_rows.filter(or_(
+                Message.sequence == 0,
+                Message.sequence >= summary_upto
+            )).all() if self.id is not None else []
+        system = self._system_message()
+        if rows and rows[0].sequence == 0 and (rows[0].role == "system" or summary_upto > 0):
+            head = rows.pop(0)
+            if system is None and head.role == "system":
+                system = head.to_dict()
+        # (sequence, message); buffered messages get the sequences the next flush will assign
+        next_sequence = self.message_count or 0
+        history = [(row.sequence, row.to_dict()) for row in rows]
+        history += [(next_sequence + i, message) for i, message in enumerate(self._pending_messages)]
+        
+        available = token_budget - (estimate_message_tokens(system) if system else 0)
+        kept = _newest_that_fit(history, available)
+        if len(kept) < len(history) or self.summary:
+            # Leave room for the summary and fit again
+            kept = _newest_that_fit(history, available - CONTEXT_SUMMARY_TOKENS)
+            dropped = history[:len(history) - len(kept)]
+            if dropped:
+                self.summary = fold_into_summary(self.summary, [message for _, message in dropped])
+                self.summary_upto = dropped[-1][0] + 1
+        
+        context = [system] if system else []
+        if self.summary:
+            context.append({"role": "system", "content": f"Summary of earlier messages in this conversation:\n{self.summary}"})
+        return context + [message for _, message in kept]
+
+    def last_message_id(self):
+        """Id of the newest stored message (the /chat/history cursor), or 0."""
+        return db.session.query(func.max(Message.id)).filter_by(conversation_id=self.id).scalar() or 0
+
+class Message(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    conversation_id = db.Column(db.Integer, db.ForeignKey('conversation.id', ondelete='CASCADE'), nullable=False)
+    sequence = db.Column(db.Integer, nullable=False)  # Position within the conversation
+    role = db.Column(db.String(20), nullable=False)  # system, user, assistant
+    content = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.UniqueConstraint('conversation_id', 'sequence', name='uq_message_conversation_sequence'),
+    )
+    
+    def to_dict(self):
+        return {"role": self.role, "content": self.content}
+
+class PromptVersion(db.Model):
+    """A rendered system prompt, stored once per distinct content and shared by conversations."""
+    id = db.Column(db.Integer, primary_key=True)
+    config_id = db.Column(db.String(50), nullable=False)
+    content_hash = db.Column(db.String(64), nullable=False)  # sha256 of content
+    content = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.UniqueConstraint('config_id', 'content_hash', name='uq_prompt_version_config_hash'),
+    )
+
 class BusinessConfig(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     config_id = db.Column(db.String(50), unique=True, nullable=False)
@@ -347,6 +639,8 @@ class BusinessConfig(db.Model):
     availability = db.Column(db.Text)
     booking_process = db.Column(db.Text)
     system_prompt = db.Column(db.Text)
+    prompt_version_id = db.Column(db.Integer)  # PromptVersion of system_prompt that new conversations reference
+    knowledge_hash = db.Column(db.String(64))  # sha256 over the prompt, FAQs and long fields; keys per-process search indexes
     telegram_bot_token = db.Column(db.String(200))
     telegram_chat_id = db.Column(db.String(100))
     appointment_enabled = db.Column(db.Boolean, default=False)
@@ -359,6 +653,8 @@ class BusinessConfig(db.Model):
     email_config = db.Column(db.Text, default='{}')       # Stores email settings
     active_handoff_session = db.Column(db.String(200))    # Tracks the current session being tubneled
     telegram_offset = db.Column(db.Integer, default=0)    # Track Telegram polling offset per bot
+    ai_suggestions = db.Column(db.Text)                   # JSON list of generated starter questions
+    ai_suggestions_updated_at = db.Column(db.DateTime)    # When ai_suggestions was generated
     
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -378,6 +674,10 @@ class BusinessConfig(db.Model):
                                         cascade="all, delete-orphan",
                                         backref='business_config',
                                         lazy=True)
+    prompt_versions = db.relationship('PromptVersion',
+                                       primaryjoin="BusinessConfig.config_id==foreign(PromptVersion.config_id)",
+                                       cascade="all, delete-orphan",
+                                       lazy=True)
 
 class HandoffRequest(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -395,11 +695,279 @@ class Appointment(db.Model):
     customer_email = db.Column(db.String(200), nullable=False)
     customer_mobile = db.Column(db.String(50), nullable=False)
     preferred_time = db.Column(db.String(200), nullable=False)
+    slot_start = db.Column(db.DateTime)  # preferred_time parsed by validate_strict_date; NULL for legacy free-text times
     message = db.Column(db.Text, default='')
     status = db.Column(db.String(20), default='pending')  # pending, approved, declined
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     telegram_message_id = db.Column(db.Integer)  # To update the Telegram message after action
+    
+    __table_args__ = (
+        # Keyset pagination of lead listings, with and without a status filter
+        db.Index('ix_appointment_config_status_created', 'config_id', 'status', 'created_at'),
+        db.Index('ix_appointment_config_created', 'config_id', 'created_at'),
+        # One active (pending/approved) booking per slot; this is the conflict check
+        db.Index('uq_appointment_active_slot', 'config_id', 'slot_start', unique=True,
+                 sqlite_where=db.text("status IN ('pending', 'approved')"),
+                 postgresql_where=db.text("status IN ('pending', 'approved')")),
+    )
+
+class TelegramOutbox(db.Model):
+    """Telegram message waiting for (or done with) background delivery."""
+    id = db.Column(db.Integer, primary_key=True)
+    bot_token = db.Column(db.String(200), nullable=False)
+    chat_id = db.Column(db.String(100), nullable=False)
+    text = db.Column(db.Text, nullable=False)
+    reply_markup = db.Column(db.Text)                  # JSON inline keyboard, if any
+    target_type = db.Column(db.String(30))             # 'appointment' / 'handoff_request' to receive telegram_message_id
+    target_id = db.Column(db.Integer)
+    status = db.Column(db.String(20), default='pending')  # pending, sending, sent, failed
+    attempts = db.Column(db.Integer, default=0)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow)
+    claimed_at = db.Column(db.DateTime)                # When a worker took the row (status 'sending')
+    last_error = db.Column(db.Text)
+    telegram_message_id = db.Column(db.Integer)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime)
+    
+    __table_args__ = (db.Index('ix_telegram_outbox_status_next_attempt', 'status', 'next_attempt_at'),)
+
+# ---- BusinessConfig Snapshot Cache ----
+# The public chat and Telegram paths only read a handful of BusinessConfig fields that change
+# when the owner edits the bot, so they use immutable snapshots cached per config_id instead of
+# querying on every request. Editing routes invalidate explicitly; the TTL bounds staleness in
+# other Gunicorn workers. Mutable state (active_handoff_session, telegram_offset) is not cached.
+CONFIG_CACHE_TTL = float(os.getenv("CONFIG_CACHE_TTL", "60"))  # seconds
+CONFIG_CACHE_SIZE = int(os.getenv("CONFIG_CACHE_SIZE", "512"))
+
+@dataclass(frozen=True)
+class BusinessConfigSnapshot:
+    id: int
+    config_id: str
+    user_id: int
+    business_name: str
+    business_type: str
+    services: str
+    system_prompt: str
+    prompt_version_id: int
+    knowledge_hash: str
+    telegram_bot_token: str
+    telegram_chat_id: str
+    appointment_enabled: bool
+    appointment_hours: str
+    appointment_config: str
+    styling_config: str
+    ai_suggestions: str
+    ai_suggestions_updated_at: datetime
+    
+    @classmethod
+    def from_model(cls, chatbot):
+        return cls(**{f.name: getattr(chatbot, f.name) for f in fields(cls)})
+
+class ConfigCache:
+    """Thread-safe LRU of BusinessConfigSnapshot keyed by config_id, with a TTL per entry."""
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # config_id -> (loaded_at, snapshot)
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, config_id):
+        """Return the snapshot for config_id, loading it from the database on a miss. None if not found."""
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(config_id)
+            if entry and now - entry[0] < self.ttl:
+                self.entries.move_to_end(config_id)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        
+        chatbot = BusinessConfig.query.filter_by(config_id=config_id).first()
+        if not chatbot:
+            return None
+        snapshot = BusinessConfigSnapshot.from_model(chatbot)
+        with self.lock:
+            self.entries[config_id] = (now, snapshot)
+            self.entries.move_to_end(config_id)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return snapshot
+    
+    def invalidate(self, config_id):
+        with self.lock:
+            self.entries.pop(config_id, None)
+    
+    def stats(self):
+        with self.lock:
+            return {"size": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+config_cache = ConfigCache(CONFIG_CACHE_SIZE, CONFIG_CACHE_TTL)
+
+def get_config_snapshot(config_id):
+    """Read-through cached, read-only view of a BusinessConfig. None if it does not exist."""
+    return config_cache.get(config_id)
+
+def invalidate_config_snapshot(config_id):
+    """Drop the cached snapshot after a BusinessConfig change has been committed."""
+    config_cache.invalidate(config_id)
+
+def get_active_handoff_session(config_id):
+    return db.session.query(BusinessConfig.active_handoff_session).filter_by(config_id=config_id).scalar()
+
+def set_active_handoff_session(config_id, session_id, only_if=None):
+    """Set (or clear) the bot's tunneled session. With only_if, change it only while it equals that session."""
+    query = BusinessConfig.query.filter_by(config_id=config_id)
+    if only_if is not None:
+        query = query.filter(BusinessConfig.active_handoff_session == only_if)
+    query.update({BusinessConfig.active_handoff_session: session_id})
+
+# ---- Conversation Event Bus ----
+# Committed changes to a conversation (new messages, handoff state) are published on a
+# channel keyed by session_id so open chat widgets are pushed updates instead of polling.
+# The in-process backend only reaches subscribers in the same Gunicorn worker; set
+# PUBSUB_REDIS_URL to fan out across workers. Subscribers also re-check the database
+# periodically, so a missed event only delays delivery.
+class PubSubBackend(ABC):
+    """Interface for conversation event fan-out. Implementations must be thread-safe."""
+    @abstractmethod
+    def publish(self, channel, event):
+        """Deliver event (a JSON-serializable dict) to the channel's current subscribers."""
+    
+    @abstractmethod
+    def subscribe(self, channel):
+        """Return a Subscription to the channel."""
+
+class Subscription(ABC):
+    """One subscriber's view of a channel, used by a single request thread."""
+    @abstractmethod
+    def get(self, timeout):
+        """Next event, or None after timeout seconds without one."""
+    
+    @abstractmethod
+    def close(self):
+        """Stop receiving events."""
+
+class InProcessSubscription(Subscription):
+    def __init__(self, backend, channel):
+        self.backend = backend
+        self.channel = channel
+        self.queue = queue.Queue(maxsize=100)
+    
+    def get(self, timeout):
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+    
+    def close(self):
+        self.backend._unsubscribe(self)
+
+class InProcessPubSub(PubSubBackend):
+    """Delivers events to subscribers in this process."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.channels = {}  # channel -> set of InProcessSubscription
+    
+    def publish(self, channel, event):
+        with self.lock:
+            subscribers = list(self.channels.get(channel, ()))
+        for subscription in subscribers:
+            try:
+                subscription.queue.put_nowait(event)
+            except queue.Full:
+                pass  # Slow subscriber; it will catch up from the database
+    
+    def subscribe(self, channel):
+        subscription = InProcessSubscription(self, channel)
+        with self.lock:
+            self.channels.setdefault(channel, set()).add(subscription)
+        return subscription
+    
+    def _unsubscribe(self, subscription):
+        with self.lock:
+            subscribers = self.channels.get(subscription.channel)
+            if subscribers:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self.channels[subscription.channel]
+
+class RedisSubscription(Subscription):
+    def __init__(self, pubsub):
+        self.pubsub = pubsub
+    
+    def get(self, timeout):
+        message = self.pubsub.get_message(ignore_subscribe_messages=True, timeout=timeout)
+        return json.loads(message['data']) if message else None
+    
+    def close(self):
+        self.pubsub.close()
+
+class RedisPubSub(PubSubBackend):
+    """Delivers events to subscribers in every worker through Redis pub/sub."""
+    def __init__(self, url):
+        import redis  # Optional dependency, only needed when PUBSUB_REDIS_URL is set
+        self.client = redis.Redis.from_url(url)
+    
+    def publish(self, channel, event):
+        self.client.publish(f"chat:{channel}", json.dumps(event))
+    
+    def subscribe(self, channel):
+        pubsub = self.client.pubsub()
+        pubsub.subscribe(f"chat:{channel}")
+        return RedisSubscription(pubsub)
+
+def _create_pubsub_backend():
+    redis_url = os.getenv("PUBSUB_REDIS_URL")
+    if redis_url:
+        try:
+            return RedisPubSub(redis_url)
+        except ImportError:
+            print("WARNING: PUBSUB_REDIS_URL is set but the redis package is not installed. Using in-process pub/sub.")
+    return InProcessPubSub()
+
+conversation_events = _create_pubsub_backend()
+
+def _mark_conversation_changed(session, conversation):
+    session.info.setdefault('changed_conversations', set()).add(conversation.session_id)
+
+@event.listens_for(db.session, 'before_flush')
+def _collect_conversation_changes(session, flush_context, instances):
+    """Remember conversations whose handoff state changed in this transaction."""
+    for obj in session.dirty:
+        if isinstance(obj, Conversation):
+            state = db.inspect(obj)
+            if (state.attrs.handoff_status.history.has_changes()
+                    or state.attrs.agent_response_pending.history.has_changes()):
+                _mark_conversation_changed(session, obj)
+
+@event.listens_for(db.session, 'after_commit')
+def _publish_conversation_changes(session):
+    """Publish one event per changed conversation once its changes are committed."""
+    for session_id in session.info.pop('changed_conversations', None) or ():
+        try:
+            conversation_events.publish(session_id, {"type": "changed", "session_id": session_id})
+        except Exception as e:
+            print(f"PUBSUB ERROR: {e}")
+
+@event.listens_for(db.session, 'before_flush')
+def _write_pending_messages(session, flush_context, instances):
+    """Write every conversation's buffered messages as Message rows in one pass."""
+    pending = session.info.pop('conversations_with_pending_messages', None)
+    for conversation in pending or ():
+        if conversation._pending_messages:
+            conversation._flush_pending_messages(session)
+            _mark_conversation_changed(session, conversation)
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def _discard_pending_messages(session, previous_transaction):
+    """Drop message caches that may no longer match the database."""
+    for conversation in session.info.pop('conversations_with_pending_messages', None) or ():
+        conversation._reset_message_cache()
+    session.info.pop('changed_conversations', None)
+    session.info.pop('telegram_outbox_enqueued', None)
 
 @login_manager.user_loader
 def load_user(user_id):
@@ -417,7 +985,7 @@ def send_telegram_notification(bot_token, chat_id, message, reply_markup=None):
         }
         if reply_markup:
             payload["reply_markup"] = json.dumps(reply_markup)
-        response = requests.post(url, json=payload, timeout=10)
+        response = telegram_http.post(url, json=payload, timeout=TELEGRAM_TIMEOUT)
         print(f"DEBUG TELEGRAM: Status={response.status_code}, Body={response.text[:200]}")
         if response.status_code == 200:
             return response.json()
@@ -427,7 +995,7 @@ def send_telegram_notification(bot_token, chat_id, message, reply_markup=None):
         return None
 
 def send_appointment_to_telegram(chatbot, appointment):
-    """Send appointment details to Telegram with inline Approve/Decline buttons."""
+    """Queue appointment details for Telegram with inline Approve/Decline buttons. The caller commits."""
     if not chatbot.telegram_bot_token or not chatbot.telegram_chat_id:
         return None
     
@@ -450,22 +1018,17 @@ def send_appointment_to_telegram(chatbot, appointment):
         ]]
     }
     
-    result = send_telegram_notification(
+    # telegram_message_id is written back once delivered, so the message can be edited later
+    return enqueue_telegram_message(
         chatbot.telegram_bot_token,
         chatbot.telegram_chat_id,
         msg,
-        reply_markup=reply_markup
+        reply_markup=reply_markup,
+        target=('appointment', appointment.id)
     )
-    
-    # Store the Telegram message ID so we can update it later
-    if result and 'result' in result:
-        appointment.telegram_message_id = result['result'].get('message_id')
-        db.session.commit()
-    
-    return result
 
 def send_handoff_request_to_telegram(chatbot, session_id):
-    """Send a human handoff request to Telegram using a stable request ID."""
+    """Queue a human handoff request for Telegram using a stable request ID. The caller commits."""
     if not chatbot.telegram_bot_token or not chatbot.telegram_chat_id:
         return None
     
@@ -476,9 +1039,9 @@ def send_handoff_request_to_telegram(chatbot, session_id):
         status='pending'
     )
     db.session.add(new_req)
-    db.session.commit()
+    db.session.flush()
     
-    msg = (f"\u2753 <b>Human Handoff Requested!</b>\n"
+    msg = (f"❓ <b>Human Handoff Requested!</b>\n"
            f"Business: {chatbot.business_name}\n"
            f"Session: <code>{session_id.split('_')[-1]}</code>\n\n"
            f"Accept to start tunneling chat or decline to let AI continue.")
@@ -490,20 +1053,214 @@ def send_handoff_request_to_telegram(chatbot, session_id):
         ]]
     }
     
-    result = send_telegram_notification(
+    return enqueue_telegram_message(
         chatbot.telegram_bot_token,
         chatbot.telegram_chat_id,
         msg,
-        reply_markup=reply_markup
+        reply_markup=reply_markup,
+        target=('handoff_request', new_req.id)
     )
+
+# ---- Telegram Outbox ----
+# Notifications raised on the customer's request path are written to the telegram_outbox table
+# in the same transaction and delivered by background workers, so chat latency never includes a
+# Telegram round-trip. Rows are claimed with an optimistic status update, delivered in order per
+# bot, retried with exponential backoff (honouring Telegram's retry_after) and rate limited per
+# bot token.
+TELEGRAM_OUTBOX_WORKERS = int(os.getenv("TELEGRAM_OUTBOX_WORKERS", "2"))
+TELEGRAM_OUTBOX_MAX_ATTEMPTS = int(os.getenv("TELEGRAM_OUTBOX_MAX_ATTEMPTS", "8"))
+TELEGRAM_OUTBOX_BACKOFF = 2.0          # seconds before the first retry, doubled per attempt
+TELEGRAM_OUTBOX_MAX_BACKOFF = 300.0    # seconds
+TELEGRAM_OUTBOX_POLL_INTERVAL = 2.0    # seconds between checks when nothing is due
+TELEGRAM_OUTBOX_CLAIM_TIMEOUT = 120    # seconds before a row claimed by a dead worker is retried
+TELEGRAM_OUTBOX_BATCH = 20             # due rows considered per claim
+TELEGRAM_RATE_PER_SECOND = float(os.getenv("TELEGRAM_RATE_PER_SECOND", "1"))  # per bot token
+TELEGRAM_RATE_BURST = 5
+
+class TokenBucket:
+    """Classic token bucket; not thread-safe on its own (guarded by TelegramOutboxState.lock)."""
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
     
-    if result and 'result' in result:
-        new_req.telegram_message_id = result['result'].get('message_id')
-        db.session.commit()
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def wait_time(self):
+        """Seconds until a token is available (0 if one is), without taking it."""
+        self._refill()
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+    
+    def reserve(self):
+        """Take one token, going into debt if needed. Returns the seconds to wait before using it."""
+        self._refill()
+        self.tokens -= 1
+        return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+class TelegramOutboxState:
+    started = False
+    lock = threading.Lock()
+    wakeup = threading.Event()
+    buckets = {}         # bot_token -> TokenBucket
+
+telegram_outbox = TelegramOutboxState()
+
+def enqueue_telegram_message(bot_token, chat_id, text, reply_markup=None, target=None):
+    """
+    Add a Telegram message to the outbox in the current transaction; it is sent after commit.
+    `target` is an optional (target_type, id) whose telegram_message_id is set once delivered.
+    """
+    if not bot_token or not chat_id:
+        return None
+    target_type, target_id = target or (None, None)
+    row = TelegramOutbox(
+        bot_token=bot_token,
+        chat_id=str(chat_id),
+        text=text,
+        reply_markup=json.dumps(reply_markup) if reply_markup else None,
+        target_type=target_type,
+        target_id=target_id,
+        status='pending',
+        attempts=0,
+        next_attempt_at=datetime.utcnow()
+    )
+    db.session.add(row)
+    db.session.info['telegram_outbox_enqueued'] = True
+    return row
+
+def start_telegram_outbox():
+    """Start this process's outbox delivery workers once."""
+    with telegram_outbox.lock:
+        if telegram_outbox.started:
+            return
+        telegram_outbox.started = True
+    print(f"TELEGRAM OUTBOX: Starting {TELEGRAM_OUTBOX_WORKERS} delivery worker(s)")
+    for _ in range(TELEGRAM_OUTBOX_WORKERS):
+        threading.Thread(target=_telegram_outbox_worker, daemon=True).start()
+
+@event.listens_for(db.session, 'after_commit')
+def _wake_telegram_outbox(session):
+    """Wake the delivery workers once messages queued in this transaction are committed."""
+    if session.info.pop('telegram_outbox_enqueued', False):
+        start_telegram_outbox()
+        telegram_outbox.wakeup.set()
+
+@app.before_request
+def _start_telegram_outbox_once():
+    """Start delivery workers on the first request so rows left over from a restart are sent."""
+    if not telegram_outbox.started:
+        start_telegram_outbox()
+
+def _claim_outbox_row():
+    """
+    Claim a due row that heads its bot's queue and is within the rate limit.
+    Returns (row, None) or (None, seconds until a rate-limited bot may send again, if any).
+    """
+    now = datetime.utcnow()
+    stale_before = now - timedelta(seconds=TELEGRAM_OUTBOX_CLAIM_TIMEOUT)
+    # Only the oldest unsent row per bot may be sent, so each bot's messages arrive in order
+    queue_heads = db.session.query(func.min(TelegramOutbox.id)).filter(
+        TelegramOutbox.status.in_(('pending', 'sending'))
+    ).group_by(TelegramOutbox.bot_token)
+    candidates = db.session.query(
+        TelegramOutbox.id, TelegramOutbox.bot_token, TelegramOutbox.status, TelegramOutbox.claimed_at
+    ).filter(TelegramOutbox.id.in_(queue_heads)).filter(or_(
+        (TelegramOutbox.status == 'pending') & (TelegramOutbox.next_attempt_at <= now),
+        (TelegramOutbox.status == 'sending') & (TelegramOutbox.claimed_at < stale_before)
+    )).order_by(TelegramOutbox.id).limit(TELEGRAM_OUTBOX_BATCH).all()
+    db.session.rollback()  # End the read transaction before claiming
     
-    return result
+    retry_in = None
+    for row in candidates:
+        with telegram_outbox.lock:
+            bucket = telegram_outbox.buckets.get(row.bot_token)
+            if bucket is None:
+                bucket = telegram_outbox.buckets[row.bot_token] = TokenBucket(TELEGRAM_RATE_PER_SECOND, TELEGRAM_RATE_BURST)
+            wait_for_token = bucket.wait_time()
+        if wait_for_token:
+            retry_in = min(retry_in or wait_for_token, wait_for_token)
+            continue
+        
+        # Optimistic claim: only one worker (in any process) sees rowcount == 1
+        claimed = TelegramOutbox.query.filter(
+            TelegramOutbox.id == row.id,
+            TelegramOutbox.status == row.status,
+            TelegramOutbox.claimed_at == row.claimed_at if row.claimed_at else TelegramOutbox.claimed_at.is_(None)
+        ).update({TelegramOutbox.status: 'sending', TelegramOutbox.claimed_at: now}, synchronize_session=False)
+        db.session.commit()
+        if claimed == 1:
+            # Only the winner of the claim spends rate-limit budget; if another local worker took
+            # the last token since the check above, wait for the next one
+            with telegram_outbox.lock:
+                wait_for_token = bucket.reserve()
+            if wait_for_token:
+                time.sleep(wait_for_token)
+            return db.session.get(TelegramOutbox, row.id), None
+    return None, retry_in
+
+def _deliver_outbox_row(row):
+    """Send one claimed row and record the outcome."""
+    status_code, body, error = None, {}, None
+    try:
+        payload = {"chat_id": row.chat_id, "text": row.text, "parse_mode": "HTML"}
+        if row.reply_markup:
+            payload["reply_markup"] = row.reply_markup
+        response = telegram_http.post(f"https://api.telegram.org/bot{row.bot_token}/sendMessage", json=payload, timeout=TELEGRAM_TIMEOUT)
+        status_code = response.status_code
+        try:
+            body = response.json()
+        except ValueError:
+            body = {}
+        error = body.get('description') or response.text[:200]
+    except Exception as e:
+        error = str(e)
     
-    return result
+    if status_code == 200 and body.get('ok'):
+        row.status = 'sent'
+        row.sent_at = datetime.utcnow()
+        row.last_error = None
+        row.telegram_message_id = (body.get('result') or {}).get('message_id')
+        target_model = {'appointment': Appointment, 'handoff_request': HandoffRequest}.get(row.target_type)
+        if target_model and row.telegram_message_id:
+            target_model.query.filter_by(id=row.target_id).update({target_model.telegram_message_id: row.telegram_message_id})
+        print(f"TELEGRAM OUTBOX: Delivered #{row.id} to chat_id={row.chat_id}")
+    else:
+        row.attempts = (row.attempts or 0) + 1
+        row.last_error = f"{status_code}: {error}" if status_code else error
+        retry_after = (body.get('parameters') or {}).get('retry_after') or 0
+        # Bad request / unauthorized / blocked / unknown chat will not succeed on retry
+        if status_code in (400, 401, 403, 404) or row.attempts >= TELEGRAM_OUTBOX_MAX_ATTEMPTS:
+            row.status = 'failed'
+            print(f"TELEGRAM OUTBOX: Giving up on #{row.id} after {row.attempts} attempt(s): {row.last_error}")
+        else:
+            delay = max(retry_after, min(TELEGRAM_OUTBOX_MAX_BACKOFF, TELEGRAM_OUTBOX_BACKOFF * 2 ** (row.attempts - 1)))
+            row.status = 'pending'
+            row.claimed_at = None
+            row.next_attempt_at = datetime.utcnow() + timedelta(seconds=delay)
+            print(f"TELEGRAM OUTBOX: #{row.id} failed ({row.last_error}), retrying in {delay:.0f}s")
+    db.session.commit()
+
+def _telegram_outbox_worker():
+    while True:
+        retry_in = None
+        try:
+            telegram_outbox.wakeup.clear()
+            with app.app_context():
+                row, retry_in = _claim_outbox_row()
+                if row:
+                    _deliver_outbox_row(row)
+                    continue
+        except Exception as e:
+            print(f"TELEGRAM OUTBOX ERROR: {e}")
+        telegram_outbox.wakeup.wait(min(retry_in or TELEGRAM_OUTBOX_POLL_INTERVAL, TELEGRAM_OUTBOX_POLL_INTERVAL))
+
+def telegram_outbox_stats():
+    """Row counts per outbox status, for /health."""
+    return dict(db.session.query(TelegramOutbox.status, func.count(TelegramOutbox.id)).group_by(TelegramOutbox.status).all())
 
 def validate_strict_date(date_str):
     """
@@ -522,6 +1279,60 @@ def validate_strict_date(date_str):
             continue
     return None
 
+# ---- Appointment Availability ----
+AVAILABILITY_WINDOW_DAYS = int(os.getenv("AVAILABILITY_WINDOW_DAYS", "14"))
+AVAILABILITY_MAX_SLOTS = int(os.getenv("AVAILABILITY_MAX_SLOTS", "40"))
+# Written out literally (not as bound IN parameters) so the planner can match it to the
+# partial uq_appointment_active_slot index
+ACTIVE_SLOT_CLAUSE = db.text("status IN ('pending', 'approved')")
+
+def upcoming_booked_slots(config_id, now=None):
+    """Start times of active bookings from today through AVAILABILITY_WINDOW_DAYS ahead, earliest first and capped."""
+    # Slots are naive business-local times, so the window starts at midnight rather than at an exact instant
+    today = (now or datetime.now()).replace(hour=0, minute=0, second=0, microsecond=0)
+    rows = db.session.query(Appointment.slot_start).filter(
+        Appointment.config_id == config_id,
+        ACTIVE_SLOT_CLAUSE,
+        Appointment.slot_start >= today,
+        Appointment.slot_start < today + timedelta(days=AVAILABILITY_WINDOW_DAYS + 1)
+    ).order_by(Appointment.slot_start).limit(AVAILABILITY_MAX_SLOTS + 1).all()
+    return [row.slot_start for row in rows]
+
+def availability_prompt(config_id, now=None):
+    """System note listing upcoming booked slots, sized by the window and slot cap rather than by booking history."""
+    slots = upcoming_booked_slots(config_id, now)
+    truncated = len(slots) > AVAILABILITY_MAX_SLOTS
+    lines = [f"- {slot.strftime('%d %b %Y, %I:%M %p')}" for slot in slots[:AVAILABILITY_MAX_SLOTS]]
+    note = f"BOOKED SLOTS (next {AVAILABILITY_WINDOW_DAYS} days):\n" + ("\n".join(lines) or "No slots booked yet.")
+    if truncated:
+        note += f"\n(Only the earliest {AVAILABILITY_MAX_SLOTS} are listed; the booking system rejects any other taken slot.)"
+    return note
+
+def book_appointment_slot(appointment):
+    """
+    Insert a new appointment inside a savepoint. Returns False if another active booking
+    already holds its slot; the unique slot index makes this safe under concurrent bookings.
+    """
+    try:
+        with db.session.begin_nested():
+            db.session.add(appointment)
+        return True
+    except IntegrityError:
+        return False
+
+def approve_appointment_slot(appointment):
+    """
+    Mark an appointment approved inside a savepoint. Returns False, leaving its status
+    unchanged, if it was declined and its slot has since been booked by someone else.
+    """
+    try:
+        with db.session.begin_nested():
+            appointment.status = 'approved'
+            appointment.updated_at = datetime.utcnow()
+        return True
+    except IntegrityError:
+        return False
+
 def check_business_hours(requested_dt, hours_str):
     """
     Check if the requested datetime falls within business hours.
@@ -583,90 +1394,543 @@ def check_business_hours(requested_dt, hours_str):
         return True, "" # Fail open but log it
 
 def generate_system_prompt(config):
-    """Generate a system prompt based on the business configuration."""
-    # Format FAQs
-    formatted_faqs = ""
-    if isinstance(config, BusinessConfig):
-        for faq in config.faqs:
-            formatted_faqs += f"Q: {faq.question}\nA: {faq.answer}\n\n"
+    """Generate a system prompt from a BusinessConfig or an equivalent plain dict."""
+    if isinstance(config, dict):
+        get = config.get
     else:
-        for qa in config.get('faqs', []):
-            formatted_faqs += f"Q: {qa['question']}\nA: {qa['answer']}\n\n"
-    
-    # Check if appointments are enabled
-    apt_enabled = False
-    apt_hours = ""
-    apt_notes = ""
-    
-    if isinstance(config, BusinessConfig):
-        apt_enabled = config.appointment_enabled
-        apt_hours = config.appointment_hours or "Not specified (assume standard business hours)"
-        apt_notes = config.appointment_notes or "None"
-    else:
-        apt_enabled = config.get('appointment_enabled', False)
-        apt_hours = config.get('appointment_hours', '')
-        apt_notes = config.get('appointment_notes', '')
-        
-    appointment_menu_item = ""
-    appointment_addon = ""
+        get = lambda name, default=None: getattr(config, name)  # model columns render as stored
+    
+    apt_enabled = get('appointment_enabled', False)
+    prompt = BASE_PROMPT_TEMPLATE.format(
+        business_name=get('business_name', 'Our Business'),
+        business_type=get('business_type', 'Service Provider'),
+        business_description=_inline_field(get('business_description', '')),
+        business_hours=get('business_hours', ''),
+        services=_inline_field(get('services', '')),
+        location=get('location', ''),
+        contact_info=get('contact_info', ''),
+        availability=get('availability', ''),
+        booking_process=get('booking_process', ''),
+        appointment_menu_item="📅 **Book Appointment** — Schedule a visit\\n" if apt_enabled else ""
+    )
     
     if apt_enabled:
-        # Fetch unavailable slots (pending or approved)
-        unavailable_slots_list = []
-        if isinstance(config, BusinessConfig):
-            apts = Appointment.query.filter_by(config_id=config.config_id).filter(
-                Appointment.status.in_(['pending', 'approved'])
-            ).all()
-            unavailable_slots_list = [a.preferred_time for a in apts]
-        
-        unavailable_slots_str = "\\n".join([f"- {s}" for s in unavailable_slots_list]) or "No slots booked yet."
-        
-        appointment_menu_item = "📅 **Book Appointment** — Schedule a visit\\n"
-        appointment_addon = APPOINTMENT_PROMPT_ADDON.format(
-            appointment_hours=apt_hours,
-            appointment_notes=apt_notes,
-            unavailable_slots=unavailable_slots_str
+        # Booked slots are not frozen into the prompt; availability_prompt() adds them per request
+        prompt += APPOINTMENT_PROMPT_ADDON.format(
+            appointment_hours=get('appointment_hours') or "Not specified (assume standard business hours)",
+            appointment_notes=get('appointment_notes') or "None"
         )
     
-    # Generate the prompt using the template
-    if isinstance(config, BusinessConfig):
-        prompt = BASE_PROMPT_TEMPLATE.format(
-            business_name=config.business_name,
-            business_type=config.business_type,
-            business_description=config.business_description,
-            business_hours=config.business_hours,
-            services=config.services,
-            location=config.location,
-            contact_info=config.contact_info,
-            availability=config.availability,
-            booking_process=config.booking_process,
-            faqs=formatted_faqs,
-            appointment_menu_item=appointment_menu_item
-        )
+    return prompt
+
+# ---- Prompt Versions ----
+# A config's rendered prompt is stored once per distinct content as a PromptVersion and
+# conversations reference it instead of copying it into a system message. The config
+# snapshot cache carries the current version id (invalidated on every edit); version
+# content never changes, so it is cached by id without invalidation.
+DEFAULT_SYSTEM_PROMPT = "You are a helpful business assistant."
+PROMPT_CACHE_SIZE = int(os.getenv("PROMPT_CACHE_SIZE", "256"))
+
+def store_prompt_version(config_id, content):
+    """Return the PromptVersion for this config and content, creating it if it is new."""
+    content_hash = hashlib.sha256(content.encode('utf-8')).hexdigest()
+    version = PromptVersion.query.filter_by(config_id=config_id, content_hash=content_hash).first()
+    if version:
+        return version
+    version = PromptVersion(config_id=config_id, content_hash=content_hash, content=content)
+    try:
+        with db.session.begin_nested():
+            db.session.add(version)
+        return version
+    except IntegrityError:
+        # Another worker stored the same prompt first
+        return PromptVersion.query.filter_by(config_id=config_id, content_hash=content_hash).first()
+
+def update_system_prompt(chatbot):
+    """
+    Re-render a BusinessConfig's prompt, point it at the matching version and refresh its
+    knowledge_hash (flushes; caller commits).
+    """
+    chatbot.system_prompt = generate_system_prompt(chatbot)
+    chatbot.prompt_version_id = store_prompt_version(chatbot.config_id, chatbot.system_prompt).id
+    digest = hashlib.sha256(chatbot.system_prompt.encode('utf-8'))
+    for question, answer in _config_faqs(chatbot):
+        digest.update(f"\0{question}\0{answer}".encode('utf-8'))
+    for name, _ in KNOWLEDGE_FIELDS:
+        digest.update(f"\0{getattr(chatbot, name) or ''}".encode('utf-8'))
+    chatbot.knowledge_hash = digest.hexdigest()
+
+def current_prompt_version_id(chatbot):
+    """Prompt version id for new conversations of this config snapshot, recording one for configs saved before versions existed."""
+    if chatbot.prompt_version_id:
+        return chatbot.prompt_version_id
+    version = store_prompt_version(chatbot.config_id, chatbot.system_prompt or DEFAULT_SYSTEM_PROMPT)
+    BusinessConfig.query.filter_by(config_id=chatbot.config_id).update({BusinessConfig.prompt_version_id: version.id})
+    invalidate_config_snapshot(chatbot.config_id)
+    return version.id
+
+@lru_cache(maxsize=PROMPT_CACHE_SIZE)
+def _cached_prompt_version_content(version_id):
+    """Text of a prompt version. Raises LookupError on a miss, which lru_cache does not cache."""
+    content = db.session.query(PromptVersion.content).filter_by(id=version_id).scalar()
+    if content is None:
+        raise LookupError(version_id)
+    return content
+
+def prompt_version_content(version_id):
+    """Text of a prompt version, cached per process; None for an unknown id (not cached, so a retry can find it)."""
+    try:
+        return _cached_prompt_version_content(version_id)
+    except LookupError:
+        return None
+
+# ---- FAQ Sync ----
+# FAQ lists are applied as a diff against the stored rows: rows are matched by question
+# (case and whitespace insensitive), rows whose question and answer are unchanged are left
+# alone, and the rest go out as batched inserts, updates and deletes in the caller's
+# transaction. Callers re-render the prompt once afterwards.
+FAQ_IMPORT_MAX_ROWS = int(os.getenv("FAQ_IMPORT_MAX_ROWS", "10000"))
+FAQ_DELETE_BATCH_SIZE = 500  # ids per DELETE ... IN (...) statement
+FAQ_QUESTION_MAX_CHARS = 500
+
+def _faq_key(question):
+    return " ".join(question.split()).casefold()
+
+def sync_faqs(chatbot, pairs, replace=True):
+    """
+    Apply (question, answer) pairs to a BusinessConfig's FAQs (flushes; caller commits).
+    With replace, stored FAQs missing from pairs are deleted. Returns counts per change.
+    """
+    wanted = OrderedDict()  # later duplicates of a question win
+    for question, answer in pairs:
+        question = (question or '').strip()[:FAQ_QUESTION_MAX_CHARS]
+        if question:
+            wanted[_faq_key(question)] = (question, (answer or '').strip())
+    
+    seen, updates, deletes = set(), [], []
+    stored = db.session.query(FAQ.id, FAQ.question, FAQ.answer).filter_by(config_id=chatbot.id).order_by(FAQ.id)
+    for faq_id, question, answer in stored:
+        key = _faq_key(question)
+        if key in seen or (key not in wanted and replace):
+            deletes.append(faq_id)
+        elif key in wanted:
+            seen.add(key)
+            if wanted[key] != (question, answer):
+                updates.append({'id': faq_id, 'question': wanted[key][0], 'answer': wanted[key][1]})
+    inserts = [{'config_id': chatbot.id, 'question': question, 'answer': answer}
+               for key, (question, answer) in wanted.items() if key not in seen]
+    
+    for start in range(0, len(deletes), FAQ_DELETE_BATCH_SIZE):
+        FAQ.query.filter(FAQ.id.in_(deletes[start:start + FAQ_DELETE_BATCH_SIZE])).delete(synchronize_session=False)
+    db.session.bulk_update_mappings(FAQ, updates)
+    db.session.bulk_insert_mappings(FAQ, inserts)
+    db.session.expire(chatbot, ['faqs'])
+    return {'added': len(inserts), 'updated': len(updates), 'deleted': len(deletes),
+            'unchanged': len(seen) - len(updates)}
+
+def _faq_pair(row, row_number):
+    """(question, answer) from one upload row, or ValueError naming the row."""
+    if isinstance(row, dict):
+        if 'question' not in row or 'answer' not in row:
+            raise ValueError(f"Row {row_number}: expected \"question\" and \"answer\" fields")
+        question, answer = row['question'], row['answer']
+    elif isinstance(row, list):
+        if len(row) < 2:
+            raise ValueError(f"Row {row_number}: expected a question and an answer, got {len(row)} value(s)")
+        question, answer = row[0], row[1]
     else:
-        prompt = BASE_PROMPT_TEMPLATE.format(
-            business_name=config.get('business_name', 'Our Business'),
-            business_type=config.get('business_type', 'Service Provider'),
-            business_description=config.get('business_description', ''),
-            business_hours=config.get('business_hours', ''),
-            services=config.get('services', ''),
-            location=config.get('location', ''),
-            contact_info=config.get('contact_info', ''),
-            availability=config.get('availability', ''),
-            booking_process=config.get('booking_process', ''),
-            faqs=formatted_faqs,
-            appointment_menu_item=appointment_menu_item
-        )
-        
-    if apt_enabled:
-        prompt += appointment_addon
+        raise ValueError(f"Row {row_number}: expected an object or a [question, answer] pair")
+    if not all(isinstance(value, (str, int, float)) or value is None for value in (question, answer)):
+        raise ValueError(f"Row {row_number}: question and answer must be text")
+    return (str(question) if question is not None else '', str(answer) if answer is not None else '')
+
+def read_faq_upload():
+    """
+    (question, answer) pairs from the request: a JSON list (or {"faqs": [...]}) of objects or
+    [question, answer] pairs, or an uploaded CSV file with question/answer columns. Raises ValueError,
+    naming the row (1-based; CSV rows count the header line) when a row has the wrong shape.
+    """
+    if request.is_json:
+        data = request.get_json(silent=True)
+        rows = data.get('faqs') if isinstance(data, dict) else data
+        if not isinstance(rows, list):
+            raise ValueError("Expected a list of FAQs")
+        numbered = list(enumerate(rows, 1))
+    else:
+        upload = request.files.get('file')
+        if not upload:
+            raise ValueError("No file uploaded")
+        try:
+            reader = csv.reader(io.StringIO(upload.read().decode('utf-8-sig')))
+            numbered = [(reader.line_num, row) for row in reader if any(cell.strip() for cell in row)]
+        except (UnicodeDecodeError, csv.Error) as e:
+            raise ValueError(f"Could not read CSV: {e}")
+        if numbered and [cell.strip().lower() for cell in numbered[0][1][:2]] == ['question', 'answer']:
+            numbered = numbered[1:]
+    if len(numbered) > FAQ_IMPORT_MAX_ROWS:
+        raise ValueError(f"Too many FAQs ({len(numbered)}), the limit is {FAQ_IMPORT_MAX_ROWS}")
+    return [_faq_pair(row, row_number) for row_number, row in numbered]
+
+# ---- Context Window ----
+# Chat history sent to the model is sized by an estimated token count rather than a message
+# count. Tokens are approximated locally (no tokenizer dependency): one per punctuation mark
+# and one per ~4 characters of each word, which tracks BPE tokenizers closely enough for budgeting.
+# The same messages go to whichever hedged model answers, so the smallest budget applies.
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))   # input tokens per request
+CONTEXT_SUMMARY_TOKENS = int(os.getenv("CONTEXT_SUMMARY_TOKENS", "300"))  # cap on the rolling summary
+MODEL_CONTEXT_BUDGETS = {}  # model -> input token budget, for models that need less than CONTEXT_TOKEN_BUDGET
+MESSAGE_TOKEN_OVERHEAD = 4  # role and separators per chat message
+SUMMARY_LINE_CHARS = 200
+TOKEN_PIECE_RE = re.compile(r"\w+|[^\w\s]")
+SENTENCE_END_RE = re.compile(r"(?<=[.!?])\s")
+
+def estimate_tokens(text):
+    """Approximate token count of text."""
+    return sum((len(piece) + 3) // 4 for piece in TOKEN_PIECE_RE.findall(text or ""))
+
+def estimate_message_tokens(message):
+    return estimate_tokens(message["content"]) + MESSAGE_TOKEN_OVERHEAD
+
+def context_token_budget(models):
+    """Input token budget that fits every model in models."""
+    return min(MODEL_CONTEXT_BUDGETS.get(model, CONTEXT_TOKEN_BUDGET) for model in models)
+
+def _newest_that_fit(history, budget):
+    """Longest newest-first suffix of history within budget; the newest message is always kept."""
+    kept = 0
+    for _, message in reversed(history):
+        budget -= estimate_message_tokens(message)
+        if kept and budget < 0:
+            break
+        kept += 1
+    return history[len(history) - kept:]
+
+def fold_into_summary(summary, messages):
+    """
+    Append one extractive line per message to the summary and drop the oldest lines until it
+    fits CONTEXT_SUMMARY_TOKENS. Customer lines keep the start of the message (names, dates and
+    contact details usually come early); assistant lines keep only the first sentence.
+    """
+    lines = summary.splitlines() if summary else []
+    for message in messages:
+        text = " ".join(message["content"].split())
+        if message["role"] == "user":
+            lines.append(f"Customer: {text[:SUMMARY_LINE_CHARS]}")
+        else:
+            lines.append(f"Assistant: {SENTENCE_END_RE.split(text, 1)[0][:SUMMARY_LINE_CHARS]}")
+    while len(lines) > 1 and estimate_tokens("\n".join(lines)) > CONTEXT_SUMMARY_TOKENS:
+        lines.pop(0)
+    return "\n".join(lines)
+
+# ---- Answer Cache ----
+# Repeated questions ("hours?", "where are you?") are answered without calling the model when
+# they match one of the config's FAQs or a first question the model already answered. Matching
+# is an exact hash of the normalized question, then TF-IDF cosine similarity over words and
+# character trigrams. Indexes are per process and keyed by the config's knowledge_hash, so any
+# edit to business details or FAQs rebuilds the index and forgets learned answers.
+ANSWER_CACHE_MIN_SIMILARITY = float(os.getenv("ANSWER_CACHE_MIN_SIMILARITY", "0.8"))
+ANSWER_CACHE_MAX_LEARNED = int(os.getenv("ANSWER_CACHE_MAX_LEARNED", "200"))  # learned answers per config
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+QUESTION_STOPWORDS = frozenset(
+    "a an the is are am was were be do does did can could would will shall should may i me my "
+    "you your yours we our us it its this that these those to of in on at for and or please "
+    "what whats when where which who how tell".split()
+)
+APPOINTMENT_INTENT_RE = re.compile(r"\b(book|booking|booked|appointment|slot|schedul\w*|reschedul\w*|cancel\w*|status)\b", re.IGNORECASE)
+
+def normalize_question(text):
+    """Lowercase, strip punctuation and collapse whitespace."""
+    return " ".join(re.sub(r"[^\w\s]", " ", text.lower()).split())
+
+def question_features(normalized):
+    """Bag of content words plus their character trigrams (which absorb plurals and typos)."""
+    features = Counter()
+    for word in normalized.split():
+        if word in QUESTION_STOPWORDS:
+            continue
+        features["w:" + word] += 1
+        padded = f" {word} "
+        for i in range(len(padded) - 2):
+            features["c:" + padded[i:i + 3]] += 1
+    return features
+
+class ConfigIndexRegistry:
+    """Per-process LRU of one search index per config, rebuilt when the config's knowledge_hash changes."""
+    def __init__(self, max_size, build):
+        self.max_size = max_size
+        self.build = build  # build(chatbot snapshot) -> index
+        self.lock = threading.Lock()
+        self.indexes = OrderedDict()  # config_id -> (knowledge_hash, index)
     
-    return prompt
+    def get(self, chatbot):
+        with self.lock:
+            entry = self.indexes.get(chatbot.config_id)
+            if entry and entry[0] == chatbot.knowledge_hash:
+                self.indexes.move_to_end(chatbot.config_id)
+                return entry[1]
+        index = self.build(chatbot)
+        with self.lock:
+            self.indexes[chatbot.config_id] = (chatbot.knowledge_hash, index)
+            self.indexes.move_to_end(chatbot.config_id)
+            while len(self.indexes) > self.max_size:
+                self.indexes.popitem(last=False)
+        return index
+    
+    def __len__(self):
+        return len(self.indexes)
+
+def _config_faqs(chatbot):
+    return db.session.query(FAQ.question, FAQ.answer).filter_by(config_id=chatbot.id).order_by(FAQ.id).all()
+
+class AnswerIndex:
+    """Exact and TF-IDF lookup over one config's FAQ questions and learned first questions."""
+    def __init__(self, faqs):
+        self.lock = threading.Lock()
+        self.docs = OrderedDict()  # normalized question -> (features, answer, source)
+        self.learned = 0
+        self.vectors = None        # postings over docs, built on first lookup
+        self.unindexed = 0         # docs learned since the postings were built (exact matches only until then)
+        for question, answer in faqs:
+            normalized = normalize_question(question)
+            if normalized:
+                self.docs[normalized] = (question_features(normalized), answer, 'faq')
+    
+    def _build_vectors(self):
+        df = Counter()
+        for features, _, _ in self.docs.values():
+            df.update(features.keys())
+        count = len(self.docs)
+        self.unindexed = 0
+        self.idf = {feature: math.log((1 + count) / (1 + n)) + 1 for feature, n in df.items()}
+        self.default_idf = math.log(1 + count) + 1
+        # Inverted index: feature -> [(doc position, weight)], so a lookup only scores docs sharing a feature
+        self.answers = []
+        self.vectors = {}
+        for position, (features, answer, source) in enumerate(self.docs.values()):
+            self.answers.append((answer, source))
+            for feature, weight in self._vector(features).items():
+                self.vectors.setdefault(feature, []).append((position, weight))
+    
+    def _vector(self, features):
+        vector = {feature: tf * self.idf.get(feature, self.default_idf) for feature, tf in features.items()}
+        norm = math.sqrt(sum(weight * weight for weight in vector.values())) or 1.0
+        return {feature: weight / norm for feature, weight in vector.items()}
+    
+    def lookup(self, question):
+        """Return (answer, source, kind) for a confident match, else None."""
+        normalized = normalize_question(question)
+        with self.lock:
+            doc = self.docs.get(normalized)
+            if doc:
+                return doc[1], doc[2], 'exact'
+            features = question_features(normalized)
+            if not features or not self.docs:
+                return None
+            # Rebuild once learned docs reach a tenth of the index rather than after every answer
+            if self.vectors is None or self.unindexed * 10 > len(self.docs):
+                self._build_vectors()
+            scores = {}
+            for feature, weight in self._vector(features).items():
+                for position, doc_weight in self.vectors.get(feature, ()):
+                    scores[position] = scores.get(position, 0.0) + weight * doc_weight
+            if not scores:
+                return None
+            position = max(scores, key=scores.get)
+            score = scores[position]
+            answer, source = self.answers[position]
+        if score >= ANSWER_CACHE_MIN_SIMILARITY:
+            return answer, source, 'similar'
+        return None
+    
+    def learn(self, question, answer):
+        """Remember a model answer to a standalone question; FAQs are never overwritten."""
+        normalized = normalize_question(question)
+        features = question_features(normalized)
+        if not features:
+            return False
+        with self.lock:
+            if normalized in self.docs:
+                return False
+            self.docs[normalized] = (features, answer, 'answer')
+            self.learned += 1
+            if self.learned > ANSWER_CACHE_MAX_LEARNED:
+                oldest = next(key for key, doc in self.docs.items() if doc[2] == 'answer')
+                del self.docs[oldest]
+                self.learned -= 1
+            self.unindexed += 1
+        return True
+
+class AnswerCache:
+    """Per-config AnswerIndex registry with hit-rate counters."""
+    def __init__(self, max_size):
+        self.indexes = ConfigIndexRegistry(max_size, lambda chatbot: AnswerIndex(_config_faqs(chatbot)))
+        self.lock = threading.Lock()
+        self.counters = Counter()
+    
+    def index_for(self, chatbot):
+        return self.indexes.get(chatbot)
+    
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+    
+    def stats(self):
+        with self.lock:
+            counters = dict(self.counters)
+        configs = len(self.indexes)
+        lookups = counters.get('hit', 0) + counters.get('miss', 0)
+        return dict(counters, configs=configs, hit_rate=round(counters.get('hit', 0) / lookups, 3) if lookups else None)
+
+answer_cache = AnswerCache(CONFIG_CACHE_SIZE)
+
+def answer_cache_bypass_reason(chatbot, conversation, user_message):
+    """Why this message must go to the model (appointment or handoff context), or None."""
+    if conversation.handoff_status:
+        return 'handoff'
+    if chatbot.appointment_enabled:
+        if APPOINTMENT_INTENT_RE.search(user_message):
+            return 'appointment'
+        # Mid-booking replies ("Bob, bob@x.com, 12 Feb 2026, 4:00 PM") follow a booking prompt
+        last = conversation.last_message()
+        if last and last["role"] == "assistant" and APPOINTMENT_INTENT_RE.search(last["content"]):
+            return 'appointment'
+    return None
+
+def lookup_cached_answer(chatbot, conversation, user_message):
+    """Cached answer for this message, or None. Call before the user message is added."""
+    if not ANSWER_CACHE_ENABLED:
+        return None
+    reason = answer_cache_bypass_reason(chatbot, conversation, user_message)
+    if reason:
+        answer_cache.count('bypass_' + reason)
+        return None
+    match = answer_cache.index_for(chatbot).lookup(user_message)
+    if not match:
+        answer_cache.count('miss')
+        return None
+    answer, source, kind = match
+    answer_cache.count('hit')
+    answer_cache.count(f'hit_{source}_{kind}')
+    return answer
+
+def learn_cached_answer(chatbot, question, answer):
+    if ANSWER_CACHE_ENABLED and answer_cache.index_for(chatbot).learn(question, answer):
+        answer_cache.count('learned')
+
+# ---- Knowledge Retrieval ----
+# FAQs and long business fields are not inlined into the system prompt. Each config gets a
+# local BM25 index over its FAQ pairs and paragraph chunks of its long fields, and every turn
+# carries only the top RETRIEVAL_TOP_K entries for the customer's message, so prompt size no
+# longer grows with the number of FAQs.
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "5"))
+RETRIEVAL_FIELD_INLINE_CHARS = 400  # longer services/description text is clipped in the prompt and indexed
+RETRIEVAL_CHUNK_CHARS = 400
+RETRIEVAL_ENTRY_CHARS = 600         # cap on any single entry injected into a turn
+BM25_K1 = 1.5
+BM25_B = 0.75
+KNOWLEDGE_FIELDS = (('services', 'Services'), ('business_description', 'About the business'))
+
+def _inline_field(text):
+    """Field text as rendered in the system prompt: in full if short, else its opening with a pointer."""
+    text = text or ''
+    if len(text) <= RETRIEVAL_FIELD_INLINE_CHARS:
+        return text
+    return text[:RETRIEVAL_FIELD_INLINE_CHARS].rsplit(' ', 1)[0] + " … (more in RELEVANT KNOWLEDGE)"
+
+def retrieval_terms(text):
+    """Content words of text, with a plural "s" stripped."""
+    terms = []
+    for word in normalize_question(text).split():
+        if word in QUESTION_STOPWORDS:
+            continue
+        if len(word) > 3 and word.endswith('s') and not word.endswith('ss'):
+            word = word[:-1]
+        terms.append(word)
+    return terms
+
+def chunk_text(text, size=RETRIEVAL_CHUNK_CHARS):
+    """Split text into chunks of whole sentences (or lines) of up to roughly size characters."""
+    chunks, current = [], ""
+    for sentence in re.split(r"(?<=[.!?])\s+|\n+", text or ""):
+        sentence = sentence.strip()
+        if not sentence:
+            continue
+        if current and len(current) + len(sentence) + 1 > size:
+            chunks.append(current)
+            current = ""
+        current = f"{current} {sentence}".strip()
+    if current:
+        chunks.append(current)
+    return chunks
+
+class KnowledgeIndex:
+    """BM25 index over one config's knowledge entries."""
+    def __init__(self, entries):
+        # entries: (indexed text, text shown to the model)
+        self.entries = []
+        self.postings = {}  # term -> [(entry position, term frequency)]
+        self.lengths = []
+        for position, (indexed, shown) in enumerate(entries):
+            terms = retrieval_terms(indexed)
+            self.entries.append(shown[:RETRIEVAL_ENTRY_CHARS])
+            self.lengths.append(len(terms))
+            for term, tf in Counter(terms).items():
+                self.postings.setdefault(term, []).append((position, tf))
+        count = len(self.entries)
+        self.average_length = (sum(self.lengths) / count) if count else 0.0
+        self.idf = {term: math.log(1 + (count - len(docs) + 0.5) / (len(docs) + 0.5))
+                    for term, docs in self.postings.items()}
+    
+    def search(self, query, k):
+        """Up to k entries matching query, best first."""
+        scores = {}
+        for term in set(retrieval_terms(query)):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for position, tf in self.postings[term]:
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[position] / (self.average_length or 1))
+                scores[position] = scores.get(position, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+        best = sorted(scores, key=scores.get, reverse=True)[:k]
+        return [self.entries[position] for position in best]
+
+def build_knowledge_index(chatbot):
+    entries = []
+    for question, answer in _config_faqs(chatbot):
+        # The question is indexed twice so it outweighs incidental words in a long answer
+        entries.append((f"{question} {question} {answer}", f"Q: {question}\nA: {answer}"))
+    fields = db.session.query(*[getattr(BusinessConfig, name) for name, _ in KNOWLEDGE_FIELDS]).filter_by(id=chatbot.id).first() or ()
+    for (name, label), text in zip(KNOWLEDGE_FIELDS, fields):
+        if text and len(text) > RETRIEVAL_FIELD_INLINE_CHARS:
+            entries.extend((chunk, f"{label}: {chunk}") for chunk in chunk_text(text))
+    return KnowledgeIndex(entries)
+
+knowledge_indexes = ConfigIndexRegistry(CONFIG_CACHE_SIZE, build_knowledge_index)
+
+def knowledge_prompt(chatbot, user_message):
+    """System note with the entries most relevant to user_message, or None if nothing matches."""
+    entries = knowledge_indexes.get(chatbot).search(user_message, RETRIEVAL_TOP_K)
+    if not entries:
+        return None
+    return "RELEVANT KNOWLEDGE (FAQs and business details matching the customer's message):\n" + "\n\n".join(entries)
 
 @app.route('/health')
 def health_check():
     """Health check endpoint for Render and self-pinging."""
-    return jsonify({"status": "ok", "timestamp": datetime.utcnow().isoformat()}), 200
+    return jsonify({
+        "status": "ok",
+        "timestamp": datetime.utcnow().isoformat(),
+        "models": model_health.snapshot(),
+        "config_cache": config_cache.stats(),
+        "prompt_cache": _cached_prompt_version_content.cache_info()._asdict(),
+        "answer_cache": answer_cache.stats(),
+        "knowledge_indexes": len(knowledge_indexes),
+        "telegram_outbox": telegram_outbox_stats(),
+        "telegram_pollers": telegram_poller_metrics(),
+        "telegram_webhook_queue": webhook_queue_stats(),
+        "history_long_polls": history_waiters.stats(),
+        "chat_event_streams": event_streams.stats()
+    }), 200
 
 @app.route('/')
 def index():
@@ -755,38 +2019,133 @@ def logout():
     logout_user()
     return redirect(url_for('index'))
 
-@app.route('/dashboard')
-@login_required
-def dashboard():
-    """User dashboard to manage chatbots."""
-    chatbots = BusinessConfig.query.filter_by(user_id=current_user.id).all()
-    
-    # Get appointments for all user's chatbots
-    config_ids = [c.config_id for c in chatbots]
-    appointments = Appointment.query.filter(
-        Appointment.config_id.in_(config_ids)
-    ).order_by(Appointment.created_at.desc()).all() if config_ids else []
-    
-    # Calculate stats for executive header
-    stats = {
-        'total_agents': len(chatbots),
-        'total_conversations': 0,
-        'pending_appointments': 0,
-        'approved_appointments': 0
-    }
+# ---- Appointment Listings ----
+DASHBOARD_RECENT_LEADS = 50  # appointments shown in the dashboard's Recent Leads feed
+APPOINTMENTS_PAGE_SIZE = int(os.getenv("APPOINTMENTS_PAGE_SIZE", "25"))
+APPOINTMENT_STATUSES = ('pending', 'approved', 'declined')
+
+def _keyset_cursor(timestamp, row_id):
+    """Opaque keyset cursor pointing just past the row with this (timestamp, id)."""
+    return f"{timestamp.isoformat()}_{row_id}"
+
+def _parse_keyset_cursor(cursor):
+    """Return (timestamp, id) from a cursor, or None if it is missing or malformed."""
+    if not cursor:
+        return None
+    try:
+        timestamp, row_id = cursor.rsplit('_', 1)
+        return datetime.fromisoformat(timestamp), int(row_id)
+    except ValueError:
+        return None
+
+def paginate_appointments(config_ids, status=None, search=None, cursor=None, per_page=APPOINTMENTS_PAGE_SIZE, options=()):
+    """One page of appointments, newest first, and the cursor for the next page (None on the last page).
+
+    Pages are keyset-paginated on (created_at, id) so every page is an index range scan
+    over (config_id[, status], created_at), however many leads a bot has accumulated.
+    """
+    query = Appointment.query.filter(Appointment.config_id.in_(config_ids)).options(*options)
+    if status in APPOINTMENT_STATUSES:
+        query = query.filter(Appointment.status == status)
+    if search:
+        pattern = f"%{search}%"
+        query = query.filter(or_(Appointment.customer_name.ilike(pattern),
+                                 Appointment.customer_email.ilike(pattern),
+                                 Appointment.customer_mobile.ilike(pattern),
+                                 Appointment.preferred_time.ilike(pattern)))
+    position = _parse_keyset_cursor(cursor)
+    if position:
+        created_at, apt_id = position
+        query = query.filter(or_(Appointment.created_at < created_at,
+                                 and_(Appointment.created_at == created_at, Appointment.id < apt_id)))
+    
+    # Fetch one extra row to learn whether an older page exists
+    rows = query.order_by(Appointment.created_at.desc(), Appointment.id.desc()).limit(per_page + 1).all()
+    next_cursor = _keyset_cursor(rows[per_page - 1].created_at, rows[per_page - 1].id) if len(rows) > per_page else None
+    return rows[:per_page], next_cursor
+
+# ---- Conversation Logs ----
+# The manage page lists one keyset-paginated page of conversations, most recently active
+# first, with a one-line preview of each; transcripts are fetched on demand when a session
+# is opened.
+CONVERSATION_LOG_PAGE_SIZE = int(os.getenv("CONVERSATION_LOG_PAGE_SIZE", "30"))
+
+def paginate_conversations(config_id, cursor=None, per_page=CONVERSATION_LOG_PAGE_SIZE):
+    """One page of (id, session_id, last_updated) rows, newest activity first, and the next page's cursor.
+
+    Keyset-paginated on (last_updated, id) over ix_conversation_config_updated, like
+    paginate_appointments.
+    """
+    query = (db.session.query(Conversation.id, Conversation.session_id, Conversation.last_updated)
+             .filter(Conversation.config_id == config_id))
+    position = _parse_keyset_cursor(cursor)
+    if position:
+        last_updated, conversation_id = position
+        query = query.filter(or_(Conversation.last_updated < last_updated,
+                                 and_(Conversation.last_updated == last_updated, Conversation.id < conversation_id)))
+    rows = query.order_by(Conversation.last_updated.desc(), Conversation.id.desc()).limit(per_page + 1).all()
+    last = rows[per_page - 1] if len(rows) > per_page else None
+    next_cursor = _keyset_cursor(last.last_updated, last.id) if last else None
+    return rows[:per_page], next_cursor
+
+def last_message_previews(conversation_ids):
+    """Map conversation id -> content of its newest message, in one query."""
+    if not conversation_ids:
+        return {}
+    newest = (db.session.query(Message.conversation_id, func.max(Message.sequence).label('sequence'))
+              .filter(Message.conversation_id.in_(conversation_ids))
+              .group_by(Message.conversation_id).subquery())
+    rows = (db.session.query(Message.conversation_id, Message.content)
+            .join(newest, and_(Message.conversation_id == newest.c.conversation_id,
+                               Message.sequence == newest.c.sequence)))
+    return dict(rows.all())
+
+def appointment_status_counts(config_ids):
+    """Map of (config_id, status) -> count from one grouped, index-only aggregate."""
+    return {(config_id, status): count for config_id, status, count in
+            db.session.query(Appointment.config_id, Appointment.status, func.count(Appointment.id))
+            .filter(Appointment.config_id.in_(config_ids))
+            .group_by(Appointment.config_id, Appointment.status).all()}
+
+@app.route('/dashboard')
+@login_required
+def dashboard():
+    """User dashboard to manage chatbots."""
+    chatbots = BusinessConfig.query.filter_by(user_id=current_user.id).all()
+    config_ids = [c.config_id for c in chatbots]
+    
+    # Per-bot counts come from two grouped aggregates; conversations and their messages are never loaded
+    conversation_counts = {}
+    appointment_counts = {}  # (config_id, status) -> count
+    appointments, next_cursor = [], None
+    leads_status = request.args.get('leads_status', '')
+    leads_search = request.args.get('leads_q', '').strip()
+    if config_ids:
+        conversation_counts = dict(db.session.query(Conversation.config_id, func.count(Conversation.id))
+                                   .filter(Conversation.config_id.in_(config_ids))
+                                   .group_by(Conversation.config_id).all())
+        appointment_counts = appointment_status_counts(config_ids)
+        # Recent leads feed, one keyset page at a time, with each lead's bot loaded in one extra query
+        appointments, next_cursor = paginate_appointments(
+            config_ids, status=leads_status, search=leads_search, cursor=request.args.get('leads_before'),
+            per_page=DASHBOARD_RECENT_LEADS, options=(orm.selectinload(Appointment.business_config),))
+    
+    # Calculate stats for executive header
+    stats = {
+        'total_agents': len(chatbots),
+        'total_conversations': sum(conversation_counts.values()),
+        'pending_appointments': sum(n for (_, status), n in appointment_counts.items() if status == 'pending'),
+        'approved_appointments': sum(n for (_, status), n in appointment_counts.items() if status == 'approved')
+    }
     
     for chatbot in chatbots:
-        stats['total_conversations'] += len(chatbot.conversations)
-        # Add a dynamic attribute for the template
-        chatbot.leads_count = Appointment.query.filter_by(config_id=chatbot.config_id, status='approved').count()
-        
-    for apt in appointments:
-        if apt.status == 'pending':
-            stats['pending_appointments'] += 1
-        elif apt.status == 'approved':
-            stats['approved_appointments'] += 1
+        # Add dynamic attributes for the template
+        chatbot.conversations_count = conversation_counts.get(chatbot.config_id, 0)
+        chatbot.leads_count = appointment_counts.get((chatbot.config_id, 'approved'), 0)
             
-    return render_template('dashboard.html', chatbots=chatbots, appointments=appointments, stats=stats)
+    return render_template('dashboard.html', chatbots=chatbots, appointments=appointments, stats=stats,
+                           leads_status=leads_status, leads_search=leads_search, leads_next_cursor=next_cursor,
+                           appointment_statuses=APPOINTMENT_STATUSES)
 
 @app.route('/admin', methods=['GET'])
 @login_required
@@ -808,8 +2167,10 @@ def manage_chatbot(config_id):
     
     if request.method == 'POST':
         action = request.form.get('action', 'save_general')
+        suggestions_changed = False
         
         if action == 'save_general':
+            previous_suggestion_inputs = suggestion_inputs(chatbot)
             # Update basic fields
             chatbot.business_name = request.form.get('business_name', '')
             chatbot.business_type = request.form.get('business_type', '')
@@ -819,16 +2180,13 @@ def manage_chatbot(config_id):
             chatbot.location = request.form.get('location', '')
             chatbot.contact_info = request.form.get('contact_info', '')
             
-            # Update FAQs
-            for faq in chatbot.faqs:
-                db.session.delete(faq)
+            # Update FAQs (only rows that changed are written)
+            sync_faqs(chatbot, zip(request.form.getlist('faq_question[]'), request.form.getlist('faq_answer[]')))
             
-            questions = request.form.getlist('faq_question[]')
-            answers = request.form.getlist('faq_answer[]')
-            for i in range(len(questions)):
-                if questions[i].strip() and i < len(answers):
-                    faq = FAQ(question=questions[i], answer=answers[i], config_id=chatbot.id)
-                    db.session.add(faq)
+            # Regenerate suggestion chips only if what they are built from changed
+            suggestions_changed = suggestion_inputs(chatbot) != previous_suggestion_inputs
+            if suggestions_changed:
+                invalidate_ai_suggestions(chatbot)
                     
         elif action == 'save_appointments':
             chatbot.appointment_enabled = 'appointment_enabled' in request.form
@@ -873,36 +2231,21 @@ def manage_chatbot(config_id):
             apt_action = request.form.get('apt_action')
             
             if apt_ids:
-                for apt_id in apt_ids:
-                    apt = Appointment.query.filter_by(id=apt_id, config_id=config_id).first()
-                    if apt:
-                        if apt_action == 'approve': apt.status = 'approved'
-                        elif apt_action == 'decline': apt.status = 'declined'
-                        elif apt_action == 'delete': db.session.delete(apt)
+                selected = Appointment.query.filter(Appointment.config_id == config_id,
+                                                    Appointment.id.in_(apt_ids)).all()
+                conflicts = []
+                for apt in selected:
+                    if apt_action == 'approve':
+                        if not approve_appointment_slot(apt): conflicts.append(apt.customer_name)
+                    elif apt_action == 'decline': apt.status = 'declined'
+                    elif apt_action == 'delete': db.session.delete(apt)
+                if conflicts:
+                    flash(f"Not approved, slot already booked: {', '.join(conflicts)}", 'warning')
             elif apt_action == 'approve_all':
                 Appointment.query.filter_by(config_id=config_id, status='pending').update({Appointment.status: 'approved'})
             elif apt_action == 'decline_all':
                 Appointment.query.filter_by(config_id=config_id, status='pending').update({Appointment.status: 'declined'})
         
-        elif action == 'save_telegram':
-            bot_token = request.form.get('telegram_bot_token')
-            chat_id = request.form.get('telegram_chat_id')
-            chatbot.telegram_bot_token = bot_token
-            chatbot.telegram_chat_id = chat_id
-            db.session.commit()
-            
-            # Auto-register webhook when saving Telegram settings
-            if bot_token:
-                base_url = os.environ.get('RENDER_EXTERNAL_URL') or request.url_root.rstrip('/')
-                wh_ok = _register_single_webhook(bot_token, chatbot.config_id, chatbot.business_name, base_url)
-                if wh_ok:
-                    flash("Telegram settings saved & webhook registered! ✅", "success")
-                else:
-                    flash("Telegram settings saved, but webhook registration failed. Try 'Force Webhook Sync'.", "warning")
-            else:
-                flash("Telegram settings updated!", "success")
-            return redirect(url_for('manage_chatbot', config_id=config_id))
-        
         elif action == 'setup_webhook':
             # Forcefully set the webhook for this bot
             bot_token = chatbot.telegram_bot_token
@@ -916,7 +2259,7 @@ def manage_chatbot(config_id):
             
             try:
                 url = f"https://api.telegram.org/bot{bot_token}/setWebhook"
-                resp = requests.post(url, json={"url": webhook_url}, timeout=10)
+                resp = telegram_http.post(url, json={"url": webhook_url, "secret_token": telegram_webhook_secret(bot_token)}, timeout=TELEGRAM_TIMEOUT)
                 if resp.status_code == 200:
                     flash(f"✅ Webhook successfully linked to: {webhook_url}", "success")
                 else:
@@ -927,14 +2270,24 @@ def manage_chatbot(config_id):
             return redirect(url_for('manage_chatbot', config_id=config_id))
 
         # Update system prompt based on new settings
-        chatbot.system_prompt = generate_system_prompt(chatbot)
+        update_system_prompt(chatbot)
         
         db.session.commit()
+        invalidate_config_snapshot(config_id)
+        if suggestions_changed:
+            refresh_ai_suggestions(config_id, force=True)
         flash('Changes saved successfully!', 'success')
         return redirect(url_for('manage_chatbot', config_id=config_id))
 
     # GET request
-    appointments = Appointment.query.filter_by(config_id=config_id).order_by(Appointment.created_at.desc()).all()
+    apt_status = request.args.get('apt_status', '')
+    apt_search = request.args.get('apt_q', '').strip()
+    appointments, apt_next_cursor = paginate_appointments([config_id], status=apt_status, search=apt_search,
+                                                          cursor=request.args.get('apt_before'))
+    apt_counts = {status: count for (_, status), count in appointment_status_counts([config_id]).items()}
+    conversations_count = db.session.query(func.count(Conversation.id)).filter(Conversation.config_id == config_id).scalar()
+    log_conversations, logs_next_cursor = paginate_conversations(config_id, cursor=request.args.get('logs_before'))
+    log_previews = last_message_previews([conv.id for conv in log_conversations])
     
     # Parse JSON configs for template
     try:
@@ -947,11 +2300,70 @@ def manage_chatbot(config_id):
     return render_template('manage_chatbot.html', 
                           chatbot=chatbot, 
                           appointments=appointments,
+                          apt_counts=apt_counts,
+                          apt_total=sum(apt_counts.values()),
+                          apt_status=apt_status,
+                          apt_search=apt_search,
+                          apt_next_cursor=apt_next_cursor,
+                          appointment_statuses=APPOINTMENT_STATUSES,
+                          conversations_count=conversations_count,
+                          log_conversations=log_conversations,
+                          log_previews=log_previews,
+                          logs_next_cursor=logs_next_cursor,
                           apt_config=apt_config,
                           style_config=style_config,
                           email_config=email_config,
                           business_types=BUSINESS_TYPES)
 
+@app.route('/chatbot/<config_id>/conversations/<int:conversation_id>/transcript')
+@login_required
+def conversation_transcript(config_id, conversation_id):
+    """Full message list of one conversation, for the manage page's log viewer."""
+    BusinessConfig.query.filter_by(config_id=config_id, user_id=current_user.id).first_or_404()
+    conversation = Conversation.query.filter_by(id=conversation_id, config_id=config_id).first_or_404()
+    if conversation._migrate_legacy_history():
+        db.session.commit()
+    return jsonify({"session_id": conversation.session_id, "messages": conversation.messages})
+
+@app.route('/chatbot/<config_id>/faqs/import', methods=['POST'])
+@login_required
+def import_faqs(config_id):
+    """Bulk-import FAQs from JSON or CSV, merged into the existing list (mode=replace drops the rest)."""
+    chatbot = BusinessConfig.query.filter_by(config_id=config_id, user_id=current_user.id).first_or_404()
+    wants_json = request.is_json
+    data = request.get_json(silent=True) if wants_json else request.form
+    replace = isinstance(data, dict) and data.get('mode') == 'replace'
+    
+    try:
+        pairs = read_faq_upload()
+    except ValueError as e:
+        if wants_json:
+            return jsonify({"error": str(e)}), 400
+        flash(f"FAQ import failed: {e}", 'danger')
+        return redirect(url_for('manage_chatbot', config_id=config_id))
+    
+    started = time.monotonic()
+    previous_suggestion_inputs = suggestion_inputs(chatbot)
+    counts = sync_faqs(chatbot, pairs, replace=replace)
+    changed = counts['added'] or counts['updated'] or counts['deleted']
+    suggestions_changed = changed and suggestion_inputs(chatbot) != previous_suggestion_inputs
+    if suggestions_changed:
+        invalidate_ai_suggestions(chatbot)
+    if changed:
+        update_system_prompt(chatbot)
+    db.session.commit()
+    if changed:
+        invalidate_config_snapshot(config_id)
+    if suggestions_changed:
+        refresh_ai_suggestions(config_id, force=True)
+    print(f"DEBUG FAQ IMPORT: {config_id} {counts} in {(time.monotonic() - started) * 1000:.0f}ms")
+    
+    if wants_json:
+        return jsonify(counts)
+    flash(f"FAQs imported: {counts['added']} added, {counts['updated']} updated, "
+          f"{counts['deleted']} removed, {counts['unchanged']} unchanged.", 'success')
+    return redirect(url_for('manage_chatbot', config_id=config_id))
+
 @app.route('/delete_chatbot/<config_id>', methods=['POST'])
 @login_required
 def delete_chatbot(config_id):
@@ -962,6 +2374,7 @@ def delete_chatbot(config_id):
         # Delete the chatbot (cascading will handle FAQs, Appointments, Conversations, and HandoffRequests)
         db.session.delete(chatbot)
         db.session.commit()
+        invalidate_config_snapshot(config_id)
         
         flash(f'Chatbot "{chatbot.business_name}" deleted successfully', 'success')
     except Exception as e:
@@ -1047,9 +2460,11 @@ def save_config():
         db.session.add(ownership_faq)
         
         # Generate system prompt
-        new_config.system_prompt = generate_system_prompt(new_config)
+        update_system_prompt(new_config)
         
         db.session.commit()
+        invalidate_config_snapshot(config_id)
+        refresh_ai_suggestions(config_id)
         
         return redirect(url_for('config_success', config_id=config_id))
     
@@ -1072,18 +2487,38 @@ def embed(config_id):
     chatbot = BusinessConfig.query.filter_by(config_id=config_id, user_id=current_user.id).first_or_404()
     return render_template('embed.html', chatbot=chatbot, config_id=config_id)
 
+# ---- AI Suggestion Chips ----
+# Bots without configured suggestion_chips get AI-generated ones. They are generated once per
+# bot in a background thread, stored on BusinessConfig, and refreshed after the TTL or when the
+# business info they are built from changes, so rendering the chat page never waits on the LLM.
+# A forced refresh that arrives while one is running marks it stale; the running refresh then
+# discards its result and generates again from the new info.
+SUGGESTION_CACHE_TTL = int(os.getenv("SUGGESTION_CACHE_TTL", str(7 * 24 * 3600)))  # seconds
+SUGGESTION_RETRY_AFTER = 300  # seconds before retrying a bot whose generation failed
+DEFAULT_SUGGESTIONS = ["Tell me about your services", "How to book an appointment?", "Where are you located?", "Contact support"]
+NO_API_KEY_SUGGESTIONS = ["What services do you offer?", "Book an appointment", "Our location", "Contact info"]
+suggestion_refresh_lock = threading.Lock()
+suggestion_refreshes_in_flight = set()
+suggestion_refreshes_stale = set()  # in-flight refreshes whose inputs changed after they started
+suggestion_last_attempt = {}  # config_id -> monotonic time of the last generation attempt
+
+def suggestion_inputs(chatbot):
+    """The business info suggestion chips are generated from: (name, services, first FAQ questions)."""
+    questions = db.session.query(FAQ.question).filter_by(config_id=chatbot.id).order_by(FAQ.id).limit(2)
+    return chatbot.business_name, chatbot.services or chatbot.business_type, tuple(q for (q,) in questions)
+
 def generate_ai_suggestions(chatbot):
-    """Generate 3-5 high-quality starter questions based on business info."""
+    """Generate 3-5 high-quality starter questions based on business info. Returns None on failure."""
     api_key = os.getenv("OPENROUTER_API_KEY", "").strip()
     if not api_key:
-        return ["What services do you offer?", "Book an appointment", "Our location", "Contact info"]
+        return None
         
     try:
-        api_url = "https://openrouter.ai/api/v1/chat/completions"
+        business_name, services, faq_questions = suggestion_inputs(chatbot)
         prompt = f"""Generate 4 very short, interactive starter questions for a chatbot. 
-Business: {chatbot.business_name}
-Services: {chatbot.services or chatbot.business_type}
-FAQs: {", ".join([f.question for f in chatbot.faqs[:2]])}
+Business: {business_name}
+Services: {services}
+FAQs: {", ".join(faq_questions)}
 
 Requirements:
 - MAX 6 words each.
@@ -1091,9 +2526,8 @@ Requirements:
 - Separated ONLY by commas.
 - Make them specific to the business."""
 
-        payload = {
-            "model": "google/gemini-2.0-flash-001:free",
-            "messages": [{"role": "user", "content": prompt}],
+        messages = [{"role": "user", "content": prompt}]
+        params = {
             "temperature": 0.4,
             "max_tokens": 100
         }
@@ -1103,22 +2537,86 @@ Requirements:
             "Content-Type": "application/json"
         }
         
-        response = requests.post(api_url, headers=headers, json=payload, timeout=7)
-        if response.status_code == 200:
-            content = response.json()['choices'][0]['message']['content'].strip()
-            suggestions = [s.strip().strip('"').strip("'") for s in content.split(',')]
+        model_name, content, last_error = _hedged_call(
+            _with_model_health(lambda model: _request_model_completion(model, messages, headers, params=params, timeout=SUGGESTION_TIMEOUT)),
+            model_health.ordered(SUGGESTION_MODELS),
+            timeout=SUGGESTION_TIMEOUT
+        )
+        if content:
+            suggestions = [s.strip().strip('"').strip("'") for s in content.strip().split(',')]
             valid = [s for s in suggestions if len(s) > 3][:4]
             if valid: return valid
+        else:
+            print(f"DEBUG: Suggestion generation failed: {last_error}")
     except Exception as e:
         print(f"DEBUG: Suggestion generation failed: {e}")
-    
-    # Final fallback if AI fails
-    return ["Tell me about your services", "How to book an appointment?", "Where are you located?", "Contact support"]
+    return None
+
+def _refresh_ai_suggestions_worker(config_id):
+    while True:
+        try:
+            with app.app_context():
+                chatbot = BusinessConfig.query.filter_by(config_id=config_id).first()
+                suggestions = generate_ai_suggestions(chatbot) if chatbot else None
+                with suggestion_refresh_lock:
+                    stale = config_id in suggestion_refreshes_stale
+                if suggestions and not stale:
+                    chatbot.ai_suggestions = json.dumps(suggestions)
+                    chatbot.ai_suggestions_updated_at = datetime.utcnow()
+                    db.session.commit()
+                    invalidate_config_snapshot(config_id)
+                    print(f"DEBUG: Stored AI suggestions for {config_id}")
+        except Exception as e:
+            print(f"DEBUG: Suggestion refresh failed for {config_id}: {e}")
+        with suggestion_refresh_lock:
+            if config_id not in suggestion_refreshes_stale:
+                suggestion_refreshes_in_flight.discard(config_id)
+                return
+            suggestion_refreshes_stale.discard(config_id)
+        print(f"DEBUG: Business info for {config_id} changed during suggestion refresh, regenerating")
+
+def refresh_ai_suggestions(config_id, force=False):
+    """
+    Regenerate a bot's suggestion chips in the background. At most one refresh per bot runs at a
+    time; with force (business info changed), a running refresh is restarted from the new info.
+    """
+    now = time.monotonic()
+    with suggestion_refresh_lock:
+        if config_id in suggestion_refreshes_in_flight:
+            if force:
+                suggestion_refreshes_stale.add(config_id)
+            return
+        if not force and now - suggestion_last_attempt.get(config_id, float('-inf')) < SUGGESTION_RETRY_AFTER:
+            return
+        suggestion_refreshes_in_flight.add(config_id)
+        suggestion_last_attempt[config_id] = now
+    threading.Thread(target=_refresh_ai_suggestions_worker, args=(config_id,), daemon=True).start()
+
+def get_ai_suggestions(chatbot):
+    """Return the stored suggestion chips for a bot, scheduling a refresh if they are missing or stale."""
+    suggestions = None
+    try:
+        suggestions = json.loads(chatbot.ai_suggestions) if chatbot.ai_suggestions else None
+    except ValueError:
+        pass
+    updated_at = chatbot.ai_suggestions_updated_at
+    if not suggestions or not updated_at or (datetime.utcnow() - updated_at).total_seconds() > SUGGESTION_CACHE_TTL:
+        refresh_ai_suggestions(chatbot.config_id)
+    if suggestions:
+        return suggestions
+    return DEFAULT_SUGGESTIONS if os.getenv("OPENROUTER_API_KEY", "").strip() else NO_API_KEY_SUGGESTIONS
+
+def invalidate_ai_suggestions(chatbot):
+    """Drop a bot's stored suggestion chips after its business info changed. Call refresh after commit."""
+    chatbot.ai_suggestions = None
+    chatbot.ai_suggestions_updated_at = None
 
 @app.route('/chat/<config_id>')
 def chat(config_id):
     """Render the chat page for a specific business configuration."""
-    chatbot = BusinessConfig.query.filter_by(config_id=config_id).first_or_404()
+    chatbot = get_config_snapshot(config_id)
+    if not chatbot:
+        abort(404)
     
     style_config = {}
     try:
@@ -1126,387 +2624,943 @@ def chat(config_id):
     except:
         pass
         
-    # Generate AI suggestions if not provided OR if empty
+    # Use stored AI suggestions if chips are not provided OR empty
     chips = style_config.get('suggestion_chips', '').strip()
     if not chips:
-        ai_suggestions = generate_ai_suggestions(chatbot)
-        style_config['suggestion_chips'] = ",".join(ai_suggestions)
+        style_config['suggestion_chips'] = ",".join(get_ai_suggestions(chatbot))
         
-    return render_template('chat.html', config=chatbot, config_id=config_id, style_config=style_config)
+    return render_template('chat.html', config=chatbot, config_id=config_id, style_config=style_config,
+                           long_poll_wait=int(HISTORY_LONG_POLL_MAX))
 
-@app.route('/chat', methods=['POST'])
-def process_chat():
-    """Process chat messages from the frontend."""
-    try:
-        # Get data from request
-        data = request.json
-        user_message = data.get('message', '').strip()
-        config_id = data.get('config_id')
-        chat_key = data.get('chat_key')  # Unique key from frontend localStorage
-        appointment_booked = False
-        
-        if not user_message:
-            return jsonify({"error": "Message cannot be empty"}), 400
-        
-        if not config_id:
-            return jsonify({"error": "Config ID is required"}), 400
-        
-        # Check if configuration exists
-        chatbot = BusinessConfig.query.filter_by(config_id=config_id).first()
-        if not chatbot:
-            print(f"DEBUG: Chatbot config not found for {config_id}")
-            return jsonify({"error": "Business configuration not found"}), 404
-        
-        # Get the system prompt for this business, fallback if empty
-        system_prompt = chatbot.system_prompt or "You are a helpful business assistant."
-        print(f"DEBUG: Using system prompt: {system_prompt[:50]}...")
-        
-        # Use chat_key from frontend if provided, otherwise generate one
-        is_new_key = False
-        if not chat_key:
-            chat_key = uuid.uuid4().hex[:16]
-            is_new_key = True
+# Fast models with native system role support, tried in order
+FREE_MODELS = [
+    "stepfun/step-3.5-flash:free",            # Primary: CONFIRMED WORKING
+    "meta-llama/llama-3.3-70b-instruct:free", # High quality fallback
+    "qwen/qwen-2.5-72b-instruct:free",       # Strong multilingual
+    "mistralai/mistral-small-3.1-24b-instruct:free",  # Fast fallback
+]
+
+# ---- Model Health Tracking ----
+# Process-wide registry of per-model outcomes. Models that keep failing get their
+# circuit opened (skipped) for a cooldown, then a single half-open probe decides whether
+# to close it again. Fallback order is re-ranked so healthy, fast models go first.
+MODEL_WINDOW_SIZE = 50
+MODEL_WINDOW_SECONDS = 300  # outcomes older than this no longer affect ranking
+MODEL_MIN_SAMPLES = 3       # fewer recent calls than this rank as healthy
+MODEL_CIRCUIT_FAILURES = int(os.getenv("MODEL_CIRCUIT_FAILURES", "5"))
+MODEL_CIRCUIT_COOLDOWN = float(os.getenv("MODEL_CIRCUIT_COOLDOWN", "30"))
+MODEL_LATENCY_BUCKET = 5  # seconds; models within the same bucket keep their configured order
+
+class ModelHealth:
+    """Rolling outcome window and circuit-breaker state for one model."""
+    def __init__(self):
+        self.samples = deque(maxlen=MODEL_WINDOW_SIZE)  # (timestamp, succeeded, latency)
+        self.consecutive_failures = 0
+        self.state = 'closed'  # closed, open, half_open
+        self.opened_at = 0
+        self.probe_in_flight = False
+    
+    def recent(self, now):
+        return [s for s in self.samples if now - s[0] <= MODEL_WINDOW_SECONDS]
+    
+    def error_rate(self, now):
+        recent = self.recent(now)
+        if not recent:
+            return 0.0
+        return sum(1 for s in recent if not s[1]) / len(recent)
+    
+    def percentile(self, pct, now):
+        latencies = sorted(s[2] for s in self.recent(now) if s[1])
+        if not latencies:
+            return None
+        index = min(len(latencies) - 1, int(round(pct / 100 * (len(latencies) - 1))))
+        return latencies[index]
+
+class ModelHealthRegistry:
+    """Thread-safe health registry shared by every LLM call in this process."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.models = {}
+    
+    def _get(self, model_name):
+        health = self.models.get(model_name)
+        if health is None:
+            health = self.models[model_name] = ModelHealth()
+        return health
+    
+    def _cooling_down(self, health, now):
+        return health.state == 'open' and now - health.opened_at < MODEL_CIRCUIT_COOLDOWN
+    
+    def acquire(self, model_name):
+        """Return True if a call to this model may proceed right now."""
+        with self.lock:
+            health = self._get(model_name)
+            if health.state == 'closed':
+                return True
+            if self._cooling_down(health, time.monotonic()):
+                return False
+            # Cooldown over (or already half-open): allow exactly one probe at a time
+            if health.probe_in_flight:
+                return False
+            health.state = 'half_open'
+            health.probe_in_flight = True
+            return True
+    
+    def record_success(self, model_name, latency):
+        with self.lock:
+            health = self._get(model_name)
+            health.samples.append((time.monotonic(), True, latency))
+            health.consecutive_failures = 0
+            if health.state != 'closed':
+                print(f"MODEL HEALTH: {model_name} recovered, closing circuit")
+            health.state = 'closed'
+            health.probe_in_flight = False
+    
+    def record_failure(self, model_name):
+        with self.lock:
+            health = self._get(model_name)
+            health.samples.append((time.monotonic(), False, 0))
+            health.consecutive_failures += 1
+            health.probe_in_flight = False
+            if health.state == 'half_open' or health.consecutive_failures >= MODEL_CIRCUIT_FAILURES:
+                if health.state != 'open':
+                    print(f"MODEL HEALTH: Opening circuit for {model_name} "
+                          f"({health.consecutive_failures} consecutive failures)")
+                health.state = 'open'
+                health.opened_at = time.monotonic()
+    
+    def ordered(self, model_names):
+        """Rank models: closed circuits first, then lower error rate, then lower p95 latency."""
+        now = time.monotonic()
+        ranked = []
+        with self.lock:
+            for index, model_name in enumerate(model_names):
+                health = self.models.get(model_name)
+                if health is None:
+                    ranked.append(((0, 0.0, 0, index), model_name))
+                    continue
+                if len(health.recent(now)) < MODEL_MIN_SAMPLES:
+                    error_rate, p95 = 0.0, 0
+                else:
+                    error_rate, p95 = health.error_rate(now), health.percentile(95, now) or 0
+                key = (1 if self._cooling_down(health, now) else 0,
+                       round(error_rate, 1),
+                       int(p95 // MODEL_LATENCY_BUCKET),
+                       index)
+                ranked.append((key, model_name))
+        return [model_name for key, model_name in sorted(ranked)]
+    
+    def snapshot(self):
+        """Per-model stats for the health endpoint."""
+        now = time.monotonic()
+        with self.lock:
+            stats = {}
+            for model_name, health in self.models.items():
+                p50 = health.percentile(50, now)
+                p95 = health.percentile(95, now)
+                stats[model_name] = {
+                    "state": health.state,
+                    "recent_calls": len(health.recent(now)),
+                    "error_rate": round(health.error_rate(now), 3),
+                    "p50_latency": round(p50, 3) if p50 is not None else None,
+                    "p95_latency": round(p95, 3) if p95 is not None else None,
+                    "consecutive_failures": health.consecutive_failures
+                }
+            return stats
+
+model_health = ModelHealthRegistry()
+
+def _with_model_health(attempt):
+    """Wrap attempt(model_name) so each call is gated by its circuit and its outcome recorded."""
+    def tracked_attempt(model_name):
+        if not model_health.acquire(model_name):
+            raise RuntimeError("circuit open")
+        started = time.monotonic()
+        try:
+            result = attempt(model_name)
+        except Exception:
+            model_health.record_failure(model_name)
+            raise
+        if result is None:
+            model_health.record_failure(model_name)
+        else:
+            model_health.record_success(model_name, time.monotonic() - started)
+        return result
+    return tracked_attempt
+
+# Starter-question generation prefers a small fast model, then the chat models
+SUGGESTION_MODELS = ["google/gemini-2.0-flash-001:free"] + FREE_MODELS
+SUGGESTION_TIMEOUT = 7
+
+# Shared generation settings for chat completions
+CHAT_COMPLETION_PARAMS = {
+    "temperature": 0.7,
+    "max_tokens": 500,
+    "top_p": 0.95
+}
+
+# Hedged fallback: if the current model has not answered after LLM_HEDGE_DELAY seconds
+# (or fails), the next model is started concurrently and the first valid reply wins
+LLM_REQUEST_TIMEOUT = float(os.getenv("LLM_REQUEST_TIMEOUT", "15"))
+LLM_HEDGE_DELAY = float(os.getenv("LLM_HEDGE_DELAY", "3"))
+LLM_DEADLINE_GRACE = 2
+llm_executor = ThreadPoolExecutor(max_workers=int(os.getenv("LLM_MAX_WORKERS", "16")), thread_name_prefix="llm")
+
+# Streamed text is held back from the client once a control tag starts
+# ([APPOINTMENT_CONFIRMED], [REQUEST_HUMAN_HANDOFF], <think>) or may be starting
+STREAM_TAG_RE = re.compile(r'\[[A-Z/]|<think>')
+STREAM_PARTIAL_TAG_RE = re.compile(r'(\[|<[a-z]{0,5})$')
+
+def _openrouter_headers(chatbot):
+    """Build OpenRouter request headers for a chatbot."""
+    api_key = os.getenv("OPENROUTER_API_KEY", "").strip()
+    return {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json",
+        "HTTP-Referer": deployment_url,
+        "X-Title": chatbot.business_name.encode('ascii', 'ignore').decode('ascii').strip() or "Business Assistant Bot"
+    }
+
+def _clean_model_reply(raw_reply):
+    """Strip <think> tags from reasoning models (safety net)."""
+    if raw_reply and "<think>" in raw_reply:
+        raw_reply = re.sub(r"<think>.*?</think>", "", raw_reply, flags=re.DOTALL).strip()
+    return raw_reply
+
+def _hedged_call(attempt, candidates, hedge_delay=None, timeout=LLM_REQUEST_TIMEOUT, discard=None):
+    """
+    Hedged fan-out over fallback candidates.
+    Starts attempt(candidates[0]); whenever hedge_delay passes without a winner, or an
+    attempt fails, the next candidate is started concurrently. The first attempt that
+    returns a non-None result wins. Returns (candidate, result, last_error); candidate
+    and result are None if nothing succeeded within roughly one timeout.
+    Attempts still running when a winner is chosen are cancelled if queued, otherwise
+    their late results are handed to discard() so resources can be released.
+    """
+    if hedge_delay is None:
+        hedge_delay = LLM_HEDGE_DELAY
+    remaining = list(candidates)
+    pending = {}
+    last_error = None
+    winner = (None, None)
+    deadline = time.monotonic() + timeout + LLM_DEADLINE_GRACE
+    next_hedge_at = 0
+    
+    def launch():
+        nonlocal next_hedge_at
+        candidate = remaining.pop(0)
+        pending[llm_executor.submit(attempt, candidate)] = candidate
+        next_hedge_at = time.monotonic() + hedge_delay
+    
+    launch()
+    while pending and winner[0] is None:
+        now = time.monotonic()
+        if now >= deadline:
+            last_error = last_error or f"timed out after {timeout}s"
+            break
+        wait_for = deadline - now
+        if remaining:
+            wait_for = min(wait_for, max(next_hedge_at - now, 0))
+        done, _ = wait(list(pending), timeout=wait_for, return_when=FIRST_COMPLETED)
         
-        session_id = f"{config_id}_{chat_key}"
-        print(f"DEBUG: Session ID: {session_id}, new_key={is_new_key}")
+        failed = False
+        for future in done:
+            candidate = pending.pop(future)
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"DEBUG HEDGE: {candidate} failed: {e}")
+                last_error = f"{candidate}: {e}"
+                failed = True
+                continue
+            if result is None:
+                last_error = f"{candidate}: empty response"
+                failed = True
+            elif winner[0] is None:
+                winner = (candidate, result)
+            elif discard:
+                discard(result)
         
-        # Get or create conversation in database
-        conversation = Conversation.query.filter_by(session_id=session_id).first()
-        is_new_session = False
-        if not conversation:
-            is_new_session = True
-            conversation = Conversation(
-                session_id=session_id,
-                config_id=config_id,
-                history=json.dumps([{"role": "system", "content": system_prompt}])
-            )
-            db.session.add(conversation)
-            db.session.commit()
-            
-            # Send Telegram notification for new chat session
-            print(f"DEBUG: New session! token={bool(chatbot.telegram_bot_token)}, chat_id={bool(chatbot.telegram_chat_id)}")
-            if chatbot.telegram_bot_token and chatbot.telegram_chat_id:
-                short_id = chat_key
-                msg = (f"\U0001f514 <b>New Chat Started!</b>\n"
-                       f"Business: {chatbot.business_name}\n"
-                       f"Chat ID: <code>{short_id}</code>")
-                result = send_telegram_notification(
-                    chatbot.telegram_bot_token,
-                    chatbot.telegram_chat_id,
-                    msg
-                )
-                print(f"DEBUG: Telegram send result: {result}")
-            else:
-                print(f"DEBUG: Telegram not configured. token='{chatbot.telegram_bot_token}', chat_id='{chatbot.telegram_chat_id}'")
+        if winner[0] is None and remaining and (failed or not pending or time.monotonic() >= next_hedge_at):
+            if not failed:
+                print(f"DEBUG HEDGE: No reply after {hedge_delay}s, hedging with {remaining[0]}")
+            launch()
+    
+    def release_late_result(future):
+        if future.exception() is None and future.result() is not None:
+            discard(future.result())
+    
+    # Cancel the losers: queued attempts never start, running ones are discarded when done
+    for future in pending:
+        if not future.cancel() and discard:
+            future.add_done_callback(release_late_result)
+    
+    return winner[0], winner[1], last_error
+
+def _request_model_completion(model_name, api_messages, api_headers, params=CHAT_COMPLETION_PARAMS, timeout=LLM_REQUEST_TIMEOUT):
+    """Call one model; returns its cleaned reply, None if empty, or raises on HTTP errors."""
+    payload = dict(params, model=model_name, messages=api_messages)
+    
+    print(f"DEBUG: Trying model: {model_name}")
+    response = openrouter_http.post(OPENROUTER_CHAT_URL, headers=api_headers, json=payload, timeout=timeout)
+    print(f"DEBUG: {model_name} -> Status {response.status_code}")
+    
+    if response.status_code != 200:
+        print(f"DEBUG: {model_name} error: {response.text[:200]}")
+        raise RuntimeError(f"HTTP {response.status_code}")
+    
+    choices = response.json().get("choices", [])
+    if not choices:
+        return None
+    
+    raw_reply = _clean_model_reply(choices[0]["message"]["content"])
+    return raw_reply or None
+
+def _request_chat_completion(api_messages, api_headers):
+    """
+    Get a reply using hedged requests across FREE_MODELS, healthiest models first.
+    Returns (assistant_message, last_error); assistant_message is None if all failed.
+    """
+    model_name, assistant_message, last_error = _hedged_call(
+        _with_model_health(lambda model: _request_model_completion(model, api_messages, api_headers)),
+        model_health.ordered(FREE_MODELS)
+    )
+    if assistant_message:
+        print(f"DEBUG: Got response from {model_name} ({len(assistant_message)} chars)")
+    return assistant_message, last_error
+
+def _iter_openrouter_stream(response):
+    """Yield content deltas from an OpenRouter `stream: true` SSE response."""
+    response.encoding = 'utf-8'
+    for line in response.iter_lines(decode_unicode=True):
+        # Skip keep-alive comments (": OPENROUTER PROCESSING") and blank separators
+        if not line or not line.startswith('data:'):
+            continue
+        data = line[5:].strip()
+        if data == '[DONE]':
+            break
+        try:
+            chunk = json.loads(data)
+        except ValueError:
+            continue
+        choices = chunk.get("choices") or []
+        if not choices:
+            continue
+        delta = (choices[0].get("delta") or {}).get("content")
+        if delta:
+            yield delta
+
+def _open_model_stream(model_name, api_messages, api_headers):
+    """
+    Open a streaming completion and wait for its first content delta.
+    Returns (response, first_delta, deltas), or None if the model produced nothing.
+    """
+    payload = dict(CHAT_COMPLETION_PARAMS, model=model_name, messages=api_messages, stream=True)
+    
+    print(f"DEBUG STREAM: Trying model: {model_name}")
+    response = openrouter_http.post(OPENROUTER_CHAT_URL, headers=api_headers, json=payload, timeout=LLM_REQUEST_TIMEOUT, stream=True)
+    try:
+        if response.status_code != 200:
+            print(f"DEBUG STREAM: {model_name} error: {response.status_code} {response.text[:200]}")
+            raise RuntimeError(f"HTTP {response.status_code}")
+        deltas = _iter_openrouter_stream(response)
+        first_delta = next(deltas, None)
+    except Exception:
+        response.close()
+        raise
+    if first_delta is None:
+        response.close()
+        return None
+    return response, first_delta, deltas
+
+def _stream_chat_completion(api_messages, api_headers):
+    """
+    Stream content deltas from whichever model in FREE_MODELS produces a first token
+    soonest, using the same hedging as non-streaming requests.
+    """
+    model_name, opened, last_error = _hedged_call(
+        _with_model_health(lambda model: _open_model_stream(model, api_messages, api_headers)),
+        model_health.ordered(FREE_MODELS),
+        discard=lambda late: late[0].close()
+    )
+    if not opened:
+        raise RuntimeError(f"All models failed. Last error: {last_error}")
+    
+    response, first_delta, deltas = opened
+    print(f"DEBUG STREAM: Streaming from {model_name}")
+    try:
+        yield first_delta
+        yield from deltas
+    finally:
+        response.close()
+
+def _sse_event(event, data):
+    """Format a single Server-Sent Event with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def _start_chat_turn(data):
+    """
+    Validate a chat request, load or create its conversation and record the user message.
+    Returns (turn, None) when the model should be called, or (None, (payload, status))
+    when the request is answered without the model (errors, active or pending handoff, cached answers).
+    """
+    user_message = (data.get('message') or '').strip()
+    config_id = data.get('config_id')
+    chat_key = data.get('chat_key')  # Unique key from frontend localStorage
+    appointment_booked = False
+    
+    if not user_message:
+        return None, ({"error": "Message cannot be empty"}, 400)
+    
+    if not config_id:
+        return None, ({"error": "Config ID is required"}, 400)
+    
+    # Check if configuration exists
+    chatbot = get_config_snapshot(config_id)
+    if not chatbot:
+        print(f"DEBUG: Chatbot config not found for {config_id}")
+        return None, ({"error": "Business configuration not found"}, 404)
+    
+    # Use chat_key from frontend if provided, otherwise generate one
+    is_new_key = False
+    if not chat_key:
+        chat_key = uuid.uuid4().hex[:16]
+        is_new_key = True
+    
+    session_id = f"{config_id}_{chat_key}"
+    print(f"DEBUG: Session ID: {session_id}, new_key={is_new_key}")
+    
+    # Get or create conversation in database
+    conversation = Conversation.query.filter_by(session_id=session_id).first()
+    if not conversation:
+        conversation = Conversation(
+            session_id=session_id,
+            config_id=config_id,
+            prompt_version_id=current_prompt_version_id(chatbot)
+        )
+        db.session.add(conversation)
         
-        # 1. TUNNELING: If handoff is ACTIVE, route message to Telegram owner
-        if conversation.handoff_status == 'ACTIVE':
-            # Find the request ID to allow targeted replies
-            handoff_req = HandoffRequest.query.filter_by(session_id=session_id).order_by(HandoffRequest.id.desc()).first()
-            req_id = handoff_req.id if handoff_req else "0"
-            
-            reply_markup = {
-                "inline_keyboard": [[
-                    {"text": "💬 Reply", "switch_inline_query_current_chat": f"/r {req_id} "},
-                    {"text": "🔒 End", "callback_data": f"ho_end_{req_id}"}
-                ]]
-            }
-            
-            msg = f"👤 <b>User:</b> {user_message}\n\n#id_{req_id}"
-            send_telegram_notification(
+        # Queue Telegram notification for new chat session (delivered after commit)
+        print(f"DEBUG: New session! token={bool(chatbot.telegram_bot_token)}, chat_id={bool(chatbot.telegram_chat_id)}")
+        if chatbot.telegram_bot_token and chatbot.telegram_chat_id:
+            short_id = chat_key
+            msg = (f"\U0001f514 <b>New Chat Started!</b>\n"
+                   f"Business: {chatbot.business_name}\n"
+                   f"Chat ID: <code>{short_id}</code>")
+            enqueue_telegram_message(
                 chatbot.telegram_bot_token,
                 chatbot.telegram_chat_id,
-                msg,
-                reply_markup=reply_markup
+                msg
             )
-            
-            conversation.add_message("user", user_message)
-            conversation.agent_response_pending = True
-            db.session.commit()
-            
-            return jsonify({
-                "response": None, 
-                "handoff_active": True,
-                "session_id": session_id
-            })
-
-        # 2. PENDING HANDOFF: If waiting for agent, intercept and notify user
-        if conversation.handoff_status == 'PENDING':
-            response_text = "Still connecting... Please wait while we find a human agent. Stay connected!"
-            conversation.add_message("user", user_message)
-            # We don't save the assistant message here to avoid cluttering human chat
-            db.session.commit()
-            return jsonify({
-                "response": response_text,
-                "handoff_pending": True,
-                "session_id": session_id
-            })
-
-        # Add user message to conversation history
-        conversation.add_message("user", user_message)
+        else:
+            print(f"DEBUG: Telegram not configured. token='{chatbot.telegram_bot_token}', chat_id='{chatbot.telegram_chat_id}'")
+        db.session.commit()
+    
+    # 1. TUNNELING: If handoff is ACTIVE, route message to Telegram owner
+    if conversation.handoff_status == 'ACTIVE':
+        # Find the request ID to allow targeted replies
+        handoff_req = HandoffRequest.query.filter_by(session_id=session_id).order_by(HandoffRequest.id.desc()).first()
+        req_id = handoff_req.id if handoff_req else "0"
         
-        # Get conversation messages for API call (system prompt + last few messages)
-        messages = conversation.get_last_messages(count=10, include_system=True)
-        
-        # Send messages as-is — system role is supported by selected models
-        api_messages = [dict(m) for m in messages]
-        
-        # --- Inject appointment status if user is asking ---
-        # Check the last user message for status-related keywords
-        status_keywords = ['status', 'appointment', 'booking', 'booked', 'confirmed', 'approved', 'declined']
-        user_lower = user_message.lower()
-        if any(kw in user_lower for kw in status_keywords):
-            # Look up appointments for this chat_key
-            user_appointments = Appointment.query.filter_by(
-                config_id=config_id, chat_key=chat_key
-            ).order_by(Appointment.created_at.desc()).all()
-            
-            if user_appointments:
-                status_info = "\n\nCURRENT APPOINTMENT STATUS FOR THIS CUSTOMER:\n"
-                for apt in user_appointments:
-                    status_emoji = {'pending': '🟡', 'approved': '✅', 'declined': '❌'}.get(apt.status, '⚪')
-                    status_info += (f"- Appointment #{apt.id}: {status_emoji} {apt.status.upper()}\n"
-                                    f"  Name: {apt.customer_name}, Time: {apt.preferred_time}\n")
-                    if apt.status == 'approved':
-                        appointment_booked = True
-                status_info += "\nPlease share this status with the customer in a friendly way."
-                # Append to the last system-like context
-                api_messages.append({"role": "system", "content": status_info})
-        
-        # Fast models with native system role support
-        FREE_MODELS = [
-            "stepfun/step-3.5-flash:free",            # Primary: CONFIRMED WORKING
-            "meta-llama/llama-3.3-70b-instruct:free", # High quality fallback
-            "qwen/qwen-2.5-72b-instruct:free",       # Strong multilingual
-            "mistralai/mistral-small-3.1-24b-instruct:free",  # Fast fallback
-        ]
-        
-        # OpenRouter API configuration
-        api_url = "https://openrouter.ai/api/v1/chat/completions"
-        api_key = os.getenv("OPENROUTER_API_KEY", "").strip()
-        api_headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json",
-            "HTTP-Referer": deployment_url,
-            "X-Title": chatbot.business_name.encode('ascii', 'ignore').decode('ascii').strip() or "Business Assistant Bot"
+        reply_markup = {
+            "inline_keyboard": [[
+                {"text": "💬 Reply", "switch_inline_query_current_chat": f"/r {req_id} "},
+                {"text": "🔒 End", "callback_data": f"ho_end_{req_id}"}
+            ]]
         }
         
-        assistant_message = None
-        last_error = None
+        msg = f"👤 <b>User:</b> {user_message}\n\n#id_{req_id}"
+        enqueue_telegram_message(
+            chatbot.telegram_bot_token,
+            chatbot.telegram_chat_id,
+            msg,
+            reply_markup=reply_markup
+        )
         
-        for model_name in FREE_MODELS:
-            try:
-                payload = {
-                    "model": model_name,
-                    "messages": api_messages,
-                    "temperature": 0.7,
-                    "max_tokens": 500,
-                    "top_p": 0.95
-                }
-                
-                print(f"DEBUG: Trying model: {model_name}")
-                response = requests.post(api_url, headers=api_headers, json=payload, timeout=15)
-                print(f"DEBUG: {model_name} -> Status {response.status_code}")
-                
-                if response.status_code != 200:
-                    print(f"DEBUG: {model_name} error: {response.text[:200]}")
-                    last_error = f"{model_name}: {response.status_code}"
-                    continue
-                
-                response_data = response.json()
-                choices = response_data.get("choices", [])
-                if not choices:
-                    last_error = f"{model_name}: empty response"
-                    continue
-                
-                raw_reply = choices[0]["message"]["content"]
-                
-                # Strip <think> tags from reasoning models (safety net)
-                if "<think>" in raw_reply:
-                    raw_reply = re.sub(r"<think>.*?</think>", "", raw_reply, flags=re.DOTALL).strip()
-                
-                if raw_reply:
-                    assistant_message = raw_reply
-                    print(f"DEBUG: Got response from {model_name} ({len(assistant_message)} chars)")
-                    break
-                else:
-                    last_error = f"{model_name}: empty after cleanup"
-                    continue
-                    
-            except Exception as e:
-                print(f"DEBUG: {model_name} exception: {str(e)}")
-                last_error = str(e)
-                continue
+        conversation.add_message("user", user_message)
+        conversation.agent_response_pending = True
+        db.session.commit()
         
-        if not assistant_message:
-            return jsonify({"error": f"All models failed. Last error: {last_error}"}), 500
+        return None, ({
+            "response": None, 
+            "handoff_active": True,
+            "session_id": session_id
+        }, 200)
+
+    # 2. PENDING HANDOFF: If waiting for agent, intercept and notify user
+    if conversation.handoff_status == 'PENDING':
+        response_text = "Still connecting... Please wait while we find a human agent. Stay connected!"
+        conversation.add_message("user", user_message)
+        # We don't save the assistant message here to avoid cluttering human chat
+        db.session.commit()
+        return None, ({
+            "response": response_text,
+            "handoff_pending": True,
+            "session_id": session_id
+        }, 200)
+
+    # 2. ANSWER CACHE: repeated FAQ-style questions are answered without the model
+    last = conversation.last_message()
+    opening_question = last is None or last["role"] == "system"
+    cached_answer = lookup_cached_answer(chatbot, conversation, user_message)
+    if cached_answer:
+        conversation.add_message("user", user_message)
+        conversation.add_message("assistant", cached_answer)
+        db.session.commit()
+        return None, ({
+            "response": cached_answer,
+            "message_id": conversation.last_message_id(),
+            "chat_key": chat_key,
+            "appointment_booked": appointment_booked,
+            "handoff_pending": False,
+            "cached": True
+        }, 200)
+    
+    # Add user message to conversation history
+    conversation.add_message("user", user_message)
+    
+    # --- Knowledge and appointment notes sent alongside the history ---
+    notes = []
+    # FAQs and business details relevant to this message
+    knowledge = knowledge_prompt(chatbot, user_message)
+    if knowledge:
+        notes.append({"role": "system", "content": knowledge})
+    # Upcoming booked slots (bounded, fresh on every turn)
+    if chatbot.appointment_enabled:
+        notes.append({"role": "system", "content": availability_prompt(config_id)})
+    
+    # Appointment status if the user is asking
+    status_note = None
+    # Check the last user message for status-related keywords
+    status_keywords = ['status', 'appointment', 'booking', 'booked', 'confirmed', 'approved', 'declined']
+    user_lower = user_message.lower()
+    if any(kw in user_lower for kw in status_keywords):
+        # Look up appointments for this chat_key
+        user_appointments = Appointment.query.filter_by(
+            config_id=config_id, chat_key=chat_key
+        ).order_by(Appointment.created_at.desc()).all()
         
-        # --- Parse appointment tags from AI response ---
-        visible_response = assistant_message
-        
-        # Check for [APPOINTMENT_CONFIRMED] tag
-        apt_match = re.search(
-            r'\[APPOINTMENT_CONFIRMED\]\s*'
-            r'Name:\s*(.+?)\s*'
-            r'Email:\s*(.+?)\s*'
-            r'Mobile:\s*(.+?)\s*'
-            r'Time:\s*(.+?)\s*'
-            r'Message:\s*(.+?)\s*'
-            r'\[/APPOINTMENT_CONFIRMED\]',
-            assistant_message, re.DOTALL
-        )
+        if user_appointments:
+            status_info = "\n\nCURRENT APPOINTMENT STATUS FOR THIS CUSTOMER:\n"
+            for apt in user_appointments:
+                status_emoji = {'pending': '🟡', 'approved': '✅', 'declined': '❌'}.get(apt.status, '⚪')
+                status_info += (f"- Appointment #{apt.id}: {status_emoji} {apt.status.upper()}\n"
+                                f"  Name: {apt.customer_name}, Time: {apt.preferred_time}\n")
+                if apt.status == 'approved':
+                    appointment_booked = True
+            status_info += "\nPlease share this status with the customer in a friendly way."
+            status_note = {"role": "system", "content": status_info}
+    
+    # Get conversation messages for API call: system prompt, rolling summary and the newest
+    # messages that fit in the token budget left over by the notes
+    budget = context_token_budget(FREE_MODELS) - sum(estimate_message_tokens(n) for n in notes + [status_note] if n)
+    messages = conversation.get_context_messages(budget)
+    
+    # Send messages as-is — system role is supported by selected models
+    api_messages = [dict(m) for m in messages]
+    at = 1 if api_messages and api_messages[0]["role"] == "system" else 0
+    api_messages[at:at] = notes
+    if status_note:
+        # Append to the last system-like context
+        api_messages.append(status_note)
+    
+    turn = {
+        "chatbot": chatbot,
+        "conversation": conversation,
+        "config_id": config_id,
+        "chat_key": chat_key,
+        "session_id": session_id,
+        "api_messages": api_messages,
+        "api_headers": _openrouter_headers(chatbot),
+        # Only a conversation's first question is free of earlier context, so only its answer is reusable
+        "cache_question": user_message if opening_question and not answer_cache_bypass_reason(chatbot, conversation, user_message) else None,
+        "appointment_booked": appointment_booked
+    }
+    return turn, None
+
+def _finish_chat_turn(turn, assistant_message):
+    """
+    Parse control tags out of the assembled model reply, book appointments, trigger
+    handoffs and save the visible reply. Returns the JSON payload for the client.
+    """
+    chatbot = turn["chatbot"]
+    conversation = turn["conversation"]
+    config_id = turn["config_id"]
+    chat_key = turn["chat_key"]
+    session_id = turn["session_id"]
+    appointment_booked = turn["appointment_booked"]
+    
+    # --- Parse appointment tags from AI response ---
+    visible_response = assistant_message
+    
+    # Check for [APPOINTMENT_CONFIRMED] tag
+    apt_match = re.search(
+        r'\[APPOINTMENT_CONFIRMED\]\s*'
+        r'Name:\s*(.+?)\s*'
+        r'Email:\s*(.+?)\s*'
+        r'Mobile:\s*(.+?)\s*'
+        r'Time:\s*(.+?)\s*'
+        r'Message:\s*(.+?)\s*'
+        r'\[/APPOINTMENT_CONFIRMED\]',
+        assistant_message, re.DOTALL
+    )
+    
+    if apt_match:
+        print(f"DEBUG: Appointment detected!")
+        preferred_time = apt_match.group(4).strip()
         
-        if apt_match:
-            print(f"DEBUG: Appointment detected!")
-            preferred_time = apt_match.group(4).strip()
-            
-            # 1. Validate strict date format
-            requested_dt = validate_strict_date(preferred_time)
+        # 1. Validate strict date format
+        requested_dt = validate_strict_date(preferred_time)
+        
+        if not requested_dt:
+            print(f"DEBUG: Invalid date format: '{preferred_time}'")
+            # Strip the tag block and add error message
+            visible_response = re.sub(r'\[APPOINTMENT_CONFIRMED\].*?\[/APPOINTMENT_CONFIRMED\]', '', visible_response, flags=re.DOTALL).strip()
+            visible_response += (
+                f"\n\n⚠️ **I need the date in a specific format!**\n"
+                f"Please provide it like: `12 Feb 2026, 4:00 PM`. I can't book with vague times like '{preferred_time}'."
+            )
+        else:
+            # 2. Check business hours
+            is_valid_hours, hours_error = check_business_hours(requested_dt, chatbot.appointment_hours)
             
-            if not requested_dt:
-                print(f"DEBUG: Invalid date format: '{preferred_time}'")
-                # Strip the tag block and add error message
+            if not is_valid_hours:
+                print(f"DEBUG: Outside business hours: {hours_error}")
                 visible_response = re.sub(r'\[APPOINTMENT_CONFIRMED\].*?\[/APPOINTMENT_CONFIRMED\]', '', visible_response, flags=re.DOTALL).strip()
-                visible_response += (
-                    f"\n\n⚠️ **I need the date in a specific format!**\n"
-                    f"Please provide it like: `12 Feb 2026, 4:00 PM`. I can't book with vague times like '{preferred_time}'."
-                )
+                visible_response += f"\n\n⚠️ **That time is outside our booking hours.**\n{hours_error} Please choose another slot!"
             else:
-                # 2. Check business hours
-                is_valid_hours, hours_error = check_business_hours(requested_dt, chatbot.appointment_hours)
+                # 3. Book the slot; the unique slot index rejects a conflicting booking
+                new_apt = Appointment(
+                    config_id=config_id,
+                    chat_key=chat_key,
+                    customer_name=apt_match.group(1).strip(),
+                    customer_email=apt_match.group(2).strip(),
+                    customer_mobile=apt_match.group(3).strip(),
+                    preferred_time=preferred_time,
+                    slot_start=requested_dt,
+                    message=apt_match.group(5).strip(),
+                    status='pending'
+                )
                 
-                if not is_valid_hours:
-                    print(f"DEBUG: Outside business hours: {hours_error}")
-                    visible_response = re.sub(r'\[APPOINTMENT_CONFIRMED\].*?\[/APPOINTMENT_CONFIRMED\]', '', visible_response, flags=re.DOTALL).strip()
-                    visible_response += f"\n\n⚠️ **That time is outside our booking hours.**\n{hours_error} Please choose another slot!"
+                if not book_appointment_slot(new_apt):
+                    # Conflict found — don't save, warn the user
+                    print(f"DEBUG: Time conflict! Slot '{preferred_time}' already booked")
+                    # Strip the tag block
+                    visible_response = re.sub(
+                        r'\[APPOINTMENT_CONFIRMED\].*?\[/APPOINTMENT_CONFIRMED\]',
+                        '', visible_response, flags=re.DOTALL
+                    ).strip()
+                    # Add conflict message
+                    visible_response += (
+                        f"\n\n⚠️ **Sorry, the slot for {preferred_time} is already booked!**\n"
+                        f"Please choose a different date or time and I'll book it for you."
+                    )
                 else:
-                    # 3. Check for date/time conflict
-                    # For conflict check, we compare as strings in the DB for now, but we search for this EXACT time
-                    existing_apt = Appointment.query.filter_by(
-                        config_id=config_id,
-                        preferred_time=preferred_time
-                    ).filter(Appointment.status.in_(['pending', 'approved'])).first()
-                    
-                    if existing_apt:
-                        # Conflict found — don't save, warn the user
-                        print(f"DEBUG: Time conflict! Slot '{preferred_time}' already booked (apt #{existing_apt.id})")
-                        # Strip the tag block
-                        visible_response = re.sub(
-                            r'\[APPOINTMENT_CONFIRMED\].*?\[/APPOINTMENT_CONFIRMED\]',
-                            '', visible_response, flags=re.DOTALL
-                        ).strip()
-                        # Add conflict message
-                        visible_response += (
-                            f"\n\n⚠️ **Sorry, the slot for {preferred_time} is already booked!**\n"
-                            f"Please choose a different date or time and I'll book it for you."
-                        )
-                    else:
-                        # No conflict — save the appointment
-                        try:
-                            new_apt = Appointment(
-                                config_id=config_id,
-                                chat_key=chat_key,
-                                customer_name=apt_match.group(1).strip(),
-                                customer_email=apt_match.group(2).strip(),
-                                customer_mobile=apt_match.group(3).strip(),
-                                preferred_time=preferred_time,
-                                message=apt_match.group(5).strip(),
-                                status='pending'
-                            )
-                            db.session.add(new_apt)
-                            db.session.commit()
-                            appointment_booked = True
-                            print(f"DEBUG: Appointment #{new_apt.id} saved")
-                            
-                            # Send to Telegram with inline buttons
-                            send_appointment_to_telegram(chatbot, new_apt)
-                        except Exception as e:
-                            print(f"DEBUG: Error saving appointment: {e}")
-                            db.session.rollback()
-            
-        # Strip the tag block from visible response (safety cleanup)
-        visible_response = re.sub(
-            r'\[APPOINTMENT_CONFIRMED\].*?\[/APPOINTMENT_CONFIRMED\]',
-            '', visible_response, flags=re.DOTALL
-        ).strip()
-        
-        # Cleanup extra newlines for tighter formatting (UX improvement)
-        visible_response = re.sub(r'\n{3,}', '\n\n', visible_response)
-        
-        # Check for [CHECK_STATUS] tag
-        if '[CHECK_STATUS]' in visible_response:
-            visible_response = visible_response.replace('[CHECK_STATUS]', '').strip()
-            
-        # Robust [REQUEST_HUMAN_HANDOFF] scrubbing (catches partials too)
-        handoff_triggered = False
-        if "[REQUEST_HUMAN" in assistant_message or "[REQUEST_HUMAN_HANDOFF]" in assistant_message:
-            visible_response = re.sub(r'\[REQUEST_HUMAN(_HANDOFF)?\]?', '', visible_response).strip()
-            
-            # Record that we should trigger handoff
-            handoff_triggered = True
-            
-            # ONLY append the connecting notice if not already pending/active AND not already in response
-            if conversation.handoff_status not in ['PENDING', 'ACTIVE']:
-                notice = "Stay connected, we are connecting you with a human agent. Please wait (2 min timer started)."
-                if not visible_response or visible_response.strip() == "":
-                    visible_response = notice
-                elif notice not in visible_response:
-                    visible_response = f"{visible_response}\n\n{notice}"
-
-        # Add assistant response to conversation history (save what the user saw)
-        # Use deduplicate=True to catch rapid echoes
-        conversation.add_message("assistant", visible_response, deduplicate=True)
-        
-        if handoff_triggered:
-            # ONLY trigger if not already pending/active (idempotency)
-            if conversation.handoff_status not in ['PENDING', 'ACTIVE']:
-                send_handoff_request_to_telegram(chatbot, session_id)
-                conversation.handoff_status = 'PENDING'
-                print(f"DEBUG: Human handoff triggered for session {chat_key}")
-            else:
-                print(f"DEBUG: Handoff already {conversation.handoff_status} for {chat_key}, skipping duplicate trigger")
+                    # No conflict — the appointment and its Telegram notification (inline
+                    # buttons) are committed with the rest of the turn below
+                    appointment_booked = True
+                    print(f"DEBUG: Appointment #{new_apt.id} booked")
+                    send_appointment_to_telegram(chatbot, new_apt)
+        
+    # Strip the tag block from visible response (safety cleanup)
+    visible_response = re.sub(
+        r'\[APPOINTMENT_CONFIRMED\].*?\[/APPOINTMENT_CONFIRMED\]',
+        '', visible_response, flags=re.DOTALL
+    ).strip()
+    
+    # Cleanup extra newlines for tighter formatting (UX improvement)
+    visible_response = re.sub(r'\n{3,}', '\n\n', visible_response)
+    
+    # Check for [CHECK_STATUS] tag
+    if '[CHECK_STATUS]' in visible_response:
+        visible_response = visible_response.replace('[CHECK_STATUS]', '').strip()
+        
+    # Robust [REQUEST_HUMAN_HANDOFF] scrubbing (catches partials too)
+    handoff_triggered = False
+    if "[REQUEST_HUMAN" in assistant_message or "[REQUEST_HUMAN_HANDOFF]" in assistant_message:
+        visible_response = re.sub(r'\[REQUEST_HUMAN(_HANDOFF)?\]?', '', visible_response).strip()
+        
+        # Record that we should trigger handoff
+        handoff_triggered = True
+        
+        # ONLY append the connecting notice if not already pending/active AND not already in response
+        if conversation.handoff_status not in ['PENDING', 'ACTIVE']:
+            notice = "Stay connected, we are connecting you with a human agent. Please wait (2 min timer started)."
+            if not visible_response or visible_response.strip() == "":
+                visible_response = notice
+            elif notice not in visible_response:
+                visible_response = f"{visible_response}\n\n{notice}"
 
-        # Save conversation to database
-        db.session.commit()
+    # Add assistant response to conversation history (save what the user saw)
+    # Use deduplicate=True to catch rapid echoes
+    conversation.add_message("assistant", visible_response, deduplicate=True)
+    
+    if handoff_triggered:
+        # ONLY trigger if not already pending/active (idempotency)
+        if conversation.handoff_status not in ['PENDING', 'ACTIVE']:
+            send_handoff_request_to_telegram(chatbot, session_id)
+            conversation.handoff_status = 'PENDING'
+            print(f"DEBUG: Human handoff triggered for session {chat_key}")
+        else:
+            print(f"DEBUG: Handoff already {conversation.handoff_status} for {chat_key}, skipping duplicate trigger")
+
+    # Save conversation to database
+    db.session.commit()
+    
+    if turn["cache_question"] and visible_response == assistant_message.strip() and not appointment_booked:
+        # A plain reply (no control tags) to a standalone question can serve the next asker
+        learn_cached_answer(chatbot, turn["cache_question"], visible_response)
+    
+    return {
+        "response": visible_response,  # Clean response without tags
+        "message_id": conversation.last_message_id(),  # Lets the widget skip it when polling history
+        "chat_key": chat_key,
+        "appointment_booked": appointment_booked,
+        "handoff_pending": handoff_triggered
+    }
+
+@app.route('/chat', methods=['POST'])
+def process_chat():
+    """Process chat messages from the frontend."""
+    try:
+        turn, early_reply = _start_chat_turn(request.json)
+        if early_reply:
+            payload, status = early_reply
+            return jsonify(payload), status
         
-        return jsonify({
-            "response": visible_response,  # Clean response without tags
-            "chat_key": chat_key,
-            "appointment_booked": appointment_booked,
-            "handoff_pending": handoff_triggered
-        })
+        assistant_message, last_error = _request_chat_completion(turn["api_messages"], turn["api_headers"])
+        if not assistant_message:
+            return jsonify({"error": f"All models failed. Last error: {last_error}"}), 500
+        
+        return jsonify(_finish_chat_turn(turn, assistant_message))
     
     except requests.exceptions.RequestException as e:
         return jsonify({"error": f"API request failed: {str(e)}"}), 500
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-@app.route('/chat/history')
-def chat_history():
-    """Return conversation history and current handoff status."""
-    config_id = request.args.get('config_id')
-    chat_key = request.args.get('chat_key')
-    session_id = request.args.get('session_id')
+@app.route('/chat/stream', methods=['POST'])
+def process_chat_stream():
+    """
+    Streaming variant of /chat. Relays model tokens as Server-Sent Events:
+    `token` events carry text deltas, a final `done` event carries the same payload
+    /chat returns (after tag parsing), and `error` reports a failure.
+    """
+    try:
+        turn, early_reply = _start_chat_turn(request.json or {})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+    
+    sse_headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    
+    if early_reply:
+        payload, status = early_reply
+        if status != 200:
+            return jsonify(payload), status
+        return Response(_sse_event("done", payload), mimetype='text/event-stream', headers=sse_headers)
+    
+    def generate():
+        assembled = ""
+        sent = 0
+        held = False
+        try:
+            for delta in _stream_chat_completion(turn["api_messages"], turn["api_headers"]):
+                assembled += delta
+                if held:
+                    continue
+                # Only forward text that cannot be part of a control tag
+                tag = STREAM_TAG_RE.search(assembled, sent)
+                if tag:
+                    safe_end = tag.start()
+                    held = True
+                else:
+                    partial = STREAM_PARTIAL_TAG_RE.search(assembled, sent)
+                    safe_end = partial.start() if partial else len(assembled)
+                if safe_end > sent:
+                    yield _sse_event("token", {"text": assembled[sent:safe_end]})
+                    sent = safe_end
+            
+            assistant_message = _clean_model_reply(assembled.strip())
+            if not assistant_message:
+                yield _sse_event("error", {"error": "Model returned an empty response"})
+                return
+            
+            yield _sse_event("done", _finish_chat_turn(turn, assistant_message))
+        except Exception as e:
+            print(f"DEBUG STREAM: Error: {e}")
+            db.session.rollback()
+            yield _sse_event("error", {"error": str(e)})
+    
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers=sse_headers)
+
+# Long-polling for /chat/history and the /chat/events stream: hold the request until something changes.
+# Each held request pins a Gunicorn thread, so the number held at once is capped per process;
+# above the cap, long-polls answer immediately with a retry_after hint.
+HISTORY_LONG_POLL_MAX = float(os.getenv("HISTORY_LONG_POLL_MAX", "25"))  # seconds
+HISTORY_LONG_POLL_MAX_WAITERS = int(os.getenv("HISTORY_LONG_POLL_MAX_WAITERS", "16"))
+HISTORY_BUSY_RETRY_AFTER = 5  # seconds a client backs off when the long-poll cap is reached
+HISTORY_RECHECK_INTERVAL = 5.0  # seconds between DB re-checks while waiting for a push event
+CHAT_EVENTS_MAX_DURATION = float(os.getenv("CHAT_EVENTS_MAX_DURATION", "55"))  # seconds before the client reconnects
+CHAT_EVENTS_MAX_STREAMS = int(os.getenv("CHAT_EVENTS_MAX_STREAMS", "24"))  # open streams per process; more get 503
+CHAT_EVENTS_KEEPALIVE = 15.0  # seconds between SSE keep-alive comments
+
+class HeldRequestLimit:
+    """Non-blocking per-process cap on requests that hold a thread while waiting (long-polls, streams)."""
+    def __init__(self, limit):
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.active = 0
     
+    def try_acquire(self):
+        with self.lock:
+            if self.active >= self.limit:
+                return False
+            self.active += 1
+            return True
+    
+    def release(self):
+        with self.lock:
+            self.active -= 1
+    
+    def stats(self):
+        return {"active": self.active, "limit": self.limit}
+
+history_waiters = HeldRequestLimit(HISTORY_LONG_POLL_MAX_WAITERS)
+event_streams = HeldRequestLimit(CHAT_EVENTS_MAX_STREAMS)
+
+def _conversation_state(conversation_id):
+    """Return (latest message id, handoff_status) using two indexed lookups, no history load."""
+    handoff_status = db.session.query(Conversation.handoff_status).filter_by(id=conversation_id).scalar()
+    last_id = db.session.query(func.max(Message.id)).filter_by(conversation_id=conversation_id).scalar()
+    return last_id or 0, handoff_status
+
+def _history_session_id(args):
+    session_id = args.get('session_id')
+    config_id = args.get('config_id')
+    chat_key = args.get('chat_key')
     if not session_id and (config_id and chat_key):
         session_id = f"{config_id}_{chat_key}"
-        
+    return session_id
+
+def _history_payload(conversation, cursor, since):
+    """Build the history response: user/assistant messages in (since, cursor] and current status."""
+    visible_rows = conversation.message_rows.filter(
+        Message.role.in_(("user", "assistant")),
+        Message.id <= cursor
+    )
+    if since is not None:
+        visible_rows = visible_rows.filter(Message.id > since)
+    visible_msgs = [dict(row.to_dict(), id=row.id) for row in visible_rows]
+    
+    return {
+        "messages": visible_msgs,
+        "handoff_status": conversation.handoff_status,
+        "agent_response_pending": conversation.agent_response_pending,
+        "cursor": max(cursor, since or 0)
+    }
+
+@app.route('/chat/history')
+def chat_history():
+    """
+    Return conversation history and current handoff status.
+    Optional params: `since` (cursor from a previous response) returns only newer messages;
+    `wait` (seconds, with `since`) long-polls until a newer message arrives or handoff_status
+    differs from `status` (the client's current view), or the timeout expires. When too many
+    long-polls are already waiting, it answers at once with `retry_after` (seconds).
+    """
+    session_id = _history_session_id(request.args)
+    since = request.args.get('since', type=int)
+    wait = min(max(request.args.get('wait', 0, type=float), 0), HISTORY_LONG_POLL_MAX)
+    
     if not session_id:
-        return jsonify({"messages": [], "handoff_status": None})
+        return jsonify({"messages": [], "handoff_status": None, "cursor": since or 0})
     
     conversation = Conversation.query.filter_by(session_id=session_id).first()
     if not conversation:
-        return jsonify({"messages": [], "handoff_status": None})
+        return jsonify({"messages": [], "handoff_status": None, "cursor": since or 0})
     
-    # Return user/assistant messages and current status
-    all_msgs = conversation.messages
-    visible_msgs = [m for m in all_msgs if m["role"] in ("user", "assistant")]
+    if conversation._migrate_legacy_history():
+        db.session.commit()
+    conversation_id = conversation.id
+    cursor, handoff_status = _conversation_state(conversation_id)
     
-    return jsonify({
-        "messages": visible_msgs,
-        "handoff_status": conversation.handoff_status,
-        "agent_response_pending": conversation.agent_response_pending
-    })
+    retry_after = None
+    if since is not None and wait > 0:
+        if not history_waiters.try_acquire():
+            retry_after = HISTORY_BUSY_RETRY_AFTER
+        else:
+            known_status = request.args.get('status', handoff_status or '') or None
+            deadline = time.monotonic() + wait
+            subscription = conversation_events.subscribe(session_id)
+            try:
+                while cursor <= since and handoff_status == known_status:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    # Release the DB connection while idle
+                    db.session.close()
+                    subscription.get(timeout=min(remaining, HISTORY_RECHECK_INTERVAL))
+                    cursor, handoff_status = _conversation_state(conversation_id)
+            finally:
+                subscription.close()
+                history_waiters.release()
+            conversation = db.session.get(Conversation, conversation_id)
+    
+    payload = _history_payload(conversation, cursor, since)
+    if retry_after:
+        payload["retry_after"] = retry_after
+    return jsonify(payload)
+
+@app.route('/chat/events')
+def chat_events():
+    """
+    Server-Sent Events stream of conversation updates for the chat widget.
+    Emits a `history` event (same payload as /chat/history with `since`) whenever a new message
+    arrives or the handoff status changes. The event id is the cursor, so a reconnecting
+    EventSource resumes from Last-Event-ID without missing or repeating messages. Answers 503
+    with Retry-After when CHAT_EVENTS_MAX_STREAMS streams are already open in this process.
+    """
+    session_id = _history_session_id(request.args)
+    since = request.headers.get('Last-Event-ID', type=int)
+    if since is None:
+        since = request.args.get('since', 0, type=int)
+    
+    conversation = Conversation.query.filter_by(session_id=session_id).first() if session_id else None
+    if not conversation:
+        return jsonify({"error": "Conversation not found"}), 404
+    conversation_id = conversation.id
+    if not event_streams.try_acquire():
+        return jsonify({"error": "Too many open event streams", "retry_after": HISTORY_BUSY_RETRY_AFTER}), 503, \
+            {'Retry-After': str(HISTORY_BUSY_RETRY_AFTER)}
+    
+    def generate():
+        cursor = since
+        known_status = request.args.get('status') or None
+        subscription = conversation_events.subscribe(session_id)
+        try:
+            yield "retry: 2000\n\n"
+            started = last_sent = time.monotonic()
+            while time.monotonic() - started < CHAT_EVENTS_MAX_DURATION:
+                latest, handoff_status = _conversation_state(conversation_id)
+                if latest > cursor or handoff_status != known_status:
+                    payload = _history_payload(db.session.get(Conversation, conversation_id), latest, cursor)
+                    cursor, known_status = payload["cursor"], handoff_status
+                    yield f"id: {cursor}\n" + _sse_event("history", payload)
+                    last_sent = time.monotonic()
+                elif time.monotonic() - last_sent >= CHAT_EVENTS_KEEPALIVE:
+                    yield ": keep-alive\n\n"
+                    last_sent = time.monotonic()
+                # Release the DB connection while idle
+                db.session.close()
+                subscription.get(timeout=HISTORY_RECHECK_INTERVAL)
+        finally:
+            subscription.close()
+    
+    sse_headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream', headers=sse_headers)
+    # Runs even if the client disconnects before the generator starts
+    response.call_on_close(event_streams.release)
+    return response
 
 @app.route('/reset/<config_id>', methods=['POST'])
 def reset_conversation(config_id):
@@ -1525,10 +3579,11 @@ def reset_conversation(config_id):
         
         if conversation:
             # Get the chatbot configuration
-            chatbot = BusinessConfig.query.filter_by(config_id=config_id).first()
+            chatbot = get_config_snapshot(config_id)
             if chatbot:
-                # Reset conversation to just the system prompt
-                conversation.messages = [{"role": "system", "content": chatbot.system_prompt}]
+                # Reset conversation to just the (current) system prompt
+                conversation.messages = []
+                conversation.prompt_version_id = current_prompt_version_id(chatbot)
                 db.session.commit()
             else:
                 # If chatbot doesn't exist, delete the conversation
@@ -1539,6 +3594,158 @@ def reset_conversation(config_id):
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+# ---- Telegram Update Router ----
+# Callback data and owner commands are parsed once into a TelegramCommand by precompiled
+# patterns and dispatched through lookup tables, instead of trying each regex in turn.
+# Callback data formats: apt_(approve|decline)_<config_id>_<apt_id>,
+# ho_(accept|decline|end)_<config_id>_<req_id>, and the short ho_end_<req_id> used by the
+# tunnel's End button. Commands: /r <req_id> <text> and /end <req_id>, optionally after an @mention.
+CALLBACK_DATA_RE = re.compile(r'(apt|ho)_(approve|decline|accept|end)_(?:(config_[0-9a-zA-Z_]+)_)?(\d+)$')
+REPLY_COMMAND_RE = re.compile(r'(?:@\w+\s+)?/r\s+(\d+)\s+(.+)', re.IGNORECASE | re.DOTALL)
+END_COMMAND_RE = re.compile(r'(?:@\w+\s+)?/end\s+(\d+)', re.IGNORECASE)
+
+class TelegramCommand(NamedTuple):
+    kind: str               # 'apt', 'ho', 'reply', 'end', 'text' or 'unknown'
+    action: str = None      # approve / decline / accept / end for callbacks
+    config_id: str = None   # Bot the callback belongs to, when encoded in the data
+    target_id: int = None   # Appointment or HandoffRequest id
+    text: str = None        # Reply text for /r and plain tunneled text
+
+UNKNOWN_COMMAND = TelegramCommand('unknown')
+
+def parse_callback_data(cb_data):
+    """Parse inline button callback data into a TelegramCommand."""
+    m = CALLBACK_DATA_RE.match(cb_data) if cb_data[:3] in ('apt', 'ho_') else None
+    if not m:
+        return UNKNOWN_COMMAND
+    kind, action, config_id, target_id = m.groups()
+    return TelegramCommand(kind, action, config_id, int(target_id))
+
+def parse_owner_text(text):
+    """Parse a message from the owner's chat into a TelegramCommand."""
+    if text[:1] not in ('/', '@'):
+        return TelegramCommand('text', text=text)
+    m = REPLY_COMMAND_RE.match(text)
+    if m:
+        return TelegramCommand('reply', target_id=int(m.group(1)), text=m.group(2))
+    m = END_COMMAND_RE.match(text)
+    if m:
+        return TelegramCommand('end', target_id=int(m.group(1)))
+    return UNKNOWN_COMMAND
+
+def _appointment_callback(chatbot, bot_token, cmd, cb_id):
+    print(f"HANDLER: Appointment {cmd.action} #{cmd.target_id} for {cmd.config_id}")
+    # Only the bot that received the callback may act on the appointment
+    appointment = Appointment.query.filter_by(id=cmd.target_id, config_id=chatbot.config_id).first()
+    if not appointment:
+        answer_telegram_callback(bot_token, cb_id, "Not found")
+        return
+    if cmd.action == 'approve':
+        if not approve_appointment_slot(appointment):
+            answer_telegram_callback(bot_token, cb_id, "Slot already booked")
+            return
+    else:
+        appointment.status = 'declined'
+        appointment.updated_at = datetime.utcnow()
+    db.session.commit()
+    status_text = '✅ Approved' if cmd.action == 'approve' else '❌ Declined'
+    answer_telegram_callback(bot_token, cb_id, f"Appointment {status_text}")
+    
+    if appointment.telegram_message_id:
+        update_msg = (f"\U0001f4c5 <b>Appointment #{cmd.target_id} — {status_text}</b>\n\n"
+                      f"\U0001f464 <b>Name:</b> {appointment.customer_name}\n"
+                      f"\U0001f4e7 <b>Email:</b> {appointment.customer_email}\n"
+                      f"\U0001f4f1 <b>Mobile:</b> {appointment.customer_mobile}\n"
+                      f"\U0001f550 <b>Time:</b> {appointment.preferred_time}")
+        edit_telegram_message(bot_token, chatbot.telegram_chat_id, appointment.telegram_message_id, update_msg)
+
+def _handoff_request_conversation(config_id, req_id):
+    """Return (HandoffRequest, Conversation) for a request id of this bot; either may be None."""
+    req = HandoffRequest.query.filter_by(id=req_id, config_id=config_id).first()
+    if not req:
+        return None, None
+    return req, Conversation.query.filter_by(session_id=req.session_id, config_id=config_id).first()
+
+def _handoff_callback(chatbot, bot_token, cmd, cb_id):
+    print(f"HANDLER: Handoff {cmd.action} #{cmd.target_id} for {cmd.config_id}")
+    req, conv = _handoff_request_conversation(chatbot.config_id, cmd.target_id)
+    if not conv:
+        answer_telegram_callback(bot_token, cb_id, "Not found")
+        return
+    if cmd.action == 'accept':
+        if conv.handoff_status != 'ACTIVE':
+            conv.handoff_status = 'ACTIVE'
+            set_active_handoff_session(chatbot.config_id, req.session_id)
+            conv.add_message("assistant", "✅ **Connection successful!** A real person has joined the chat. How can we help you?", deduplicate=True)
+            db.session.commit()
+            answer_telegram_callback(bot_token, cb_id, "Accepted")
+            send_telegram_notification(bot_token, chatbot.telegram_chat_id, f"\U0001f91d Handoff Accepted! Tunnel active.\nUse /r {cmd.target_id} <msg> to reply.")
+        else:
+            answer_telegram_callback(bot_token, cb_id, "Already active")
+    else:
+        conv.handoff_status = None
+        conv.add_message("assistant", "I'm sorry, no person is available right now.", deduplicate=True)
+        db.session.commit()
+        answer_telegram_callback(bot_token, cb_id, "Declined")
+
+def _handoff_end_callback(chatbot, bot_token, cmd, cb_id):
+    req, conv = _handoff_request_conversation(chatbot.config_id, cmd.target_id)
+    if not conv:
+        answer_telegram_callback(bot_token, cb_id, "Not found")
+        return
+    conv.handoff_status = None
+    conv.add_message("assistant", "\U0001f512 **The human agent has left the chat.**", deduplicate=True)
+    set_active_handoff_session(chatbot.config_id, None, only_if=req.session_id)
+    db.session.commit()
+    answer_telegram_callback(bot_token, cb_id, "Ended")
+
+CALLBACK_HANDLERS = {
+    ('apt', 'approve'): _appointment_callback,
+    ('apt', 'decline'): _appointment_callback,
+    ('ho', 'accept'): _handoff_callback,
+    ('ho', 'decline'): _handoff_callback,
+    ('ho', 'end'): _handoff_end_callback,
+}
+
+def _reply_command(chatbot, cmd, msg_obj):
+    """/r <id> <text>: send the owner's reply into that handoff's conversation."""
+    req, conv = _handoff_request_conversation(chatbot.config_id, cmd.target_id)
+    if conv and conv.add_message("assistant", cmd.text, deduplicate=True):
+        conv.agent_response_pending = False
+        set_active_handoff_session(chatbot.config_id, req.session_id)
+        db.session.commit()
+        # Confirmation to owner
+        telegram_http.post(f"https://api.telegram.org/bot{chatbot.telegram_bot_token}/sendMessage",
+                           json={"chat_id": msg_obj['chat']['id'], "text": f"📩 Reply sent to #{cmd.target_id}", "reply_to_message_id": msg_obj['message_id']},
+                           timeout=TELEGRAM_TIMEOUT)
+
+def _end_command(chatbot, cmd, msg_obj):
+    """/end <id>: close that handoff and hand the conversation back to the AI."""
+    req, conv = _handoff_request_conversation(chatbot.config_id, cmd.target_id)
+    if conv:
+        conv.handoff_status = None
+        conv.add_message("assistant", "🔒 **The human agent has left the chat.** AI mode is back on.", deduplicate=True)
+        set_active_handoff_session(chatbot.config_id, None, only_if=req.session_id)
+        db.session.commit()
+        send_telegram_notification(chatbot.telegram_bot_token, chatbot.telegram_chat_id, f"🔒 Chat #{cmd.target_id} ended.")
+
+def _tunnel_text(chatbot, cmd, msg_obj):
+    """Plain text: route it to the bot's active handoff session, if any."""
+    active_session = get_active_handoff_session(chatbot.config_id)
+    if not active_session:
+        return False
+    conv = Conversation.query.filter_by(session_id=active_session).first()
+    if conv and conv.add_message("assistant", cmd.text, deduplicate=True):
+        conv.agent_response_pending = False
+        db.session.commit()
+    return True
+
+TEXT_HANDLERS = {
+    'reply': _reply_command,
+    'end': _end_command,
+    'text': _tunnel_text,
+}
+
 def handle_telegram_update(chatbot, update):
     """
     Unified handler for Telegram updates (both from Webhook and Poller).
@@ -1549,8 +3756,6 @@ def handle_telegram_update(chatbot, update):
         print("HANDLER: No bot token, skipping")
         return False
 
-    print(f"HANDLER: Processing update: {json.dumps(update, default=str)[:300]}")
-
     # 1. HANDLE CALLBACK QUERIES (Approve / Decline / End)
     if 'callback_query' in update:
         cb = update['callback_query']
@@ -1558,103 +3763,23 @@ def handle_telegram_update(chatbot, update):
         cb_id = cb.get('id')
         print(f"HANDLER CALLBACK: data='{cb_data}', id='{cb_id}'")
         
-        # CRITICAL: Always answer the callback FIRST to dismiss Telegram's loading spinner
-        # Then do the business logic. If business logic fails, at least the spinner stops.
+        # CRITICAL: Always answer the callback, even on errors, to dismiss Telegram's loading spinner
         try:
-            # 1. Parse config_id from callback_data (format: prefix_action_configId_dataId)
-            # Example: apt_approve_config_2025..._12
-            parts = cb_data.split('_')
-            target_chatbot = chatbot # default to current
-            
-            # Detect format and extract config_id
-            if cb_data.startswith('apt_') or cb_data.startswith('ho_'):
-                # Try to find config_id in the middle of the string
-                # Regex to match: prefix_action_(config_.*)_(id)
-                m = re.match(r'(apt|ho)_(approve|decline|accept|end)_(config_[0-9a-zA-Z_]+)_(\d+)', cb_data)
-                if m:
-                    prefix, action, cid, data_id = m.groups()
-                    if cid != chatbot.config_id:
-                        print(f"HANDLER: Callback for DIFFERENT bot! {chatbot.config_id} -> {cid}")
-                        found = BusinessConfig.query.filter_by(config_id=cid).first()
-                        if found:
-                            target_chatbot = found
-                            bot_token = found.telegram_bot_token # Use correct token too
-                        else:
-                            print(f"HANDLER: Config {cid} not found in DB!")
-            
-            # Re-process with target_chatbot
-            apt_match = re.match(r'apt_(approve|decline)_(config_[0-9a-zA-Z_]+)_(\d+)', cb_data)
-            if apt_match:
-                action, cid, apt_id = apt_match.groups()
-                print(f"HANDLER: Appointment {action} #{apt_id} for {cid}")
-                appointment = Appointment.query.get(int(apt_id))
-                if appointment:
-                    new_status = 'approved' if action == 'approve' else 'declined'
-                    appointment.status = new_status
-                    appointment.updated_at = datetime.utcnow()
-                    db.session.commit()
-                    status_text = '\u2705 Approved' if action == 'approve' else '\u274c Declined'
-                    answer_telegram_callback(bot_token, cb_id, f"Appointment {status_text}")
-                    
-                    if appointment.telegram_message_id:
-                        update_msg = (f"\U0001f4c5 <b>Appointment #{apt_id} \u2014 {status_text}</b>\n\n"
-                                      f"\U0001f464 <b>Name:</b> {appointment.customer_name}\n"
-                                      f"\U0001f4e7 <b>Email:</b> {appointment.customer_email}\n"
-                                      f"\U0001f4f1 <b>Mobile:</b> {appointment.customer_mobile}\n"
-                                      f"\U0001f550 <b>Time:</b> {appointment.preferred_time}")
-                        edit_telegram_message(bot_token, target_chatbot.telegram_chat_id, appointment.telegram_message_id, update_msg)
-                else:
-                    answer_telegram_callback(bot_token, cb_id, "Not found")
-                return True
-
-            # Handoff Accept/Decline
-            ho_match = re.match(r'ho_(accept|decline)_(config_[0-9a-zA-Z_]+)_(\d+)', cb_data)
-            if ho_match:
-                action, cid, req_id = ho_match.groups()
-                print(f"HANDLER: Handoff {action} #{req_id} for {cid}")
-                req = HandoffRequest.query.get(int(req_id))
-                if req:
-                    conv = Conversation.query.filter_by(session_id=req.session_id).first()
-                    if conv:
-                        if action == 'accept':
-                            if conv.handoff_status != 'ACTIVE':
-                                conv.handoff_status = 'ACTIVE'
-                                target_chatbot.active_handoff_session = req.session_id
-                                conv.add_message("assistant", "\u2705 **Connection successful!** A real person has joined the chat. How can we help you?", deduplicate=True)
-                                db.session.commit()
-                                answer_telegram_callback(bot_token, cb_id, "Accepted")
-                                send_telegram_notification(bot_token, target_chatbot.telegram_chat_id, f"\U0001f91d Handoff Accepted! Tunnel active.\nUse /r {req_id} <msg> to reply.")
-                            else:
-                                answer_telegram_callback(bot_token, cb_id, "Already active")
-                        else:
-                            conv.handoff_status = None
-                            conv.add_message("assistant", "I'm sorry, no person is available right now.", deduplicate=True)
-                            db.session.commit()
-                            answer_telegram_callback(bot_token, cb_id, "Declined")
-                return True
-
-            # Handoff End
-            ho_end_match = re.match(r'ho_end_(config_[0-9a-zA-Z_]+)_(\d+)', cb_data)
-            if ho_end_match:
-                cid, req_id = ho_end_match.groups()
-                req = HandoffRequest.query.get(int(req_id))
-                if req:
-                    conv = Conversation.query.filter_by(session_id=req.session_id).first()
-                    if conv:
-                        conv.handoff_status = None
-                        conv.add_message("assistant", "\U0001f512 **The human agent has left the chat.**", deduplicate=True)
-                        if target_chatbot.active_handoff_session == req.session_id:
-                            target_chatbot.active_handoff_session = None
-                        db.session.commit()
-                        answer_telegram_callback(bot_token, cb_id, "Ended")
+            cmd = parse_callback_data(cb_data)
+            handler = CALLBACK_HANDLERS.get((cmd.kind, cmd.action))
+            if not handler:
+                answer_telegram_callback(bot_token, cb_id, "Unknown action")
+                print(f"HANDLER: Unknown callback data: {cb_data}")
                 return True
             
-            # Unknown callback — still answer it to clear the spinner
-            answer_telegram_callback(bot_token, cb_id, "Unknown action")
-            print(f"HANDLER: Unknown callback data: {cb_data}")
+            # Callback data can be forged, so it only ever acts on the bot that received it
+            if cmd.config_id and cmd.config_id != chatbot.config_id:
+                print(f"HANDLER: Callback for another bot ignored: {chatbot.config_id} got {cmd.config_id}")
+                answer_telegram_callback(bot_token, cb_id, "Not found")
+                return True
             
+            handler(chatbot, bot_token, cmd, cb_id)
         except Exception as e:
-            # CRITICAL: Even on error, ALWAYS answer the callback to stop the loading spinner
             print(f"HANDLER CALLBACK ERROR: {e}")
             try:
                 answer_telegram_callback(bot_token, cb_id, f"Error: {str(e)[:50]}")
@@ -1665,89 +3790,135 @@ def handle_telegram_update(chatbot, update):
     # 2. HANDLE TEXT MESSAGES (Tunneling / Commands)
     if 'message' in update and 'text' in update['message']:
         msg_obj = update['message']
-        text = msg_obj['text'].strip()
-        telegram_chat_id = str(msg_obj['chat']['id'])
         
         # Security: Only process messages from authorized chat_id
-        if str(chatbot.telegram_chat_id) != telegram_chat_id:
+        if str(chatbot.telegram_chat_id) != str(msg_obj['chat']['id']):
             return False
-            
-        # Targeted Reply: /r <id> <message>
-        # Match optional mention, then /r, then ID, then message
-        r_match = re.match(r'^(?:@\w+\s+)?/r\s+(\d+)\s+(.+)', text, re.IGNORECASE | re.DOTALL)
-        if r_match:
-            req_id, reply_text = r_match.groups()
-            req = HandoffRequest.query.get(int(req_id))
-            if req:
-                conv = Conversation.query.filter_by(session_id=req.session_id).first()
-                if conv:
-                    if conv.add_message("assistant", reply_text, deduplicate=True):
-                        conv.agent_response_pending = False
-                        chatbot.active_handoff_session = req.session_id
-                        db.session.commit()
-                        # Confirmation to owner
-                        requests.post(f"https://api.telegram.org/bot{bot_token}/sendMessage", 
-                                     json={"chat_id": telegram_chat_id, "text": f"📩 Reply sent to #{req_id}", "reply_to_message_id": msg_obj['message_id']})
-            return True
-            
-        # Targeted End: /end <id>
-        if text.lower().startswith('/end ') or (text.lower().startswith('@') and '/end ' in text.lower()):
-            try:
-                parts = text.split(' ')
-                id_idx = parts.index('/end') + 1 if '/end' in parts else -1
-                if id_idx > 0 and id_idx < len(parts):
-                    req_id = parts[id_idx]
-                    req = HandoffRequest.query.get(int(req_id))
-                    if req:
-                        conv = Conversation.query.filter_by(session_id=req.session_id).first()
-                        if conv:
-                            conv.handoff_status = None
-                            conv.add_message("assistant", "🔒 **The human agent has left the chat.** AI mode is back on.", deduplicate=True)
-                            if chatbot.active_handoff_session == req.session_id:
-                                chatbot.active_handoff_session = None
-                            db.session.commit()
-                            send_telegram_notification(bot_token, chatbot.telegram_chat_id, f"🔒 Chat #{req_id} ended.")
-            except: pass
-            return True
-
-        # General Tunneling (Auto-routing to active session)
-        if chatbot.active_handoff_session:
-            if not text.startswith('/') and not text.startswith('@'):
-                conv = Conversation.query.filter_by(session_id=chatbot.active_handoff_session).first()
-                if conv:
-                    if conv.add_message("assistant", text, deduplicate=True):
-                        conv.agent_response_pending = False
-                        db.session.commit()
+        
+        cmd = parse_owner_text(msg_obj['text'].strip())
+        handler = TEXT_HANDLERS.get(cmd.kind)
+        if not handler:
+            return True  # Unrecognised command
+        try:
+            result = handler(chatbot, cmd, msg_obj)
+        except Exception as e:
+            db.session.rollback()
+            print(f"HANDLER TEXT ERROR: {e}")
             return True
+        return True if result is None else result
 
     return False
 
 # ---- Telegram Webhook Handler ----
+# The webhook only validates the update and queues it, so Telegram gets its 200 at once and
+# never retries (and duplicates) slow deliveries. Updates are sharded by (bot, chat) onto
+# bounded queues, each drained by one worker thread, which keeps every chat's updates in order.
+TELEGRAM_WEBHOOK_WORKERS = int(os.getenv("TELEGRAM_WEBHOOK_WORKERS", "4"))
+TELEGRAM_WEBHOOK_QUEUE_SIZE = int(os.getenv("TELEGRAM_WEBHOOK_QUEUE_SIZE", "250"))  # per worker
+TELEGRAM_WEBHOOK_REQUIRE_SECRET = os.getenv("TELEGRAM_WEBHOOK_REQUIRE_SECRET", "").lower() in ("1", "true", "yes")
+
+class WebhookQueueState:
+    started = False
+    lock = threading.Lock()
+    shards = []            # one bounded queue.Queue per worker
+    recent_updates = {}    # config_id -> RecentUpdateIds
+    duplicates = 0
+    rejected = 0
+
+webhook_queue = WebhookQueueState()
+
+def start_webhook_workers():
+    """Start this process's webhook workers once."""
+    with webhook_queue.lock:
+        if webhook_queue.started:
+            return
+        webhook_queue.shards = [queue.Queue(maxsize=TELEGRAM_WEBHOOK_QUEUE_SIZE) for _ in range(TELEGRAM_WEBHOOK_WORKERS)]
+        for shard in webhook_queue.shards:
+            threading.Thread(target=_webhook_worker, args=(shard,), daemon=True).start()
+        webhook_queue.started = True
+    print(f"WEBHOOK QUEUE: Started {TELEGRAM_WEBHOOK_WORKERS} worker(s)")
+
+def _update_chat_id(update):
+    """Chat an update belongs to, used to keep each chat's updates on one worker."""
+    for key in ('message', 'edited_message', 'channel_post'):
+        if key in update:
+            return update[key].get('chat', {}).get('id')
+    if 'callback_query' in update:
+        cb = update['callback_query']
+        return (cb.get('message') or {}).get('chat', {}).get('id') or cb.get('from', {}).get('id')
+    return None
+
+def enqueue_webhook_update(config_id, update):
+    """Queue an update for background handling. Returns 'queued', 'duplicate' or 'full'."""
+    start_webhook_workers()
+    update_id = update['update_id']
+    with webhook_queue.lock:
+        recent = webhook_queue.recent_updates.get(config_id)
+        if recent is None:
+            recent = webhook_queue.recent_updates[config_id] = RecentUpdateIds()
+    if not recent.add(update_id):
+        webhook_queue.duplicates += 1
+        return 'duplicate'
+    
+    chat_id = _update_chat_id(update)
+    shard = webhook_queue.shards[hash((config_id, chat_id if chat_id is not None else update_id)) % len(webhook_queue.shards)]
+    try:
+        shard.put_nowait((config_id, update))
+    except queue.Full:
+        recent.discard(update_id)  # Let Telegram's retry through
+        webhook_queue.rejected += 1
+        return 'full'
+    return 'queued'
+
+def _webhook_worker(shard):
+    while True:
+        config_id, update = shard.get()
+        try:
+            with app.app_context():
+                chatbot = get_config_snapshot(config_id)
+                if chatbot:
+                    handle_telegram_update(chatbot, update)
+        except Exception as e:
+            print(f"WEBHOOK WORKER ERROR ({config_id}, update {update.get('update_id')}): {e}")
+
+def webhook_queue_stats():
+    """Queue depth and drop counters, for /health."""
+    return {
+        "depth": sum(shard.qsize() for shard in webhook_queue.shards),
+        "capacity": TELEGRAM_WEBHOOK_WORKERS * TELEGRAM_WEBHOOK_QUEUE_SIZE,
+        "duplicates": webhook_queue.duplicates,
+        "rejected": webhook_queue.rejected
+    }
+
 @app.route('/telegram/webhook/<config_id>', methods=['POST'])
 def telegram_webhook(config_id):
-    """Production webhook for Telegram updates."""
-    try:
-        data = request.json
-        print(f"DEBUG WEBHOOK: Received update for {config_id}")
-        
-        chatbot = BusinessConfig.query.filter_by(config_id=config_id).first()
-        if not chatbot:
-            print(f"DEBUG WEBHOOK: Bot {config_id} not found")
-            return jsonify({"ok": True})
-            
-        # Use our UNIFIED handler!
-        handle_telegram_update(chatbot, data)
-        
-        return jsonify({"ok": True})
-    except Exception as e:
-        print(f"DEBUG WEBHOOK ERROR: {e}")
+    """Production webhook for Telegram updates: validate, queue and acknowledge immediately."""
+    update = request.get_json(silent=True)
+    if not isinstance(update, dict) or not isinstance(update.get('update_id'), int):
+        return jsonify({"ok": False, "error": "Invalid update"}), 400
+    
+    chatbot = get_config_snapshot(config_id)
+    if not chatbot or not chatbot.telegram_bot_token:
+        print(f"DEBUG WEBHOOK: Bot {config_id} not found")
         return jsonify({"ok": True})
+    
+    # Telegram sends the secret we registered with setWebhook; older registrations have none
+    secret = request.headers.get('X-Telegram-Bot-Api-Secret-Token')
+    if (secret or TELEGRAM_WEBHOOK_REQUIRE_SECRET) and secret != telegram_webhook_secret(chatbot.telegram_bot_token):
+        print(f"DEBUG WEBHOOK: Rejected update for {config_id} with a bad secret token")
+        return jsonify({"ok": False}), 403
+    
+    result = enqueue_webhook_update(config_id, update)
+    if result == 'full':
+        print(f"DEBUG WEBHOOK: Queue full, asking Telegram to retry update {update['update_id']}")
+        return jsonify({"ok": False, "error": "Busy"}), 503
+    return jsonify({"ok": True})
 
 def answer_telegram_callback(bot_token, callback_id, text):
     """Answer a Telegram callback query to dismiss the loading state."""
     try:
         url = f"https://api.telegram.org/bot{bot_token}/answerCallbackQuery"
-        requests.post(url, json={"callback_query_id": callback_id, "text": text}, timeout=5)
+        telegram_http.post(url, json={"callback_query_id": callback_id, "text": text}, timeout=TELEGRAM_CALLBACK_TIMEOUT)
     except Exception as e:
         print(f"DEBUG: answerCallbackQuery error: {e}")
 
@@ -1755,23 +3926,29 @@ def edit_telegram_message(bot_token, chat_id, message_id, new_text):
     """Edit an existing Telegram message (remove buttons, update text)."""
     try:
         url = f"https://api.telegram.org/bot{bot_token}/editMessageText"
-        requests.post(url, json={
+        telegram_http.post(url, json={
             "chat_id": chat_id,
             "message_id": message_id,
             "text": new_text,
             "parse_mode": "HTML"
-        }, timeout=5)
+        }, timeout=TELEGRAM_CALLBACK_TIMEOUT)
     except Exception as e:
         print(f"DEBUG: editMessageText error: {e}")
 
 # ---- Dashboard Appointment Actions ----
+def _user_appointment_or_404(apt_id):
+    """An appointment belonging to one of the current user's bots, or 404."""
+    return (Appointment.query.join(BusinessConfig, BusinessConfig.config_id == Appointment.config_id)
+            .filter(Appointment.id == apt_id, BusinessConfig.user_id == current_user.id).first_or_404())
+
 @app.route('/appointment/<int:apt_id>/approve', methods=['POST'])
 @login_required
 def approve_appointment(apt_id):
     """Approve an appointment from the dashboard."""
-    appointment = Appointment.query.get_or_404(apt_id)
-    appointment.status = 'approved'
-    appointment.updated_at = datetime.utcnow()
+    appointment = _user_appointment_or_404(apt_id)
+    if not approve_appointment_slot(appointment):
+        flash(f'That slot is already booked, so {appointment.customer_name} was not approved.', 'warning')
+        return redirect(url_for('dashboard'))
     db.session.commit()
     flash(f'Appointment for {appointment.customer_name} approved!', 'success')
     return redirect(url_for('dashboard'))
@@ -1780,7 +3957,7 @@ def approve_appointment(apt_id):
 @login_required
 def decline_appointment(apt_id):
     """Decline an appointment from the dashboard."""
-    appointment = Appointment.query.get_or_404(apt_id)
+    appointment = _user_appointment_or_404(apt_id)
     appointment.status = 'declined'
     appointment.updated_at = datetime.utcnow()
     db.session.commit()
@@ -1791,7 +3968,7 @@ def decline_appointment(apt_id):
 @login_required
 def delete_appointment(apt_id):
     """Delete an appointment from the dashboard."""
-    appointment = Appointment.query.get_or_404(apt_id)
+    appointment = _user_appointment_or_404(apt_id)
     name = appointment.customer_name
     db.session.delete(appointment)
     db.session.commit()
@@ -1816,7 +3993,7 @@ def setup_telegram_webhook(config_id):
     
     try:
         url = f"https://api.telegram.org/bot{chatbot.telegram_bot_token}/setWebhook"
-        response = requests.post(url, json={"url": webhook_url}, timeout=10)
+        response = telegram_http.post(url, json={"url": webhook_url, "secret_token": telegram_webhook_secret(chatbot.telegram_bot_token)}, timeout=TELEGRAM_TIMEOUT)
         result = response.json()
         
         if result.get('ok'):
@@ -1860,86 +4037,298 @@ with app.app_context():
     db.create_all()
 
 # Set the proper host and port for production
-# ========== Telegram Polling Thread ==========
-# Uses getUpdates API to poll for inline button callbacks
-# Works locally without a public webhook URL
+# ========== Telegram Polling Threads ==========
+# Uses the getUpdates API to receive inline button callbacks and owner replies.
+# Works locally without a public webhook URL. A supervisor runs one long-poll thread per
+# bot, so update latency does not grow with the number of bots, and starts/stops pollers
+# as tokens are added, changed or removed in BusinessConfig.
+TELEGRAM_LONG_POLL_TIMEOUT = int(os.getenv("TELEGRAM_LONG_POLL_TIMEOUT", "30"))  # seconds Telegram holds getUpdates
+TELEGRAM_POLLER_MAX_BOTS = int(os.getenv("TELEGRAM_POLLER_MAX_BOTS", "100"))      # cap on concurrent poll threads
+TELEGRAM_POLLER_RESCAN = 30       # seconds between BusinessConfig scans for added/removed bots
+TELEGRAM_POLLER_ERROR_BACKOFF = 5  # seconds after a failed getUpdates
+TELEGRAM_POLLER_CONFLICT_BACKOFF = 60  # seconds after 409 Conflict (a webhook is set for this bot)
+
+# Long polls hold a connection each, so this session's pool is sized to the poller cap
+telegram_poll_http = _build_http_session(Retry(
+    total=HTTP_MAX_RETRIES, connect=HTTP_MAX_RETRIES, read=0, status=0,
+    backoff_factor=HTTP_RETRY_BACKOFF
+), pool_size=TELEGRAM_POLLER_MAX_BOTS)
+
+TELEGRAM_DEDUPE_SIZE = 1000  # recent update_ids remembered per bot
+
+class RecentUpdateIds:
+    """Bounded set of the most recent update_ids for one bot; oldest ids are evicted in O(1)."""
+    def __init__(self, max_size=TELEGRAM_DEDUPE_SIZE):
+        self.order = deque()
+        self.ids = set()
+        self.max_size = max_size
+        self.lock = threading.Lock()
+    
+    def add(self, update_id):
+        """Record update_id. Returns False if it was already seen."""
+        with self.lock:
+            if update_id in self.ids:
+                return False
+            self.ids.add(update_id)
+            self.order.append(update_id)
+            if len(self.order) > self.max_size:
+                self.ids.discard(self.order.popleft())
+            return True
+    
+    def discard(self, update_id):
+        """Forget update_id so a redelivery is accepted (used when it could not be queued)."""
+        with self.lock:
+            self.ids.discard(update_id)
+
+class BotPoller:
+    """Long-polls getUpdates for one bot token in its own thread and records lag metrics."""
+    def __init__(self, config_id, bot_token):
+        self.config_id = config_id
+        self.bot_token = bot_token
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.offset = None
+        self.recent_updates = RecentUpdateIds()
+        self.started_at = time.time()
+        self.last_poll_at = None      # When the last getUpdates returned
+        self.last_update_at = None    # When the last update was handled
+        self.last_lag = None          # Seconds from Telegram's message date to handling it
+        self.max_lag = 0.0
+        self.updates_handled = 0
+        self.errors = 0
+        self.last_error = None
+    
+    def start(self):
+        self.thread.start()
+    
+    def stop(self):
+        """Ask the thread to exit; it finishes after its in-flight long poll returns."""
+        self.stop_event.set()
+    
+    def retarget(self, config_id):
+        """Route this token's updates to another bot config without interrupting the long poll."""
+        print(f"TELEGRAM POLLER: Token moved from {self.config_id} to {config_id}")
+        self.config_id = config_id
+    
+    def run(self):
+        print(f"TELEGRAM POLLER: Started for {self.config_id}")
+        while not self.stop_event.is_set():
+            try:
+                with app.app_context():
+                    self.poll_once()
+            except Exception as e:
+                self.errors += 1
+                self.last_error = str(e)[:200]
+                print(f"POLLER ERROR ({self.config_id}): {e}")
+                self.stop_event.wait(TELEGRAM_POLLER_ERROR_BACKOFF)
+        print(f"TELEGRAM POLLER: Stopped for {self.config_id}")
+    
+    def poll_once(self):
+        if self.offset is None:
+            self.offset = db.session.query(BusinessConfig.telegram_offset).filter_by(config_id=self.config_id).scalar() or 0
+            db.session.rollback()  # Don't hold a transaction open across the long poll
+        
+        url = f"https://api.telegram.org/bot{self.bot_token}/getUpdates"
+        params = {"offset": self.offset, "timeout": TELEGRAM_LONG_POLL_TIMEOUT}
+        resp = telegram_poll_http.get(url, params=params, timeout=(TELEGRAM_TIMEOUT, TELEGRAM_LONG_POLL_TIMEOUT + 10))
+        self.last_poll_at = time.time()
+        data = resp.json()
+        if not data.get('ok'):
+            self.errors += 1
+            self.last_error = f"{resp.status_code}: {data.get('description', '')}"[:200]
+            backoff = TELEGRAM_POLLER_CONFLICT_BACKOFF if resp.status_code == 409 else TELEGRAM_POLLER_ERROR_BACKOFF
+            print(f"POLLER ({self.config_id}): getUpdates failed ({self.last_error}), retrying in {backoff}s")
+            self.stop_event.wait(backoff)
+            return
+        
+        updates = data.get('result') or []
+        try:
+            for update in updates:
+                if self.stop_event.is_set():
+                    return
+                update_id = update['update_id']
+                self.offset = max(self.offset, update_id + 1)
+                if not self.recent_updates.add(update_id):
+                    continue  # Duplicate delivery
+                
+                chatbot = get_config_snapshot(self.config_id)
+                if not chatbot:
+                    self.stop()
+                    return
+                try:
+                    # Use our UNIFIED handler!
+                    handle_telegram_update(chatbot, update)
+                    self._record_update(update)
+                except Exception as u_err:
+                    db.session.rollback()
+                    self.errors += 1
+                    self.last_error = str(u_err)[:200]
+                    print(f"POLLER UPDATE ERROR (ID {update_id}): {u_err}")
+        finally:
+            # Persist the offset once per page rather than once per update
+            if updates:
+                BusinessConfig.query.filter_by(config_id=self.config_id).update({BusinessConfig.telegram_offset: self.offset})
+                db.session.commit()
+    
+    def _record_update(self, update):
+        now = time.time()
+        self.updates_handled += 1
+        self.last_update_at = now
+        sent_at = (update.get('message') or update.get('edited_message') or {}).get('date')
+        if sent_at:
+            self.last_lag = max(0.0, now - sent_at)
+            self.max_lag = max(self.max_lag, self.last_lag)
+    
+    def metrics(self):
+        def iso(ts):
+            return datetime.utcfromtimestamp(ts).isoformat() if ts else None
+        return {
+            "alive": self.thread.is_alive(),
+            "offset": self.offset,
+            "last_poll_at": iso(self.last_poll_at),
+            "seconds_since_poll": round(time.time() - (self.last_poll_at or self.started_at), 1),
+            "last_update_at": iso(self.last_update_at),
+            "last_lag_seconds": round(self.last_lag, 2) if self.last_lag is not None else None,
+            "max_lag_seconds": round(self.max_lag, 2),
+            "updates_handled": self.updates_handled,
+            "errors": self.errors,
+            "last_error": self.last_error
+        }
+
+def _sync_bot_pollers():
+    """
+    Start pollers for new bot tokens and stop pollers whose token was removed. Telegram allows one
+    getUpdates consumer per token, so a token that moves to another config keeps its poller, and a
+    token is only polled again once its previous poller's long poll has returned.
+    """
+    rows = db.session.query(BusinessConfig.config_id, BusinessConfig.telegram_bot_token).filter(
+        BusinessConfig.telegram_bot_token.isnot(None),
+        BusinessConfig.telegram_bot_token != ''
+    ).order_by(BusinessConfig.id).all()
+    db.session.rollback()
+    
+    wanted = {}
+    for config_id, bot_token in rows:
+        wanted.setdefault(bot_token, config_id)  # getUpdates allows one consumer per token
+    
+    with poller_state.lock:
+        for bot_token, poller in list(poller_state.stopping.items()):
+            if not poller.thread.is_alive():
+                del poller_state.stopping[bot_token]
+        for bot_token, poller in list(poller_state.pollers.items()):
+            config_id = wanted.get(bot_token)
+            if config_id is None or not poller.thread.is_alive():
+                poller.stop()
+                del poller_state.pollers[bot_token]
+                if poller.thread.is_alive():
+                    poller_state.stopping[bot_token] = poller
+            elif config_id != poller.config_id:
+                poller.retarget(config_id)
+        for bot_token, config_id in wanted.items():
+            if bot_token in poller_state.pollers or bot_token in poller_state.stopping:
+                continue  # Already polled, or the old poller is still inside getUpdates (next rescan)
+            if len(poller_state.pollers) >= TELEGRAM_POLLER_MAX_BOTS:
+                print(f"TELEGRAM POLLER: Limit of {TELEGRAM_POLLER_MAX_BOTS} bots reached, not polling {config_id}")
+                break
+            poller = BotPoller(config_id, bot_token)
+            poller_state.pollers[bot_token] = poller
+            poller.start()
+
+def telegram_poller_metrics():
+    """Per-bot poller health and lag, keyed by config_id, for /health."""
+    with poller_state.lock:
+        return {poller.config_id: poller.metrics() for poller in poller_state.pollers.values()}
 
 def telegram_polling_worker():
-    """Background thread that polls Telegram for all updates (Consolidated)."""
+    """Supervisor thread: keeps one long-polling BotPoller running per configured bot."""
     with poller_state.lock:
         if poller_state.started:
             print("TELEGRAM POLLER: Already running, skipping startup.")
             return
         poller_state.started = True
 
-    print("TELEGRAM POLLER: Starting polling thread...")
+    print("TELEGRAM POLLER: Starting supervisor...")
     
     while True:
         try:
-            time.sleep(2)
             with app.app_context():
-                chatbots = BusinessConfig.query.filter(
-                    BusinessConfig.telegram_bot_token.isnot(None),
-                    BusinessConfig.telegram_bot_token != ''
-                ).all()
-                
-                for chatbot in chatbots:
-                    try:
-                        bot_token = chatbot.telegram_bot_token
-                        current_offset = chatbot.telegram_offset or 0
-                        url = f"https://api.telegram.org/bot{bot_token}/getUpdates"
-                        params = {"offset": current_offset, "timeout": 2} 
-                        
-                        resp = requests.get(url, params=params, timeout=10)
-                        data = resp.json()
-                        if not data.get('ok') or not data.get('result'):
-                            continue
-                            
-                        for update in data['result']:
-                            try:
-                                update_id = update['update_id']
-                                
-                                # Deduplication check
-                                if update_id in poller_state.processed_updates:
-                                    continue
-                                poller_state.processed_updates.add(update_id)
-                                if len(poller_state.processed_updates) > poller_state.max_buffer:
-                                    # Safe buffer pruning (keeping most recent IDs)
-                                    poller_state.processed_updates = set(list(poller_state.processed_updates)[-poller_state.max_buffer:])
-                                
-                                # Use our UNIFIED handler!
-                                handle_telegram_update(chatbot, update)
-                                
-                                # Update offset after each successful update processing
-                                chatbot.telegram_offset = update_id + 1
-                                db.session.commit()
-                                
-                            except Exception as u_err:
-                                print(f"POLLER UPDATE ERROR (ID {update.get('update_id')}): {u_err}")
-                                continue
-
-                    except Exception as e:
-                        print(f"POLLER INNER ERROR: {e}")
-                        
+                _sync_bot_pollers()
         except Exception as e:
             print(f"TELEGRAM POLLER ERROR: {e}")
-            time.sleep(5)
+        time.sleep(TELEGRAM_POLLER_RESCAN)
 
 def check_db_schema():
-    """Ensure all required columns exist in the SQLite database."""
+    """Ensure all required columns exist in the database."""
     with app.app_context():
         try:
             # Check if telegram_offset exists in business_config
-            from sqlalchemy import text
+            from sqlalchemy import text, inspect
             with db.engine.connect() as conn:
-                # SQLite-specific column check
-                result = conn.execute(text("PRAGMA table_info(business_config)"))
-                columns = [row[1] for row in result]
+                datetime_type = db.DateTime().compile(dialect=conn.dialect)  # DATETIME on SQLite, TIMESTAMP elsewhere
+                columns = [column['name'] for column in inspect(conn).get_columns('business_config')]
                 if 'telegram_offset' not in columns:
                     print("Adding missing column 'telegram_offset' to 'business_config' table...")
                     conn.execute(text("ALTER TABLE business_config ADD COLUMN telegram_offset INTEGER DEFAULT 0"))
                     conn.commit()
                     print("Column added successfully.")
+                if 'ai_suggestions' not in columns:
+                    print("Adding missing columns 'ai_suggestions', 'ai_suggestions_updated_at' to 'business_config' table...")
+                    conn.execute(text("ALTER TABLE business_config ADD COLUMN ai_suggestions TEXT"))
+                    conn.execute(text(f"ALTER TABLE business_config ADD COLUMN ai_suggestions_updated_at {datetime_type}"))
+                    conn.commit()
+                    print("Columns added successfully.")
+                if 'prompt_version_id' not in columns:
+                    print("Adding missing column 'prompt_version_id' to 'business_config' table...")
+                    conn.execute(text("ALTER TABLE business_config ADD COLUMN prompt_version_id INTEGER"))
+                    conn.commit()
+                    print("Column added successfully.")
+                if 'knowledge_hash' not in columns:
+                    print("Adding missing column 'knowledge_hash' to 'business_config' table...")
+                    conn.execute(text("ALTER TABLE business_config ADD COLUMN knowledge_hash VARCHAR(64)"))
+                    conn.commit()
+                    print("Column added successfully.")
+                
+                # Check if message_count exists in conversation
+                columns = [column['name'] for column in inspect(conn).get_columns('conversation')]
+                if 'message_count' not in columns:
+                    print("Adding missing column 'message_count' to 'conversation' table...")
+                    conn.execute(text("ALTER TABLE conversation ADD COLUMN message_count INTEGER DEFAULT 0"))
+                    conn.commit()
+                    print("Column added successfully.")
+                if 'summary' not in columns:
+                    print("Adding missing columns 'summary', 'summary_upto' to 'conversation' table...")
+                    conn.execute(text("ALTER TABLE conversation ADD COLUMN summary TEXT"))
+                    conn.execute(text("ALTER TABLE conversation ADD COLUMN summary_upto INTEGER DEFAULT 0"))
+                    conn.commit()
+                    print("Columns added successfully.")
+                if 'prompt_version_id' not in columns:
+                    print("Adding missing column 'prompt_version_id' to 'conversation' table...")
+                    conn.execute(text("ALTER TABLE conversation ADD COLUMN prompt_version_id INTEGER REFERENCES prompt_version (id)"))
+                    conn.commit()
+                    print("Column added successfully.")
+                
+                # Check if slot_start exists in appointment (backfilled from preferred_time)
+                columns = [column['name'] for column in inspect(conn).get_columns('appointment')]
+                if 'slot_start' not in columns:
+                    print("Adding missing column 'slot_start' to 'appointment' table...")
+                    conn.execute(text(f"ALTER TABLE appointment ADD COLUMN slot_start {datetime_type}"))
+                    taken = set()
+                    rows = conn.execute(text("SELECT id, config_id, preferred_time, status FROM appointment ORDER BY id"))
+                    for apt_id, config_id, preferred_time, status in rows.all():
+                        slot = validate_strict_date((preferred_time or '').strip())
+                        if not slot:
+                            continue
+                        if status in ('pending', 'approved'):
+                            # An older active booking keeps a doubly-booked slot
+                            if (config_id, slot) in taken:
+                                continue
+                            taken.add((config_id, slot))
+                        conn.execute(Appointment.__table__.update()
+                                     .where(Appointment.__table__.c.id == apt_id).values(slot_start=slot))
+                    conn.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS uq_appointment_active_slot "
+                                      "ON appointment (config_id, slot_start) WHERE status IN ('pending', 'approved')"))
+                    conn.commit()
+                    print("Column added successfully.")
         except Exception as e:
             print(f"DATABASE SCHEMA UPDATE ERROR: {e}")
 
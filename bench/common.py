@@ -0,0 +1,38 @@
+"""Shared setup for the benchmarks in this directory."""
+import atexit
+import importlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_app(rev=None):
+    """
+    Import app.py from the working tree (or as of git revision `rev`) in a scratch directory,
+    so it runs against a throwaway SQLite database and never touches instance/chatbot.db.
+    """
+    if rev:
+        source = subprocess.check_output(['git', 'show', f'{rev}:app.py'], cwd=REPO_ROOT)
+    else:
+        with open(os.path.join(REPO_ROOT, 'app.py'), 'rb') as f:
+            source = f.read()
+    
+    workdir = tempfile.mkdtemp(prefix='chatbot-bench-')
+    atexit.register(shutil.rmtree, workdir, ignore_errors=True)
+    with open(os.path.join(workdir, 'app.py'), 'wb') as f:
+        f.write(source)
+    os.symlink(os.path.join(REPO_ROOT, 'templates'), os.path.join(workdir, 'templates'))
+    os.makedirs(os.path.join(workdir, 'instance'))
+    
+    os.environ.pop('DATABASE_URL', None)
+    os.environ.setdefault('SECRET_KEY', 'bench')
+    os.chdir(workdir)
+    sys.path.insert(0, workdir)
+    app = importlib.import_module('app')
+    with app.app.app_context():
+        app.db.create_all()
+    return app
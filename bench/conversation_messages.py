@@ -0,0 +1,76 @@
+"""
+Benchmark one /chat request cycle on a 200-message conversation: load the conversation, add the
+user message, read the last 10 messages for the model, add the reply with dedupe, commit.
+
+    python bench/conversation_messages.py              # working tree
+    python bench/conversation_messages.py --rev 3f1e91e  # before the per-object message cache
+
+Each run is a fresh process with a new database. One untimed warm-up pass runs first, so
+SQLAlchemy's statement cache and SQLite's page cache are warm for every revision alike. The
+timed passes that follow are reported as mean, min and max ms/request. Compare revisions from
+several runs each, because absolute numbers vary by machine and across runs on the same machine.
+For example, this loop ran 5 interleaved processes per revision:
+
+    for i in 1 2 3 4 5; do for r in 3f1e91e 9e03019 HEAD; do
+        python bench/conversation_messages.py --rev $r --repeat 10; done; done
+
+Results, as the mean of the 5 per-process means, each over 10 x 200 requests:
+    3f1e91e  8 statements  5.85 ms/request (per-process means 5.42-6.51)
+    9e03019  5 statements  4.69 ms/request (4.36-5.08)
+    8b64034  6 statements  4.38 ms/request (3.58-5.01); the extra statement reserves sequence numbers
+"""
+import argparse
+import json
+import time
+
+from common import load_app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rev', help="git revision of app.py to benchmark (default: working tree)")
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=5, help="timed passes after the warm-up pass")
+    args = parser.parse_args()
+    
+    A = load_app(args.rev)
+    from sqlalchemy import event
+    statements = [0]
+    
+    with A.app.app_context():
+        event.listen(A.db.engine, 'before_cursor_execute', lambda *a, **k: statements.__setitem__(0, statements[0] + 1))
+        messages = [{"role": "system", "content": "S" * 3000}] + \
+                   [{"role": ["user", "assistant"][i % 2], "content": "m" * 300} for i in range(199)]
+        conversation = A.Conversation(session_id='bench', config_id='bench',
+                                      history='' if hasattr(A, 'Message') else json.dumps(messages))
+        A.db.session.add(conversation)
+        A.db.session.commit()
+        if hasattr(A, 'Message'):
+            conversation.messages = messages
+            A.db.session.commit()
+        conversation_id = conversation.id
+    
+    results = []
+    for _ in range(args.repeat + 1):
+        with A.app.app_context():
+            statements[0] = 0
+            started = time.perf_counter()
+            for i in range(args.requests):
+                conversation = A.db.session.get(A.Conversation, conversation_id)
+                conversation.add_message("user", f"q{i}")
+                conversation.get_last_messages(count=10, include_system=True)
+                conversation.add_message("assistant", f"a{i}", deduplicate=True)
+                A.db.session.commit()
+                A.db.session.remove()
+            elapsed = time.perf_counter() - started
+        results.append((elapsed / args.requests * 1000, statements[0] / args.requests))
+    
+    timings = [ms for ms, _ in results[1:]]  # results[0] is the warm-up pass
+    per_request = results[-1][1]
+    print(f"{args.rev or 'working tree'}: {sum(timings) / len(timings):.2f} ms/request "
+          f"(min {min(timings):.2f}, max {max(timings):.2f}), {per_request:.1f} SQL statements/request "
+          f"(mean of {args.repeat} x {args.requests} requests after 1 warm-up pass)")
+
+
+if __name__ == '__main__':
+    main()
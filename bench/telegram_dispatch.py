@@ -0,0 +1,96 @@
+"""
+Benchmark the per-update CPU cost of the Telegram update router.
+
+Two measurements:
+  * parse + dispatch only: the pre-dispatcher parsing logic (kept below as a reference copy)
+    against parse_callback_data/parse_owner_text and the handler tables;
+  * the full handle_telegram_update on SQLite, with Telegram API calls stubbed out.
+
+    python bench/telegram_dispatch.py                 # working tree
+    python bench/telegram_dispatch.py --rev ba85669~1  # full handler before the dispatcher
+"""
+import argparse
+import contextlib
+import io
+import re
+import timeit
+
+from common import load_app
+
+CONFIG_ID = 'config_20250101120000_1'
+CALLBACK_SAMPLES = [f'apt_approve_{CONFIG_ID}_42', f'ho_accept_{CONFIG_ID}_7', f'ho_end_{CONFIG_ID}_7', 'ho_end_7', 'bogus']
+TEXT_SAMPLES = ['/r 12 hello there', '/end 12', 'hello customer', '@bot /r 3 hi']
+
+
+# Reference copy of the callback/text parsing handle_telegram_update did before the dispatcher
+def legacy_route_callback(cb_data):
+    if cb_data.startswith('apt_') or cb_data.startswith('ho_'):
+        match = re.match(r'(apt|ho)_(approve|decline|accept|end)_(config_[0-9a-zA-Z_]+)_(\d+)', cb_data)
+        if match:
+            match.groups()
+    if re.match(r'apt_(approve|decline)_(config_[0-9a-zA-Z_]+)_(\d+)', cb_data):
+        return 'apt'
+    if re.match(r'ho_(accept|decline)_(config_[0-9a-zA-Z_]+)_(\d+)', cb_data):
+        return 'ho'
+    if re.match(r'ho_end_(config_[0-9a-zA-Z_]+)_(\d+)', cb_data):
+        return 'end'
+    return None
+
+
+def legacy_route_text(text):
+    reply = re.match(r'^(?:@\w+\s+)?/r\s+(\d+)\s+(.+)', text, re.IGNORECASE | re.DOTALL)
+    if reply:
+        return reply.groups()
+    if text.lower().startswith('/end ') or (text.lower().startswith('@') and '/end ' in text.lower()):
+        parts = text.split(' ')
+        return parts[parts.index('/end') + 1] if '/end' in parts else None
+    if not text.startswith('/') and not text.startswith('@'):
+        return 'tunnel'
+    return None
+
+
+def per_update_ns(route, samples, number):
+    best = min(timeit.repeat(lambda: [route(sample) for sample in samples], number=number, repeat=5))
+    return best / number / len(samples) * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rev', help="git revision of app.py for the full-handler run (default: working tree)")
+    parser.add_argument('--number', type=int, default=20000)
+    args = parser.parse_args()
+    
+    A = load_app(args.rev)
+    
+    if hasattr(A, 'parse_callback_data'):
+        route_callback = lambda data: A.CALLBACK_HANDLERS.get((lambda c: (c.kind, c.action))(A.parse_callback_data(data)))
+        route_text = lambda text: A.TEXT_HANDLERS.get(A.parse_owner_text(text).kind)
+        print("parse + dispatch (ns/update):")
+        print(f"  callbacks:  legacy {per_update_ns(legacy_route_callback, CALLBACK_SAMPLES, args.number):.0f}"
+              f" -> dispatcher {per_update_ns(route_callback, CALLBACK_SAMPLES, args.number):.0f}")
+        print(f"  owner text: legacy {per_update_ns(legacy_route_text, TEXT_SAMPLES, args.number):.0f}"
+              f" -> dispatcher {per_update_ns(route_text, TEXT_SAMPLES, args.number):.0f}")
+    
+    A.answer_telegram_callback = lambda *a, **k: None
+    with A.app.app_context():
+        user = A.User(username='bench', email='bench@example.com')
+        user.set_password('bench')
+        A.db.session.add(user)
+        A.db.session.commit()
+        A.db.session.add(A.BusinessConfig(config_id=CONFIG_ID, business_name='Bench', user_id=user.id,
+                                          telegram_bot_token='bench-token', telegram_chat_id='1'))
+        A.db.session.commit()
+        chatbot = A.get_config_snapshot(CONFIG_ID)
+        updates = [
+            {'update_id': 1, 'callback_query': {'id': 'c', 'data': f'apt_approve_{CONFIG_ID}_999'}},
+            {'update_id': 2, 'callback_query': {'id': 'c', 'data': f'ho_end_{CONFIG_ID}_999'}},
+            {'update_id': 3, 'message': {'message_id': 1, 'text': 'hello customer', 'chat': {'id': 1}}},
+        ]
+        with contextlib.redirect_stdout(io.StringIO()):  # the handler's DEBUG prints
+            best = min(timeit.repeat(lambda: [A.handle_telegram_update(chatbot, update) for update in updates],
+                                     number=300, repeat=5))
+    print(f"full handler, {args.rev or 'working tree'}: {best / 300 / len(updates) * 1e6:.1f} us/update")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""Add message table and move conversation history blobs into it
+
+Revision ID: 3b9e4d2a7c15
+Revises: c054d0ecc10f
+Create Date: 2026-10-17 10:12:44.318205
+
+"""
+import json
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3b9e4d2a7c15'
+down_revision = 'c054d0ecc10f'
+branch_labels = None
+depends_on = None
+
+
+conversation = sa.table(
+    'conversation',
+    sa.column('id', sa.Integer),
+    sa.column('history', sa.Text),
+    sa.column('message_count', sa.Integer),
+    sa.column('last_updated', sa.DateTime),
+)
+
+message = sa.table(
+    'message',
+    sa.column('conversation_id', sa.Integer),
+    sa.column('sequence', sa.Integer),
+    sa.column('role', sa.String),
+    sa.column('content', sa.Text),
+    sa.column('created_at', sa.DateTime),
+)
+
+
+def upgrade():
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+
+    # db.create_all() in app.py may already have created the table
+    if 'message' not in inspector.get_table_names():
+        op.create_table(
+            'message',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('conversation_id', sa.Integer(), nullable=False),
+            sa.Column('sequence', sa.Integer(), nullable=False),
+            sa.Column('role', sa.String(length=20), nullable=False),
+            sa.Column('content', sa.Text(), nullable=False),
+            sa.Column('created_at', sa.DateTime(), nullable=True),
+            sa.ForeignKeyConstraint(['conversation_id'], ['conversation.id'], ondelete='CASCADE'),
+            sa.PrimaryKeyConstraint('id'),
+            sa.UniqueConstraint('conversation_id', 'sequence', name='uq_message_conversation_sequence')
+        )
+    elif 'uq_message_conversation_sequence' not in [c['name'] for c in inspector.get_unique_constraints('message')]:
+        # Created by an older db.create_all() with a plain (conversation_id, sequence) index
+        with op.batch_alter_table('message', schema=None) as batch_op:
+            if 'ix_message_conversation_sequence' in [i['name'] for i in inspector.get_indexes('message')]:
+                batch_op.drop_index('ix_message_conversation_sequence')
+            batch_op.create_unique_constraint('uq_message_conversation_sequence', ['conversation_id', 'sequence'])
+
+    if 'message_count' not in [c['name'] for c in inspector.get_columns('conversation')]:
+        with op.batch_alter_table('conversation', schema=None) as batch_op:
+            batch_op.add_column(sa.Column('message_count', sa.Integer(), nullable=True))
+
+    # Backfill: one message row per entry in each JSON history blob
+    rows = bind.execute(
+        sa.select(conversation.c.id, conversation.c.history, conversation.c.last_updated)
+        .where(conversation.c.history.isnot(None))
+        .where(conversation.c.history != '')
+    ).fetchall()
+    for conv_id, history, last_updated in rows:
+        try:
+            entries = json.loads(history)
+        except ValueError:
+            entries = []
+        if entries:
+            op.bulk_insert(message, [
+                {
+                    'conversation_id': conv_id,
+                    'sequence': sequence,
+                    'role': entry['role'],
+                    'content': entry['content'],
+                    'created_at': last_updated,
+                }
+                for sequence, entry in enumerate(entries)
+            ])
+        bind.execute(
+            conversation.update()
+            .where(conversation.c.id == conv_id)
+            .values(history='', message_count=len(entries))
+        )
+
+
+def downgrade():
+    bind = op.get_bind()
+
+    # Rebuild the JSON blobs from message rows
+    rows = bind.execute(
+        sa.select(message.c.conversation_id, message.c.role, message.c.content)
+        .order_by(message.c.conversation_id, message.c.sequence)
+    ).fetchall()
+    histories = {}
+    for conv_id, role, content in rows:
+        histories.setdefault(conv_id, []).append({'role': role, 'content': content})
+    for conv_id, entries in histories.items():
+        bind.execute(
+            conversation.update()
+            .where(conversation.c.id == conv_id)
+            .values(history=json.dumps(entries))
+        )
+
+    with op.batch_alter_table('conversation', schema=None) as batch_op:
+        batch_op.drop_column('message_count')
+
+    op.drop_table('message')
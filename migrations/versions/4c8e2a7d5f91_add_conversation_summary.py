@@ -0,0 +1,32 @@
+"""Add rolling summary columns to conversation
+
+Revision ID: 4c8e2a7d5f91
+Revises: 9b1d7f3e6c25
+Create Date: 2026-10-17 19:12:05.638240
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4c8e2a7d5f91'
+down_revision = '9b1d7f3e6c25'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # check_db_schema() in app.py may already have added the columns
+    columns = [c['name'] for c in sa.inspect(op.get_bind()).get_columns('conversation')]
+    with op.batch_alter_table('conversation', schema=None) as batch_op:
+        if 'summary' not in columns:
+            batch_op.add_column(sa.Column('summary', sa.Text(), nullable=True))
+        if 'summary_upto' not in columns:
+            batch_op.add_column(sa.Column('summary_upto', sa.Integer(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('conversation', schema=None) as batch_op:
+        batch_op.drop_column('summary_upto')
+        batch_op.drop_column('summary')
@@ -0,0 +1,47 @@
+"""Add telegram_outbox table for background Telegram delivery
+
+Revision ID: 5e7a9c3b1d48
+Revises: 8d2f61c4e9a3
+Create Date: 2026-10-17 15:02:19.804117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5e7a9c3b1d48'
+down_revision = '8d2f61c4e9a3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # db.create_all() in app.py may already have created the table
+    if 'telegram_outbox' in sa.inspect(op.get_bind()).get_table_names():
+        return
+    op.create_table(
+        'telegram_outbox',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('bot_token', sa.String(length=200), nullable=False),
+        sa.Column('chat_id', sa.String(length=100), nullable=False),
+        sa.Column('text', sa.Text(), nullable=False),
+        sa.Column('reply_markup', sa.Text(), nullable=True),
+        sa.Column('target_type', sa.String(length=30), nullable=True),
+        sa.Column('target_id', sa.Integer(), nullable=True),
+        sa.Column('status', sa.String(length=20), nullable=True),
+        sa.Column('attempts', sa.Integer(), nullable=True),
+        sa.Column('next_attempt_at', sa.DateTime(), nullable=True),
+        sa.Column('claimed_at', sa.DateTime(), nullable=True),
+        sa.Column('last_error', sa.Text(), nullable=True),
+        sa.Column('telegram_message_id', sa.Integer(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.Column('sent_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_telegram_outbox_status_next_attempt', 'telegram_outbox', ['status', 'next_attempt_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_telegram_outbox_status_next_attempt', table_name='telegram_outbox')
+    op.drop_table('telegram_outbox')
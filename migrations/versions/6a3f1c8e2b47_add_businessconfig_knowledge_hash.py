@@ -0,0 +1,29 @@
+"""Add knowledge_hash to business_config
+
+Revision ID: 6a3f1c8e2b47
+Revises: 4c8e2a7d5f91
+Create Date: 2026-10-17 20:41:17.204518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6a3f1c8e2b47'
+down_revision = '4c8e2a7d5f91'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # check_db_schema() in app.py may already have added the column
+    columns = [c['name'] for c in sa.inspect(op.get_bind()).get_columns('business_config')]
+    if 'knowledge_hash' not in columns:
+        with op.batch_alter_table('business_config', schema=None) as batch_op:
+            batch_op.add_column(sa.Column('knowledge_hash', sa.String(length=64), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('business_config', schema=None) as batch_op:
+        batch_op.drop_column('knowledge_hash')
@@ -0,0 +1,32 @@
+"""Add stored AI suggestion chips to business_config
+
+Revision ID: 8d2f61c4e9a3
+Revises: 3b9e4d2a7c15
+Create Date: 2026-10-17 13:41:07.552910
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d2f61c4e9a3'
+down_revision = '3b9e4d2a7c15'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # check_db_schema() in app.py may already have added the columns
+    columns = [c['name'] for c in sa.inspect(op.get_bind()).get_columns('business_config')]
+    with op.batch_alter_table('business_config', schema=None) as batch_op:
+        if 'ai_suggestions' not in columns:
+            batch_op.add_column(sa.Column('ai_suggestions', sa.Text(), nullable=True))
+        if 'ai_suggestions_updated_at' not in columns:
+            batch_op.add_column(sa.Column('ai_suggestions_updated_at', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('business_config', schema=None) as batch_op:
+        batch_op.drop_column('ai_suggestions_updated_at')
+        batch_op.drop_column('ai_suggestions')
@@ -0,0 +1,55 @@
+"""Add prompt_version table referenced by business_config and conversation
+
+Revision ID: 9b1d7f3e6c25
+Revises: e2f94b6c0a17
+Create Date: 2026-10-17 18:31:40.215867
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9b1d7f3e6c25'
+down_revision = 'e2f94b6c0a17'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    # db.create_all() / check_db_schema() in app.py may already have created these
+    if 'prompt_version' not in inspector.get_table_names():
+        op.create_table(
+            'prompt_version',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('config_id', sa.String(length=50), nullable=False),
+            sa.Column('content_hash', sa.String(length=64), nullable=False),
+            sa.Column('content', sa.Text(), nullable=False),
+            sa.Column('created_at', sa.DateTime(), nullable=True),
+            sa.PrimaryKeyConstraint('id'),
+            sa.UniqueConstraint('config_id', 'content_hash', name='uq_prompt_version_config_hash')
+        )
+
+    columns = [c['name'] for c in inspector.get_columns('business_config')]
+    if 'prompt_version_id' not in columns:
+        with op.batch_alter_table('business_config', schema=None) as batch_op:
+            batch_op.add_column(sa.Column('prompt_version_id', sa.Integer(), nullable=True))
+
+    columns = [c['name'] for c in inspector.get_columns('conversation')]
+    if 'prompt_version_id' not in columns:
+        with op.batch_alter_table('conversation', schema=None) as batch_op:
+            batch_op.add_column(sa.Column('prompt_version_id', sa.Integer(), nullable=True))
+            batch_op.create_foreign_key('fk_conversation_prompt_version', 'prompt_version',
+                                        ['prompt_version_id'], ['id'])
+
+
+def downgrade():
+    foreign_keys = [fk['name'] for fk in sa.inspect(op.get_bind()).get_foreign_keys('conversation')]
+    with op.batch_alter_table('conversation', schema=None) as batch_op:
+        if 'fk_conversation_prompt_version' in foreign_keys:
+            batch_op.drop_constraint('fk_conversation_prompt_version', type_='foreignkey')
+        batch_op.drop_column('prompt_version_id')
+    with op.batch_alter_table('business_config', schema=None) as batch_op:
+        batch_op.drop_column('prompt_version_id')
+    op.drop_table('prompt_version')
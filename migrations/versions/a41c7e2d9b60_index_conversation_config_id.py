@@ -0,0 +1,27 @@
+"""Index conversation.config_id for per-bot dashboard counts
+
+Revision ID: a41c7e2d9b60
+Revises: 5e7a9c3b1d48
+Create Date: 2026-10-17 16:20:51.117402
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a41c7e2d9b60'
+down_revision = '5e7a9c3b1d48'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # db.create_all() in app.py may already have created the index on a fresh database
+    indexes = [ix['name'] for ix in sa.inspect(op.get_bind()).get_indexes('conversation')]
+    if 'ix_conversation_config_id' not in indexes:
+        op.create_index('ix_conversation_config_id', 'conversation', ['config_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_conversation_config_id', table_name='conversation')
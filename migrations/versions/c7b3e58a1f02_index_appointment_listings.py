@@ -0,0 +1,31 @@
+"""Composite indexes for keyset-paginated appointment listings
+
+Revision ID: c7b3e58a1f02
+Revises: a41c7e2d9b60
+Create Date: 2026-10-17 17:05:12.448903
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c7b3e58a1f02'
+down_revision = 'a41c7e2d9b60'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # db.create_all() in app.py may already have created the indexes on a fresh database
+    indexes = [ix['name'] for ix in sa.inspect(op.get_bind()).get_indexes('appointment')]
+    if 'ix_appointment_config_status_created' not in indexes:
+        op.create_index('ix_appointment_config_status_created', 'appointment',
+                        ['config_id', 'status', 'created_at'], unique=False)
+    if 'ix_appointment_config_created' not in indexes:
+        op.create_index('ix_appointment_config_created', 'appointment', ['config_id', 'created_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_appointment_config_created', table_name='appointment')
+    op.drop_index('ix_appointment_config_status_created', table_name='appointment')
@@ -0,0 +1,43 @@
+"""Composite index for keyset-paginated conversation logs, with last_updated made non-null
+
+Revision ID: d3a8f5c1e7b2
+Revises: 6a3f1c8e2b47
+Create Date: 2026-10-18 10:14:32.517240
+
+"""
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd3a8f5c1e7b2'
+down_revision = '6a3f1c8e2b47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    bind = op.get_bind()
+
+    # Keyset pages compare last_updated, which never matches NULL: backfill from the newest
+    # message, or the epoch for conversations without one, so every row can be paged to
+    bind.execute(sa.text(
+        "UPDATE conversation SET last_updated = COALESCE("
+        "(SELECT MAX(message.created_at) FROM message WHERE message.conversation_id = conversation.id), :epoch) "
+        "WHERE last_updated IS NULL"
+    ).bindparams(sa.bindparam('epoch', datetime(1970, 1, 1), type_=sa.DateTime())))
+    with op.batch_alter_table('conversation', schema=None) as batch_op:
+        batch_op.alter_column('last_updated', existing_type=sa.DateTime(), nullable=False)
+
+    # db.create_all() in app.py may already have created the index on a fresh database
+    indexes = [ix['name'] for ix in sa.inspect(bind).get_indexes('conversation')]
+    if 'ix_conversation_config_updated' not in indexes:
+        op.create_index('ix_conversation_config_updated', 'conversation', ['config_id', 'last_updated'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_conversation_config_updated', table_name='conversation')
+    with op.batch_alter_table('conversation', schema=None) as batch_op:
+        batch_op.alter_column('last_updated', existing_type=sa.DateTime(), nullable=True)
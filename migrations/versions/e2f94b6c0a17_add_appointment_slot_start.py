@@ -0,0 +1,81 @@
+"""Add normalized appointment.slot_start with a unique index on active slots
+
+Revision ID: e2f94b6c0a17
+Revises: c7b3e58a1f02
+Create Date: 2026-10-17 17:48:33.902116
+
+"""
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2f94b6c0a17'
+down_revision = 'c7b3e58a1f02'
+branch_labels = None
+depends_on = None
+
+ACTIVE_STATUSES = "status IN ('pending', 'approved')"
+
+# Same formats as validate_strict_date() in app.py, copied so the migration
+# does not depend on importing the application
+STRICT_DATE_FORMATS = (
+    "%d %b %Y, %I:%M %p",  # 12 Feb 2026, 4:00 PM
+    "%d %B %Y, %I:%M %p",  # 12 February 2026, 4:00 PM
+    "%d %b %Y, %H:%M",     # 12 Feb 2026, 16:00
+)
+
+
+def validate_strict_date(date_str):
+    for fmt in STRICT_DATE_FORMATS:
+        try:
+            return datetime.strptime(date_str, fmt)
+        except ValueError:
+            continue
+    return None
+
+
+def upgrade():
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+    # check_db_schema() in app.py may already have added and backfilled the column
+    columns = [c['name'] for c in inspector.get_columns('appointment')]
+    if 'slot_start' not in columns:
+        with op.batch_alter_table('appointment', schema=None) as batch_op:
+            batch_op.add_column(sa.Column('slot_start', sa.DateTime(), nullable=True))
+
+    appointment = sa.table('appointment',
+                           sa.column('id', sa.Integer), sa.column('config_id', sa.String),
+                           sa.column('preferred_time', sa.String), sa.column('status', sa.String),
+                           sa.column('slot_start', sa.DateTime))
+    rows = bind.execute(sa.select(appointment.c.id, appointment.c.config_id, appointment.c.preferred_time,
+                                  appointment.c.status, appointment.c.slot_start)
+                        .order_by(appointment.c.id)).all()
+    taken = set()
+    for apt_id, config_id, preferred_time, status, slot_start in rows:
+        if slot_start is not None:
+            if status in ('pending', 'approved'):
+                taken.add((config_id, slot_start))
+            continue
+        slot = validate_strict_date((preferred_time or '').strip())
+        if not slot:
+            continue
+        if status in ('pending', 'approved'):
+            # Slots double-booked before this index existed stay with the oldest booking
+            if (config_id, slot) in taken:
+                continue
+            taken.add((config_id, slot))
+        bind.execute(appointment.update().where(appointment.c.id == apt_id).values(slot_start=slot))
+
+    indexes = [ix['name'] for ix in sa.inspect(bind).get_indexes('appointment')]
+    if 'uq_appointment_active_slot' not in indexes:
+        op.create_index('uq_appointment_active_slot', 'appointment', ['config_id', 'slot_start'], unique=True,
+                        sqlite_where=sa.text(ACTIVE_STATUSES), postgresql_where=sa.text(ACTIVE_STATUSES))
+
+
+def downgrade():
+    op.drop_index('uq_appointment_active_slot', table_name='appointment')
+    with op.batch_alter_table('appointment', schema=None) as batch_op:
+        batch_op.drop_column('slot_start')